@@ -0,0 +1,243 @@
+"""Balsa.cl Confirmation of pending changes
+
+   Accepts or rejects stops waiting for confirmation (StopNew, StopUpdate
+   and StopDelete) in batches, also merges duplicate clusters. The production data is changed with
+   grouped batch writes and the counters are adjusted once per batch.
+   Used by the single confirmations of the walkthroughs as well as by
+   the bulk confirmation.
+
+   Stefan Wehner (2011)
+"""
+
+import settings
+import logging
+import dedup
+import geo.geomath
+from google.appengine.ext import db
+from google.appengine.ext.db import Key
+from balsa_dbm import Stop, StopUpdate, StopNew, StopDelete, MergedStop
+from balsa_stops import BalsaStopFactory
+from balsa_index import StopIndex, StopLabel, StopFingerprint
+from balsa_counter import StopCounter
+
+# pending tables by the name of their walkthrough and their confirmation
+PENDING = {'new': (StopNew, "NEW"),
+           'update': (StopUpdate, "UPDATE"),
+           'delete': (StopDelete, "DELETE")}
+CONFIRMS = dict([(model_class.kind(), confirm) for model_class, confirm in PENDING.values()])
+
+
+def change_score(pending, production):
+    """Returns the magnitude of the change from production to pending,
+    moves count up to TRIAGE_DISTANCE_SCALE, see dedup.change_score"""
+    return dedup.change_score(pending, production, settings.TRIAGE_DISTANCE_SCALE)
+
+
+class ConfirmRule(object):
+    """Selects pending stops by comparing them with the production stop
+    of the same osm id
+
+    max_distance: the stop must not have moved further (meters)
+    same_names: the names must be identical
+    same_type: the stop type must be identical
+    max_score: the change score of the triage must not be higher
+    New stops have no production stop and never match a rule with conditions.
+    """
+
+    def __init__(self, max_distance=None, same_names=False, same_type=False, max_score=None):
+        self.max_distance = max_distance
+        self.same_names = same_names
+        self.same_type = same_type
+        self.max_score = max_score
+
+    def match(self, pending, production):
+        if self.max_distance is None and not self.same_names and not self.same_type and self.max_score is None:
+            return True
+        if not production:
+            return False
+        if self.max_score is not None and change_score(pending, production) > self.max_score:
+            return False
+        if self.same_names and pending.names != production.names:
+            return False
+        if self.same_type and pending.stop_type != production.stop_type:
+            return False
+        if self.max_distance is not None and pending.location != production.location:
+            if geo.geomath.distance(pending.location, production.location) >= self.max_distance:
+                return False
+        return True
+
+
+class BalsaConfirm(object):
+    """Accepts and rejects pending stops batch wise
+
+    Has to be a static class like the writer of the import.
+    """
+
+    @staticmethod
+    def _production_keys(pending):
+        return [Key.from_path('Stop', stop.key().id()) for stop in pending]
+
+    @staticmethod
+    def _cluster_keys(pending):
+        """Keys of the duplicate clusters of new stops, which are done
+        together with them"""
+        return [Key.from_path('DuplicateCluster', stop.key().id()) for stop in pending if stop.kind() == 'StopNew']
+
+    @classmethod
+    def select(cls, pending, rule):
+        """Returns the pending stops matching rule"""
+        productions = db.get(cls._production_keys(pending))
+        return [stop for stop, production in zip(pending, productions) if rule.match(stop, production)]
+
+    @classmethod
+    def triage(cls, updates):
+        """Score pending updates, accept the trivial ones in bulk
+
+        Updates scoring at most TRIAGE_AUTO_ACCEPT_SCORE are accepted,
+        the others are stored with their score. Updates of production stops
+        which are gone become new stops, see renew. Returns the number of
+        updates accepted.
+        """
+        productions = db.get(cls._production_keys(updates))
+        trivial = []
+        scored = []
+        orphans = []
+        for update, production in zip(updates, productions):
+            if not production:
+                orphans.append(update)
+                continue
+            update.change_score = change_score(update, production)
+            if update.change_score <= settings.TRIAGE_AUTO_ACCEPT_SCORE:
+                trivial.append(update)
+            else:
+                scored.append(update)
+        cls._write(scored, [])
+        cls.renew(orphans)
+        return cls.accept(trivial)
+
+    @classmethod
+    def renew(cls, updates):
+        """Turn pending updates whose production stop is gone into new stops
+
+        The production stop has been deleted since the update was queued,
+        so the admin decides on the node like on any new one. Updates of
+        production stops merged away as duplicates are dropped, the node
+        stays away. Returns the number of new stops.
+        """
+        if not updates:
+            return 0
+        merged = set([stop.key().id() for stop in
+                      db.get([Key.from_path('MergedStop', update.key().id()) for update in updates]) if stop])
+        news = [BalsaStopFactory.copy_stop(update, StopNew) for update in updates
+                if not update.key().id() in merged]
+        deltas = {}
+        for update in updates:
+            key = (update.stop_type, "UPDATE")
+            deltas[key] = deltas.get(key, 0) - 1
+        for new in news:
+            key = (new.stop_type, "NEW")
+            deltas[key] = deltas.get(key, 0) + 1
+        cls._write(news, [update.key() for update in updates])
+        StopCounter.add(deltas)
+        logging.info("Turned %d updates of deleted stops into new stops, dropped %d." %
+                     (len(news), len(updates) - len(news)))
+        return len(news)
+
+    @classmethod
+    def accept(cls, pending, obsolete_keys=[]):
+        """Accept pending stops into production
+
+        New and updated stops replace the production stop of the same osm
+        id, deletions remove it. Production stops with obsolete_keys are
+        deleted as well and recorded as MergedStop, so that the next update
+        does not bring them back. Returns the number of stops accepted.
+        """
+        pending = [stop for stop in pending if stop]
+        if not pending and not obsolete_keys:
+            return 0
+        production_keys = []
+        for key in cls._production_keys(pending) + list(obsolete_keys):
+            if not key in production_keys:
+                production_keys.append(key)
+        productions = db.get(production_keys)
+        deltas = {}
+        def count(stop_type, confirm, delta):
+            deltas[(stop_type, confirm)] = deltas.get((stop_type, confirm), 0) + delta
+
+        puts = []
+        deletes = []
+        for production in productions:
+            if production:
+                count(production.stop_type, "NO", -1)
+                deletes.append(production.key())
+        for stop in pending:
+            count(stop.stop_type, CONFIRMS[stop.kind()], -1)
+            deletes.append(stop.key())
+            if stop.kind() != 'StopDelete':
+                puts.append(BalsaStopFactory.copy_stop(stop, Stop))
+                count(stop.stop_type, "NO", 1)
+        # replaced production stops are overwritten, not deleted
+        replaced = set([stop.key() for stop in puts])
+        deletes = [key for key in deletes if not key in replaced] + cls._cluster_keys(pending)
+        obsolete_keys = set(obsolete_keys)
+        for production in productions:
+            if production and production.key() in obsolete_keys and not production.key() in replaced:
+                puts.append(MergedStop(key=Key.from_path('MergedStop', production.key().id()),
+                                       stop_type=production.stop_type))
+
+        cls._write(puts, deletes)
+        StopCounter.add(deltas)
+        StopLabel.invalidate(production_keys)
+        StopFingerprint.invalidate(production_keys)
+        StopIndex.schedule_rebuild()
+        logging.info("Accepted %d pending stops, %d obsolete." % (len(pending), len(obsolete_keys)))
+        return len(pending)
+
+    @classmethod
+    def reject(cls, pending):
+        """Drop pending stops and keep the production data, returns the
+        number of stops rejected"""
+        pending = [stop for stop in pending if stop]
+        if not pending:
+            return 0
+        deltas = {}
+        for stop in pending:
+            key = (stop.stop_type, CONFIRMS[stop.kind()])
+            deltas[key] = deltas.get(key, 0) - 1
+        cls._write([], [stop.key() for stop in pending] + cls._cluster_keys(pending))
+        StopCounter.add(deltas)
+        logging.info("Rejected %d pending stops." % (len(pending)))
+        return len(pending)
+
+    @classmethod
+    def merge(cls, clusters, keep_new=True):
+        """Resolve duplicate clusters
+
+        If keep_new, the new stops are accepted and their duplicates are
+        deleted from production, else the new stops are rejected. Returns
+        the number of clusters resolved.
+        """
+        if not clusters:
+            return 0
+        news = StopNew.get([Key.from_path('StopNew', cluster.key().id()) for cluster in clusters])
+        if keep_new:
+            obsolete = []
+            for cluster, new in zip(clusters, news):
+                # the new stop has been confirmed in the meantime
+                if new:
+                    obsolete.extend([Key.from_path('Stop', osm_id) for osm_id in cluster.duplicate_ids])
+            cls.accept(news, obsolete)
+        else:
+            cls.reject(news)
+        # clusters of new stops confirmed in the meantime are outdated
+        cls._write([], [cluster.key() for cluster in clusters])
+        return len(clusters)
+
+    @staticmethod
+    def _write(puts, deletes):
+        """Grouped batch writes of the largest size the writer uses"""
+        size = settings.WRITE_MAX_BATCH_SIZE
+        for i in range(0, len(puts), size):
+            db.put(puts[i:i+size])
+        for i in range(0, len(deletes), size):
+            db.delete(deletes[i:i+size])
@@ -0,0 +1,114 @@
+"""Balsa.cl Sharded counters for the number of stops
+
+   The number of stops per stop type and confirmation state is spread
+   over several shard entities. Writers pick a random shard, so import
+   batches and confirmations do not contend on a single entity group.
+   Readers add up all shards, the result is held in memcache.
+
+   Stefan Wehner (2011)
+"""
+
+import settings
+import logging
+import random
+from google.appengine.ext import db
+from google.appengine.ext.db import Key
+from google.appengine.api import memcache
+from balsa_dbm import StopCounterShard, StopMeta
+
+# seconds the sums are held in memcache, bounds the time a
+# concurrently computed sum may be outdated
+COUNTER_CACHE_TIME = 60
+
+
+class StopCounter(object):
+    """Number of stops per (stop_type, confirm)
+
+    Has to be a static class because the counters are shared by all requests.
+    """
+
+    @classmethod
+    def _increment(cls, stop_type, confirm, delta):
+        key_name = "%s-%s-%d" % (stop_type, confirm, random.randint(0, settings.COUNTER_SHARDS-1))
+        def store():
+            shard = StopCounterShard.get_by_key_name(key_name)
+            if not shard:
+                shard = StopCounterShard(key_name=key_name, stop_type=stop_type, confirm=confirm)
+            shard.count += delta
+            shard.put()
+        db.run_in_transaction(store)
+
+    @classmethod
+    def add(cls, deltas):
+        """Takes dictionary (stop_type, confirm) -> delta"""
+        changed = False
+        for (stop_type, confirm), delta in deltas.items():
+            assert stop_type in settings.STOP_TYPES and confirm in settings.CONFIRM_TYPES, \
+                "Invalid stop type or confirm %s/%s" % (stop_type, confirm)
+            if delta:
+                cls._increment(stop_type, confirm, delta)
+                changed = True
+        if changed:
+            memcache.delete('stop_counter')
+
+    @classmethod
+    def delta(cls, delta, stop_type, confirm="NO"):
+        cls.add({(stop_type, confirm): delta})
+
+    @classmethod
+    def migrate(cls):
+        """Seed the shards from the counters StopMeta held in older versions
+
+        The seed goes to a shard of its own, which is written with the
+        absolute value, so a migration interrupted before the StopMeta
+        counters are cleared can simply run again.
+        """
+        meta = StopMeta.get(Key.from_path('StopMeta', 1))
+        if not meta or meta.counter_stop_no_confirm is None:
+            return
+        shards = []
+        for stop_type in settings.STOP_TYPES:
+            for confirm in settings.CONFIRM_TYPES:
+                name = 'counter_%s_%s_confirm' % (stop_type.lower(), confirm.lower())
+                shards.append(StopCounterShard(key_name="%s-%s-seed" % (stop_type, confirm),
+                                               stop_type=stop_type, confirm=confirm,
+                                               count=getattr(meta, name) or 0))
+                setattr(meta, name, None)
+        db.put(shards)
+        meta.put()
+        logging.info("Seeded stop counters from StopMeta.")
+
+    @classmethod
+    def get_all(cls):
+        """Returns dictionary (stop_type, confirm) -> number of stops"""
+        counts = memcache.get('stop_counter')
+        if counts is None:
+            cls.migrate()
+            counts = {}
+            for stop_type in settings.STOP_TYPES:
+                for confirm in settings.CONFIRM_TYPES:
+                    counts[(stop_type, confirm)] = 0
+            for shard in StopCounterShard.all():
+                counts[(shard.stop_type, shard.confirm)] += shard.count
+            memcache.set('stop_counter', counts, time=COUNTER_CACHE_TIME)
+        return counts
+
+    @classmethod
+    def get(cls, stop_type, confirm="NO"):
+        return cls.get_all()[(stop_type, confirm)]
+
+    @classmethod
+    def template_values(cls, template_values, confirm):
+        """Put the counters of confirm into template_values like
+        'update_num_stops' for the pages of the update"""
+        prefix = {"NO": "production", "UPDATE": "update", "NEW": "new", "DELETE": "delete"}[confirm]
+        counts = cls.get_all()
+        template_values['%s_num_stops' % (prefix)] = counts[("STOP", confirm)]
+        template_values['%s_num_stations' % (prefix)] = counts[("STATION", confirm)]
+        template_values['%s_num_places' % (prefix)] = counts[("PLACE", confirm)]
+
+    @classmethod
+    def reset(cls):
+        """Set all counters to zero"""
+        db.delete(StopCounterShard.all(keys_only=True).fetch(1000))
+        memcache.delete('stop_counter')
@@ -12,54 +12,102 @@ import settings
 
 
 class StopMeta(db.Model):
-    """Keep track of number of datasets stored
+    """Keep track of the state of the stop data
 
-    Should contain 9 datasets, the permutations of stops
-    STOP, STATION, PLACE with confirmation NO, UPDATE and NEW
+    A single dataset. The number of stops is counted by the shards of
+    StopCounterShard, see balsa_counter.
     """
     last_update = db.DateTimeProperty()
+    # counters of older versions, only read once to seed StopCounterShard
+    # and cleared then, see StopCounter.migrate
     counter_stop_no_confirm = db.IntegerProperty()
     counter_stop_new_confirm = db.IntegerProperty()
     counter_stop_update_confirm = db.IntegerProperty()
+    counter_stop_delete_confirm = db.IntegerProperty()
     counter_station_no_confirm = db.IntegerProperty()
     counter_station_new_confirm = db.IntegerProperty()
     counter_station_update_confirm = db.IntegerProperty()
+    counter_station_delete_confirm = db.IntegerProperty()
     counter_place_no_confirm = db.IntegerProperty()
     counter_place_new_confirm = db.IntegerProperty()
     counter_place_update_confirm = db.IntegerProperty()
+    counter_place_delete_confirm = db.IntegerProperty()
 
-    def zero_all(self):
-        self.counter_stop_no_confirm = 0
-        self.counter_stop_new_confirm = 0
-        self.counter_stop_update_confirm = 0
-        self.counter_station_no_confirm = 0
-        self.counter_station_new_confirm = 0
-        self.counter_station_update_confirm = 0
-        self.counter_place_no_confirm = 0
-        self.counter_place_new_confirm = 0
-        self.counter_place_update_confirm =0
-
-    def counter_delta(self, delta, stop_type, confirm="NO"):
-        if stop_type == 'STOP' and confirm == 'NO':
-            self.counter_stop_no_confirm += delta
-        elif stop_type == 'STOP' and confirm == 'UPDATE':
-            self.counter_stop_update_confirm += delta
-        elif stop_type == 'STOP' and confirm == 'NEW':
-            self.counter_stop_new_confirm += delta
-        elif stop_type == 'PLACE' and confirm == 'NO':
-            self.counter_place_no_confirm += delta
-        elif stop_type == 'PLACE' and confirm == 'UPDATE':
-            self.counter_place_update_confirm += delta
-        elif stop_type == 'PLACE' and confirm == 'NEW':
-            self.counter_place_new_confirm += delta
-        elif stop_type == 'STATION' and confirm == 'NO':
-            self.counter_station_no_confirm += delta
-        elif stop_type == 'STATION' and confirm == 'UPDATE':
-            self.counter_station_update_confirm += delta
-        elif stop_type == 'STATION' and confirm == 'NEW':
-            self.counter_station_new_confirm += delta
-        else:
-            assert False, "Invalid stop type or confirm %s/%s" % (stop_type, confirm)
+
+class StopCounterShard(db.Model):
+    """Part of the number of stops of a stop type and confirmation
+
+    Keyed by stop_type-confirm-shard number.
+    """
+    stop_type = db.StringProperty(choices=settings.STOP_TYPES)
+    confirm = db.StringProperty(choices=settings.CONFIRM_TYPES)
+    count = db.IntegerProperty(default=0)
+
+
+class ImportCheckpoint(db.Model):
+    """Progress of an import or update which is parsed in slices
+
+    Keyed by the blob key of the uploaded data. Holds the position in the
+    uncompressed data up to which all stops have been written.
+    """
+    action = db.StringProperty()
+    # byte offset in the uncompressed osm data
+    offset = db.IntegerProperty(default=0)
+    slices = db.IntegerProperty(default=0)
+    # state of BalsaStopWriter: newest node timestamp seen so far
+    timestamp = db.DateTimeProperty()
+    # set while the slice behind offset is stored, a task finding it set
+    # retries a slice of which some stops may be stored already
+    storing = db.BooleanProperty(default=False)
+    # blob key of the uncompressed copy of a zip, gzip or bz2 upload
+    inflated = db.StringProperty()
+
+
+class PurgeShard(db.Model):
+    """Progress of one shard of a purge, a stop table and stop type
+
+    Keyed by kind-stop_type. Holds the cursor behind the keys deleted so
+    far, so a retried or chained task continues where the shard stopped.
+    Tasks of another purge than the one of generation leave it alone.
+    """
+    generation = db.StringProperty()
+    cursor = db.TextProperty()
+    deleted = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+
+
+class StopIndexSnapshot(db.Model):
+    """The stop lookup index as built by a background task
+
+    A single dataset keyed 'current'. The compressed index is split into
+    the StopIndexChunk entities keyed version-number, see balsa_index.
+    """
+    version = db.StringProperty()
+    chunks = db.IntegerProperty(default=0)
+    timestamp = db.DateTimeProperty()
+
+
+class StopIndexChunk(db.Model):
+    """Part of a StopIndexSnapshot"""
+    data = db.BlobProperty()
+
+
+class NeighbourCandidates(db.Model):
+    """Production stops of a region, loaded by the neighbour task chain of
+    the region, see balsa_update.BalsaNeighbourTask
+
+    Keyed by chain-region. The stops are kept in compressed pages, the
+    NeighbourCandidatesPage entities keyed chain-region-number. The
+    cursor points behind the stops of the last page.
+    """
+    cursor = db.TextProperty()
+    pages = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+
+
+class NeighbourCandidatesPage(db.Model):
+    """Part of NeighbourCandidates"""
+    data = db.BlobProperty()
 
 
 class Comuna(db.Model):
@@ -111,6 +159,13 @@ class Stop(GeoModel):
     comuna = db.ReferenceProperty(Comuna)
     region = db.ReferenceProperty(Region)
     country = db.ReferenceProperty(Country)
+    # display label with names and administrative hierarchy, denormalized
+    # so that lookups do not have to resolve the references above
+    label = db.StringProperty(indexed=False)
+    # hash over the osm data of the stop, see BalsaStopFactory.fingerprint
+    fingerprint = db.IntegerProperty(indexed=False)
+    # timestamp of the osm node the stop was created from
+    osm_timestamp = db.DateTimeProperty(indexed=False)
 
     def __str__(self):
         return "<Stop> id=%d %s (lat=%3.3f,lon=%3.3f)" % ("; ".join(self.names),self.location.lat,self.location.lon)
@@ -119,13 +174,19 @@ class Stop(GeoModel):
         if not other or not isinstance(other, self.__class__):
             return False
         # test for equal fields
-        if self.osm_id == other.osm_id and self.names == other.names and self.stop_type == other.stop_type and self.location == other.location:
+        if self.key().id() == other.key().id() and self.names == other.names and self.stop_type == other.stop_type and self.location == other.location:
             return True
         return False
 
 class StopUpdate(Stop):
     """Holds changed Stops which need to be confirmed by adminstrator before being moved into the Stop datastore
     """
+    # magnitude of the change, set by the triage after an update. The
+    # confirm walkthrough shows the riskiest changes first, updates the
+    # triage has not scored yet count as the riskiest (see
+    # balsa_confirm.change_score) and are not left out of the ordered query.
+    change_score = db.FloatProperty(default=3.0)
+
     def __str__(self):
         return "<StopUpdate> id=%d %s (lat=%3.3f,lon=%3.3f)" % ("; ".join(self.names),self.location.lat,self.location.lon)
 
@@ -133,6 +194,37 @@ class StopUpdate(Stop):
 class StopNew(Stop):
     """Holds new Stops which need to be confirmed by adminstrator before being moved into the Stop datastore
     """
+    # nearest production stops of the same region (osm ids and meters),
+    # found by a background task after the update
+    neighbour_ids = db.ListProperty(long, indexed=False)
+    neighbour_distances = db.ListProperty(float, indexed=False)
+    neighbours_done = db.BooleanProperty(default=False, indexed=False)
+
     def __str__(self):
         return "<StopUpdate> id=%d %s (lat=%3.3f,lon=%3.3f)" % ("; ".join(self.names),self.location.lat,self.location.lon)
 
+
+class StopDelete(Stop):
+    """Holds copies of Stops which have been deleted in openstreetmap. The deletion needs to be confirmed by administrator before the Stop is removed from the datastore
+    """
+    def __str__(self):
+        return "<StopDelete> id=%d %s (lat=%3.3f,lon=%3.3f)" % ("; ".join(self.names),self.location.lat,self.location.lon)
+
+
+class DuplicateCluster(db.Model):
+    """A new stop together with the production stops it probably duplicates. Found by a background task after the update, the key id is the osm id of the new stop
+    """
+    # osm ids of the production stops, best match first, with their scores and distances (meters)
+    duplicate_ids = db.ListProperty(long, indexed=False)
+    scores = db.ListProperty(float, indexed=False)
+    distances = db.ListProperty(float, indexed=False)
+    # best score of the cluster, orders the review
+    score = db.FloatProperty()
+    # all duplicates have the same name words as the new stop
+    exact = db.BooleanProperty(default=False, indexed=False)
+
+
+class MergedStop(db.Model):
+    """Production stop deleted as duplicate of another stop by the admin. The key id is its osm id, updates do not bring the node back as a new stop
+    """
+    stop_type = db.StringProperty(choices=settings.STOP_TYPES)
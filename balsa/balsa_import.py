@@ -7,6 +7,7 @@ import settings
 import logging
 import os
 import datetime
+import time
 from django.utils import simplejson as json
 from google.appengine.ext import db
 from google.appengine.api import users
@@ -18,52 +19,130 @@ from google.appengine.api import taskqueue
 from google.appengine.api import memcache
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-from balsa_dbm import Stop, StopNew, StopUpdate, StopMeta, Country, Region, Comuna
+from balsa_dbm import Stop, StopNew, StopUpdate, StopDelete, StopMeta, Country, Region, Comuna, PurgeShard, MergedStop
 from balsa_access import AdminRequired
 from balsa_stops import BalsaStopUploadHandler, BalsaStopStoreTask
+from balsa_index import StopIndex, StopFingerprint
+from balsa_counter import StopCounter
+
+
+# stop tables by kind
+PURGE_KINDS = {'Stop': Stop,
+               'StopUpdate': StopUpdate,
+               'StopNew': StopNew,
+               'StopDelete': StopDelete,
+               'MergedStop': MergedStop}
 
 
 class BalsaPurgeTask(webapp.RequestHandler):
-    """Delete all data in the stop table"""
+    """Delete all data of one stop table and stop type
 
-    def post(self):
-        num = 0
-        for stop in settings.STOP_TYPES:
-            counter = StopMeta.get(Key.from_path('StopMeta', 1))
-            q = db.Query(Stop, keys_only=True).filter("stop_type =", stop).fetch(100)
-            logging.debug(q)
-            counter.counter_delta(-len(q), stop, "NO")
-            num += len(q)
-            db.delete(q)
-
-            q = db.Query(StopUpdate, keys_only=True).filter("stop_type =", stop).fetch(100)
-            logging.debug(q)
-            counter.counter_delta(-len(q), stop, "UPDATE")
-            num += len(q)
-            db.delete(q)
-
-            q = db.Query(StopNew, keys_only=True).filter("stop_type =", stop).fetch(100)
-            logging.debug(q)
-            counter.counter_delta(-len(q), stop, "NEW")
-            num += len(q)
-            db.delete(q)
-            counter.put()
-
-        if num:
-            taskqueue.add(url='/purge/delete', queue_name='import')
+    Every combination of table and stop type is a shard of the purge,
+    all shards run in parallel. A shard walks its keys with a cursor and
+    chains a follow-up task when it runs out of time. Its progress is
+    kept in a PurgeShard entity, so retried tasks neither repeat nor
+    lose work. The counters are reset once all shards are finished.
+    Every purge has a generation, tasks of an earlier purge which are
+    still queued exit without touching the shards of a later one.
+    """
 
+    def post(self):
+        kind = self.request.get('kind')
+        stop_type = self.request.get('stop_type')
+        generation = self.request.get('generation')
+        model_class = PURGE_KINDS[kind]
+        shard = PurgeShard.get_by_key_name(BalsaPurgeTask.shard_name(kind, stop_type))
+        if not shard or shard.generation != generation or shard.done:
+            return
+
+        query = db.Query(model_class, keys_only=True).filter("stop_type =", stop_type)
+        if shard.cursor:
+            query.with_cursor(shard.cursor)
+        deadline = time.time() + settings.TASK_TIME_BUDGET
+        keys = []
+        while time.time() < deadline:
+            keys = query.fetch(settings.PURGE_BATCH_SIZE)
+            if not keys:
+                break
+            db.delete(keys)
+            if kind == 'StopNew':
+                # duplicate clusters live and die with their new stops
+                db.delete([Key.from_path('DuplicateCluster', key.id()) for key in keys])
+            shard.deleted += len(keys)
+            shard.cursor = query.cursor()
+            if not BalsaPurgeTask.save(shard):
+                return
+            query.with_cursor(shard.cursor)
+
+        if keys:
+            # out of time, continue behind the last batch
+            BalsaPurgeTask.queue_task(kind, stop_type, generation)
+            memcache.set('import_status', "Deleting all data (%d datasets deleted)." % (BalsaPurgeTask.deleted()), time=600)
+            return
+
+        shard.done = True
+        if not BalsaPurgeTask.save(shard):
+            return
+        logging.info("Purged %d entities of %s %s." % (shard.deleted, kind, stop_type))
+        shards = PurgeShard.get_by_key_name(BalsaPurgeTask.shard_names())
+        if [other for other in shards if not other or other.generation != generation or not other.done]:
+            memcache.set('import_status', "Deleting all data (%d datasets deleted)." % (BalsaPurgeTask.deleted()), time=600)
+            return
+        # the last shards may finish at the same time, all of this is idempotent
+        StopCounter.reset()
+        StopIndex.schedule_rebuild()
+        StopFingerprint.invalidate_all()
         memcache.set('import_status', "Deletion finished.", time=30)
 
+    @staticmethod
+    def save(shard):
+        """Put shard unless a later purge has started meanwhile, returns
+        False then"""
+        def store():
+            current = PurgeShard.get(shard.key())
+            if not current or current.generation != shard.generation:
+                return False
+            shard.put()
+            return True
+        return db.run_in_transaction(store)
+
+    @staticmethod
+    def shard_name(kind, stop_type):
+        return "%s-%s" % (kind, stop_type)
+
+    @staticmethod
+    def shard_names():
+        names = []
+        for kind in PURGE_KINDS.keys():
+            for stop_type in settings.STOP_TYPES:
+                names.append(BalsaPurgeTask.shard_name(kind, stop_type))
+        return names
+
+    @staticmethod
+    def deleted():
+        """Returns the number of entities deleted by all shards so far"""
+        return sum([shard.deleted for shard in PurgeShard.get_by_key_name(BalsaPurgeTask.shard_names()) if shard])
+
+    @staticmethod
+    def queue_task(kind, stop_type, generation):
+        taskqueue.add(url='/purge/delete', queue_name='purge',
+                      params={'kind': kind, 'stop_type': stop_type, 'generation': generation})
+
 
 class BalsaPurge(webapp.RequestHandler):
-    """Start a background job to delete all data in the stop table"""
+    """Start background jobs to delete all data in the stop tables"""
 
     @AdminRequired
     def get(self, login_user=None, template_values={}):
-        # start background process
-        taskqueue.add(url='/purge/delete', queue_name='import')
-
-        memcache.set('import_status', "Deleting all data", time=30)
+        # progress of an earlier purge is outdated, so are its tasks
+        generation = "%d" % (time.time() * 1000)
+        db.put([PurgeShard(key_name=name, generation=generation) for name in BalsaPurgeTask.shard_names()])
+        # start one background process per table and stop type
+        for kind in PURGE_KINDS.keys():
+            for stop_type in settings.STOP_TYPES:
+                BalsaPurgeTask.queue_task(kind, stop_type, generation)
+
+        memcache.set('import_status', "Deleting all data", time=600)
         self.redirect('/update')
 
 
@@ -79,14 +158,14 @@ class BalsaImportSelect(webapp.RequestHandler):
         #       time. For the moment we concentrate on Chile.
         if StopMeta.get(Key.from_path('StopMeta', 1)):
             self.redirect('/update')
+            return
 
-        # set counter fields to zero
-        # counter_fields = StopMeta(Key.from_path('StopMeta', 1))
+        # set counters to zero
+        StopCounter.reset()
         def store():
-            counter_fields = StopMeta(key=Key.from_path('StopMeta', 1))
-            counter_fields.zero_all()
-            counter_fields.last_update = datetime.datetime(2011,1,1)
-            counter_fields.put()
+            meta = StopMeta(key=Key.from_path('StopMeta', 1))
+            meta.last_update = datetime.datetime(2011,1,1)
+            meta.put()
         db.run_in_transaction(store)
 
         template_values['upload_url'] = blobstore.create_upload_url('/import/upload')
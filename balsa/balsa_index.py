@@ -0,0 +1,412 @@
+"""Balsa.cl In-memory search index for the stop lookup
+
+   The whole set of production stops, stations and places together with
+   the administrative hierarchy (comunas, regions and countries) is small
+   enough to be held in instance memory. The index is built once per
+   instance from the datastore and answers prefix lookups on the plain
+   ascii names without any further datastore access. A background task
+   builds the index from the datastore and stores it as a compressed
+   snapshot, which the instances load.
+
+   Stefan Wehner (2011)
+"""
+
+import settings
+import logging
+import bisect
+import datetime
+import time
+import zlib
+import cPickle as pickle
+from google.appengine.ext import db
+from google.appengine.ext.db import Key
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from balsa_dbm import Stop, Comuna, StopIndexSnapshot, StopIndexChunk
+
+# fetch size for reading the datastore while building the index
+INDEX_FETCH_SIZE = 500
+# bytes of the compressed index per StopIndexChunk, below the entity size limit
+INDEX_CHUNK_SIZE = 900*1024
+# seconds the version of the index snapshot is held in memcache
+VERSION_CACHE_TIME = 60
+# seconds between a change of the production data and the rebuild of the
+# index, all changes within this time are picked up by the same rebuild
+REBUILD_DELAY = 60
+# seconds a confirm walkthrough is held in memcache
+REVIEW_CACHE_TIME = 3600
+
+
+def format_label(names, comuna=None, region=None, country=None):
+    """Returns the display label for a stop
+
+    Looks like: name (alt names), comuna, region short name, country
+    """
+    label = ""
+    if names:
+        label = names[0]
+    if len(names) > 1:
+        label = "%s (%s)" % (label, ", ".join(names[1:]))
+    for name in [comuna, region, country]:
+        if name:
+            label = "%s, %s" % (label, name)
+    return label
+
+
+class StopLabel(object):
+    """Cache for display labels of production stops keyed by stop key
+
+    Labels are looked up in instance memory first, then in memcache and
+    only then in the datastore. The import and update pipeline has to
+    invalidate the labels of all stops it writes.
+    """
+
+    _labels = {}
+
+    @classmethod
+    def from_stop(cls, stop):
+        """Returns label of stop entity, resolving references for old
+        entities which have been stored without a label"""
+        if stop.label:
+            return stop.label
+        return format_label(stop.names,
+                            stop.comuna and stop.comuna.name,
+                            stop.region and stop.region.short_name,
+                            stop.country and stop.country.name)
+
+    @classmethod
+    def seed(cls, labels):
+        """Put dictionary of stop key -> label into the instance cache"""
+        cls._labels.update(labels)
+
+    @classmethod
+    def get_multi(cls, keys):
+        """Returns dictionary stop key -> label for the given keys"""
+        res = {}
+        missing = []
+        for key in keys:
+            if key in cls._labels:
+                res[key] = cls._labels[key]
+            else:
+                missing.append(key)
+        if missing:
+            cached = memcache.get_multi([str(key) for key in missing], key_prefix='label:')
+            keys = missing
+            missing = []
+            for key in keys:
+                if str(key) in cached:
+                    res[key] = cached[str(key)]
+                else:
+                    missing.append(key)
+        if missing:
+            labels = {}
+            for stop in db.get(missing):
+                if stop:
+                    labels[stop.key()] = cls.from_stop(stop)
+            memcache.set_multi(dict([(str(key), label) for key,label in labels.items()]), key_prefix='label:')
+            res.update(labels)
+        cls._labels.update(res)
+        return res
+
+    @classmethod
+    def invalidate(cls, keys):
+        """Remove the labels of changed stops"""
+        for key in keys:
+            cls._labels.pop(key, None)
+        memcache.delete_multi([str(key) for key in keys], key_prefix='label:')
+
+
+class StopFingerprint(object):
+    """Cache of the fingerprints of production stops keyed by osm id
+
+    Lets an update skip unchanged nodes without fetching their stops. The
+    cache is filled by the import and by the update itself, entries of
+    stops which are changed outside of them have to be invalidated. A
+    purge outdates all entries at once by moving to a new generation.
+    """
+
+    @classmethod
+    def _prefix(cls):
+        generation = memcache.get('fingerprint_generation') or 0
+        return 'fp:%d:' % (generation)
+
+    @classmethod
+    def get_multi(cls, osm_ids):
+        """Returns dictionary osm id -> fingerprint of the cached ids"""
+        cached = memcache.get_multi([str(osm_id) for osm_id in osm_ids], key_prefix=cls._prefix())
+        return dict([(long(osm_id), fingerprint) for osm_id,fingerprint in cached.items()])
+
+    @classmethod
+    def set_multi(cls, fingerprints):
+        """Put dictionary osm id -> fingerprint into the cache"""
+        if fingerprints:
+            memcache.set_multi(dict([(str(osm_id), fingerprint) for osm_id,fingerprint in fingerprints.items()]),
+                               key_prefix=cls._prefix())
+
+    @classmethod
+    def invalidate(cls, keys):
+        """Remove the fingerprints of changed stops"""
+        memcache.delete_multi([str(key.id()) for key in keys], key_prefix=cls._prefix())
+
+    @classmethod
+    def invalidate_all(cls):
+        if memcache.incr('fingerprint_generation') is None:
+            memcache.add('fingerprint_generation', 1)
+
+
+class ReviewCache(object):
+    """Prefetched candidates of the confirm walkthroughs per admin
+
+    Holds the cursor behind the prefetched candidates and the candidates
+    themselves, prepared for the template. A new upload outdates the
+    walkthroughs of all admins by moving to a new generation.
+    """
+
+    @classmethod
+    def _key(cls, user, flow):
+        generation = memcache.get('review_generation') or 0
+        return 'review:%d:%s:%s' % (generation, flow, user)
+
+    @classmethod
+    def get(cls, user, flow):
+        """Returns dictionary with 'cursor' and list of 'items'"""
+        return memcache.get(cls._key(user, flow)) or {'cursor': None, 'items': []}
+
+    @classmethod
+    def set(cls, user, flow, review):
+        memcache.set(cls._key(user, flow), review, time=REVIEW_CACHE_TIME)
+
+    @classmethod
+    def delete(cls, user, flow):
+        memcache.delete(cls._key(user, flow))
+
+    @classmethod
+    def invalidate_all(cls):
+        if memcache.incr('review_generation') is None:
+            memcache.add('review_generation', 1)
+
+
+class PrefixIndex(object):
+    """Sorted array of (ascii name, key) pairs
+
+    Answers the same question as a datastore query with
+    'ascii_names >=' and 'ascii_names <' filters on a string list property.
+    """
+
+    def __init__(self):
+        self._words = []
+        self._keys = []
+
+    def build(self, pairs):
+        """Takes an iterable of (ascii_name, key) tuples"""
+        pairs = sorted(pairs)
+        self._words = [word for word,key in pairs]
+        self._keys = [key for word,key in pairs]
+
+    def lookup(self, prefix, limit, accept=None):
+        """Returns up to limit distinct keys with a name starting with prefix
+
+        The keys are returned in the order of their lowest matching name,
+        like the datastore does. If accept is given, only keys for which
+        accept(key) is True are returned.
+        """
+        res = []
+        seen = set()
+        i = bisect.bisect_left(self._words, prefix)
+        while i < len(self._words) and len(res) < limit:
+            if not self._words[i].startswith(prefix):
+                break
+            key = self._keys[i]
+            if not key in seen and (not accept or accept(key)):
+                seen.add(key)
+                res.append(key)
+            i += 1
+        return res
+
+    def __len__(self):
+        return len(self._words)
+
+
+class StopIndex(object):
+    """Instance wide index of stops and administrative entities
+
+    Has to be a static class because it lives as long as the instance and
+    is shared by all requests. The index is built by a background task and
+    stored as a snapshot, requests only load the latest snapshot and keep
+    answering from the index they hold until a newer one has been stored.
+    """
+
+    _version = None
+    _comunas = PrefixIndex()
+    _stops = {}
+    # stop id -> (stop_type, comuna name, label)
+    _stop_data = {}
+    # stop key -> stop_type of the stops found by datastore queries, as
+    # long as the instance holds no index
+    _queried = {}
+
+    @classmethod
+    def version(cls):
+        """Returns the version of the latest snapshot as (name, number of
+        chunks), None if no index has been built yet"""
+        version = memcache.get('stop_index_version')
+        if not version:
+            snapshot = StopIndexSnapshot.get_by_key_name('current')
+            if not snapshot:
+                return None
+            version = (snapshot.version, snapshot.chunks)
+            memcache.set('stop_index_version', version, time=VERSION_CACHE_TIME)
+        return version
+
+    @classmethod
+    def schedule_rebuild(cls):
+        """The production data has changed, queue a rebuild of the index
+
+        Cheap enough to be called for every change, only the first call
+        within REBUILD_DELAY queues a task.
+        """
+        if memcache.add('stop_index_rebuild', True, time=10*REBUILD_DELAY):
+            taskqueue.add(url='/update/index', queue_name='import', countdown=REBUILD_DELAY)
+
+    @classmethod
+    def _fetch_all(cls, model_class):
+        """Iterates over all entities of model_class in batches"""
+        query = model_class.all()
+        entities = query.fetch(INDEX_FETCH_SIZE)
+        while entities:
+            for entity in entities:
+                yield entity
+            if len(entities) < INDEX_FETCH_SIZE:
+                break
+            query.with_cursor(query.cursor())
+            entities = query.fetch(INDEX_FETCH_SIZE)
+
+    @classmethod
+    def _chunk_keys(cls, version):
+        name, chunks = version
+        return [Key.from_path('StopIndexChunk', "%s-%d" % (name, i)) for i in xrange(chunks)]
+
+    @classmethod
+    def build(cls):
+        """Read all production data from the datastore and store it as the
+        latest snapshot, runs in the background task"""
+        # changes from now on need another rebuild
+        memcache.delete('stop_index_rebuild')
+        comuna_pairs = []
+        for comuna in cls._fetch_all(Comuna):
+            comuna_pairs.extend([(name, comuna.key().name()) for name in comuna.ascii_names])
+
+        stop_pairs = dict([(stop_type, []) for stop_type in settings.STOP_TYPES])
+        stop_data = {}
+        for stop in cls._fetch_all(Stop):
+            osm_id = stop.key().id()
+            comuna = Stop.comuna.get_value_for_datastore(stop)
+            # only old entities without a label resolve their references here
+            stop_data[osm_id] = (stop.stop_type, comuna and comuna.name(), StopLabel.from_stop(stop))
+            stop_pairs[stop.stop_type].extend([(word, osm_id) for word in stop.ascii_names])
+        # sorting the sorted pairs again on load takes linear time only
+        comuna_pairs.sort()
+        for pairs in stop_pairs.values():
+            pairs.sort()
+
+        data = zlib.compress(pickle.dumps((comuna_pairs, stop_pairs, stop_data), pickle.HIGHEST_PROTOCOL))
+        version = ("%d" % (time.time() * 1000), (len(data) + INDEX_CHUNK_SIZE - 1) / INDEX_CHUNK_SIZE)
+        for key, offset in zip(cls._chunk_keys(version), xrange(0, len(data), INDEX_CHUNK_SIZE)):
+            # one by one, a batch would exceed the size limit of an api call
+            StopIndexChunk(key=key, data=db.Blob(data[offset:offset + INDEX_CHUNK_SIZE])).put()
+
+        def replace():
+            old = StopIndexSnapshot.get_by_key_name('current')
+            StopIndexSnapshot(key_name='current', version=version[0], chunks=version[1],
+                              timestamp=datetime.datetime.now()).put()
+            return old
+        old = db.run_in_transaction(replace)
+        memcache.set('stop_index_version', version, time=VERSION_CACHE_TIME)
+        if old:
+            db.delete(cls._chunk_keys((old.version, old.chunks)))
+        logging.info("Stored stop index %s of %d stops and %d comuna names in %d bytes" %
+                     (version[0], len(stop_data), len(comuna_pairs), len(data)))
+
+    @classmethod
+    def load(cls, version):
+        """Load the snapshot of version, returns False if it is gone"""
+        chunks = db.get(cls._chunk_keys(version))
+        if [chunk for chunk in chunks if not chunk]:
+            # replaced by a newer snapshot meanwhile
+            return False
+        comuna_pairs, stop_pairs, stop_data = pickle.loads(zlib.decompress("".join([chunk.data for chunk in chunks])))
+        comunas = PrefixIndex()
+        comunas.build(comuna_pairs)
+        stops = {}
+        for stop_type, pairs in stop_pairs.items():
+            stops[stop_type] = PrefixIndex()
+            stops[stop_type].build(pairs)
+
+        cls._comunas = comunas
+        cls._stops = stops
+        cls._stop_data = stop_data
+        cls._version = version
+        logging.info("Loaded stop index %s of %d stops and %d comuna names" % (version[0], len(stop_data), len(comunas)))
+        return True
+
+    @classmethod
+    def ensure_current(cls):
+        """Load the latest snapshot if the instance holds an older one
+
+        Until an index has been loaded, e.g. right after the deployment or
+        if the snapshot is gone, lookups are answered by datastore queries
+        on the ascii names.
+        """
+        cls._queried = {}
+        version = cls.version()
+        if version and version != cls._version:
+            if not cls.load(version):
+                memcache.delete('stop_index_version')
+        if not cls._version and not version:
+            # never built, e.g. data imported by an older version
+            cls.schedule_rebuild()
+
+    @classmethod
+    def _query(cls, model_class, prefix):
+        """Returns keys only query for entities with a name starting with prefix"""
+        query = db.Query(model_class, keys_only=True)
+        query.filter("ascii_names >=", prefix)
+        query.filter("ascii_names <", prefix + u"\ufffd")
+        return query
+
+    @classmethod
+    def lookup_comunas(cls, prefix, limit):
+        if not cls._version:
+            return cls._query(Comuna, prefix).fetch(limit)
+        return [Key.from_path('Comuna', name) for name in cls._comunas.lookup(prefix, limit)]
+
+    @classmethod
+    def lookup_stops(cls, prefix, stop_type, limit, comuna=None):
+        if not cls._version:
+            query = cls._query(Stop, prefix)
+            if comuna:
+                query.filter("comuna =", comuna)
+            query.filter("stop_type =", stop_type)
+            keys = query.fetch(limit)
+            for key in keys:
+                cls._queried[key] = stop_type
+            return keys
+        if not stop_type in cls._stops:
+            return []
+        accept = None
+        if comuna:
+            accept = lambda osm_id: cls._stop_data[osm_id][1] == comuna.name()
+        return [Key.from_path('Stop', osm_id) for osm_id in cls._stops[stop_type].lookup(prefix, limit, accept)]
+
+    @classmethod
+    def stop_type(cls, key):
+        if not cls._version:
+            return cls._queried[key]
+        return cls._stop_data[key.id()][0]
+
+    @classmethod
+    def labels(cls, keys):
+        """Returns dictionary stop key -> label, as of the snapshot"""
+        if not cls._version:
+            return StopLabel.get_multi(keys)
+        return dict([(key, cls._stop_data[key.id()][2]) for key in keys])
@@ -0,0 +1,110 @@
+"""Balsa.cl Progress figures of imports and updates
+
+   The parser and the writer of an import or update publish their
+   throughput into a record in memcache. The record survives the chain
+   of tasks which parse the data slice by slice and is shown on the
+   update page and by /update/metrics.
+
+   Stefan Wehner (2011)
+"""
+
+import time
+from google.appengine.api import memcache
+
+# seconds a metrics record is held in memcache
+METRICS_CACHE_TIME = 24*3600
+# upper bounds (seconds) of the histogram of the time the writer waited
+# for a datastore put, see BalsaStopWriter._complete
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.0, 5.0]
+
+
+class ImportMetrics(object):
+    """Throughput record of one import or update"""
+
+    def __init__(self, action, bytes_total=0):
+        self.action = action
+        self.started = time.time()
+        self.updated = self.started
+        self.finished = False
+        # size of the uploaded (possibly compressed) data and the part parsed
+        self.bytes_total = bytes_total
+        self.bytes_read = 0
+        self.slices = 0
+        # seconds spent in parsing slices, without the gaps between tasks
+        self.parse_seconds = 0.0
+        self.nodes_scanned = 0
+        # kind -> number of matching nodes
+        self.matches = {}
+        self.entities_written = 0
+        self.batches_written = 0
+        # one count per bucket of LATENCY_BUCKETS plus one for longer waits
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    @staticmethod
+    def load(action):
+        """Returns the record of the running action, None if there is none"""
+        return memcache.get('%s_metrics' % action)
+
+    @staticmethod
+    def start(action, bytes_total):
+        """Start a new record for an uploaded file"""
+        metrics = ImportMetrics(action, bytes_total)
+        metrics.save()
+        return metrics
+
+    def save(self):
+        self.updated = time.time()
+        memcache.set('%s_metrics' % self.action, self, time=METRICS_CACHE_TIME)
+
+    def add_match(self, kind):
+        self.matches[kind] = self.matches.get(kind, 0) + 1
+
+    def add_slice(self, bytes_read, nodes, seconds):
+        """Account a parsed slice, bytes_read is the position in the upload"""
+        self.bytes_read = bytes_read
+        self.nodes_scanned += nodes
+        self.parse_seconds += seconds
+        self.slices += 1
+
+    def add_write(self, entities, wait):
+        self.entities_written += entities
+        self.batches_written += 1
+        i = 0
+        while i < len(LATENCY_BUCKETS) and wait > LATENCY_BUCKETS[i]:
+            i += 1
+        self.latency_histogram[i] += 1
+
+    def finish(self):
+        self.bytes_read = self.bytes_total
+        self.finished = True
+        self.save()
+
+    def eta(self):
+        """Returns the estimated seconds until the action has finished"""
+        if self.finished:
+            return 0
+        if not self.bytes_read:
+            return None
+        elapsed = self.updated - self.started
+        return int(elapsed * (self.bytes_total - self.bytes_read) / self.bytes_read)
+
+    def as_dict(self):
+        """Returns the record for templates and json"""
+        labels = ["<= %.2f s" % (bound) for bound in LATENCY_BUCKETS] + ["> %.2f s" % (LATENCY_BUCKETS[-1])]
+        nodes_per_second = 0
+        if self.parse_seconds:
+            nodes_per_second = int(self.nodes_scanned / self.parse_seconds)
+        return {'action': self.action,
+                'finished': self.finished,
+                'elapsed': int(self.updated - self.started),
+                'eta': self.eta(),
+                'bytes_total': self.bytes_total,
+                'bytes_read': self.bytes_read,
+                'slices': self.slices,
+                'parse_seconds': round(self.parse_seconds, 1),
+                'nodes_scanned': self.nodes_scanned,
+                'nodes_per_second': nodes_per_second,
+                'matches': sorted(self.matches.items()),
+                'entities_written': self.entities_written,
+                'batches_written': self.batches_written,
+                'latency_histogram': zip(labels, self.latency_histogram)}
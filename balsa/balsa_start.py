@@ -8,14 +8,13 @@ import settings
 import logging
 import os
 from django.utils import simplejson as json
-from google.appengine.ext import db
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.db import Key
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api import memcache
-from balsa_dbm import Stop, Comuna, Country, Region
 from balsa_stops import Normalize
+from balsa_index import StopIndex
 
 class LookupStop(webapp.RequestHandler):
     """Lookup function for search term.
@@ -33,16 +32,14 @@ class LookupStop(webapp.RequestHandler):
 
         logging.debug("lookup stops for %s" % " ".join(queries))
 
+        # all lookups are answered from the in-memory index
+        StopIndex.ensure_current()
+
         # look for city first
         match_query = ""
         comunas = []
         for query in queries:
-            query0 = query
-            query1 = query0+u"\ufffd"
-            q_com = db.Query(Comuna, keys_only=True)
-            q_com.filter("ascii_names >=", query0)
-            q_com.filter("ascii_names <", query1)
-            com = q_com.fetch(4)
+            com = StopIndex.lookup_comunas(query, 4)
             # choose the result(s) with max. 3 matches
             if len(com) > 0 and len(com) < 4:
                 # use the results if better then the results from a previous string part
@@ -63,18 +60,15 @@ class LookupStop(webapp.RequestHandler):
                 continue
             all_words = []
             for query in queries:
-                query0 = query
-                query1 = query0+u"\ufffd"
                 # look up plain query string in list of plain keys
-                q_pk = db.Query(Stop, keys_only=True)
+                comuna = None
                 if stop == "STOP" and comunas:
-                    q_pk.filter("comuna =", comunas[0])
-                q_pk.filter("ascii_names >=", query0)
-                q_pk.filter("ascii_names <", query1)
-                q_pk.filter("stop_type =", stop)
-                stops = q_pk.fetch(7)
+                    comuna = comunas[0]
+                stops = StopIndex.lookup_stops(query, stop, 7, comuna)
                 # convert from list to set
                 all_words.append(set(stops))
+            if not all_words:
+                continue
             # At this point we have the result sets (stop keys) for the words in the query.
             # Now we need to find the Stop entities (hopefully very few) which are in _all_
             # of the sets
@@ -83,23 +77,10 @@ class LookupStop(webapp.RequestHandler):
                 stops = stops.intersection(stop)
             all_stops.extend(stops)
 
-
-        # retrieve entries from database
-        stop_entries = db.get(list(all_stops))
+        labels = StopIndex.labels(all_stops)
         grouped = {'STOP': [], 'PLACE': [], 'STATION': []}
-        for stop in stop_entries:
-            name = ""
-            if stop.names:
-                name = stop.names[0]
-            if len(stop.names) > 1:
-                name = "%s (%s)" % (name, ", ".join(stop.names[1:]))
-            if stop.comuna:
-                name = "%s, %s" % (name, stop.comuna.name)
-            if stop.region:
-                name = "%s, %s" % (name, stop.region.short_name)
-            if stop.country:
-                name = "%s, %s" % (name, stop.country.name)
-            grouped[stop.stop_type].append(name)
+        for key in all_stops:
+            grouped[StopIndex.stop_type(key)].append(labels[key])
         # return in the order: PLACE, STATION, STOP
         res = grouped['PLACE']
         res.extend(grouped['STATION'])
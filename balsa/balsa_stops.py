@@ -8,11 +8,15 @@ import settings
 import logging
 import os
 import re
-import difflib
 import zipfile
 import osmparse
+import osmpbf
+import regionmatch
 import unicodedata
 import datetime
+import time
+import struct
+import hashlib
 from google.appengine.ext import db
 from google.appengine.api import users
 from google.appengine.ext import webapp
@@ -21,10 +25,14 @@ from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api import taskqueue
 from google.appengine.api import memcache
+from google.appengine.api import files
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-from balsa_dbm import Stop, StopMeta, Country, Region, Comuna
+from balsa_dbm import Stop, StopUpdate, StopNew, StopDelete, StopMeta, Country, Region, Comuna, ImportCheckpoint
 from balsa_access import AdminRequired
+from balsa_index import StopIndex, StopLabel, StopFingerprint, ReviewCache, format_label
+from balsa_counter import StopCounter
+from balsa_metrics import ImportMetrics
 
 
 class Normalize(object):
@@ -53,12 +61,72 @@ class Normalize(object):
                 res.append(s1)
         return res
 
+class BalsaAdminCache(object):
+    """Import scoped cache of the administrative entities Country, Region
+    and Comuna
+
+    The keys of these entities are made from their names, so stops can
+    reference them without a datastore round trip. Entities which are not
+    known to exist are collected and created in one batch by flush(),
+    which has to run before the stops referencing them are stored.
+    """
+
+    # keys known to exist in the datastore (for the life time of the instance)
+    _known = set()
+    # key -> entity, waiting to be created
+    _pending = {}
+
+    @classmethod
+    def init(cls):
+        cls._pending = {}
+
+    @classmethod
+    def key(cls, model_class, key_name, **kwds):
+        """Returns the key of the entity, created with kwds if it is new"""
+        key = Key.from_path(model_class.kind(), key_name)
+        if not key in cls._known and not key in cls._pending:
+            cls._pending[key] = model_class(key=key, **kwds)
+        return key
+
+    @classmethod
+    def flush(cls):
+        """Create the entities which are not in the datastore yet"""
+        if not cls._pending:
+            return
+        keys = cls._pending.keys()
+        new = [cls._pending[key] for key,entity in zip(keys, db.get(keys)) if not entity]
+        if new:
+            logging.debug("Creating %d administrative entities" % (len(new)))
+            db.put(new)
+        cls._known.update(keys)
+        cls._pending = {}
+
+
 class BalsaStopFactory(object):
     """Acts as a factory for Stop datasets
 
     Has to be a static class because it is used from a static callback function
     """
 
+    # memoizes region tags over all nodes parsed by this instance
+    region_resolver = regionmatch.RegionResolver(settings.REGIONS)
+    # tags with alternative names of a stop
+    name_tags = ['alt_name', 'nat_name', 'old_name', 'reg_name', 'loc_name', 'official_name']
+
+    @classmethod
+    def fingerprint(cls, node, kind):
+        """Returns a 64 bit hash over the node data a stop is made of
+
+        Covers type, position, names and is_in tags, so an unchanged node
+        is recognized without reading its stop from the datastore.
+        """
+        fields = [kind, "%.7f" % (node.lat), "%.7f" % (node.lon), node.name]
+        for k,v in sorted(node.attr.items()):
+            if k in cls.name_tags or k.startswith('name:') or k.startswith('is_in'):
+                fields.append(u"%s=%s" % (k, v))
+        digest = hashlib.md5(u"\n".join(fields).encode('UTF-8')).digest()
+        return struct.unpack("<q", digest[:8])[0]
+
     @classmethod
     def create_stop(cls, node, kind):
         """Returns stop in production table created with parent to be in the correct entity group"""
@@ -80,6 +148,18 @@ class BalsaStopFactory(object):
         # uses the update function to fill all fields
         return cls.fill_stop(stop, node, kind)
 
+    @classmethod
+    def create_delete_stop(cls, stop):
+        """Returns copy of production stop in the table of deletions to be confirmed"""
+        return cls.copy_stop(stop, StopDelete)
+
+    @classmethod
+    def copy_stop(cls, stop, model_class):
+        """Returns copy of stop of any of the stop tables in the table of
+        model_class, with the same osm id"""
+        values = dict([(name, prop.get_value_for_datastore(stop)) for name,prop in Stop.properties().items()])
+        return model_class(key=Key.from_path(model_class.kind(), stop.key().id()), **values)
+
     @classmethod
     def fill_stop(self, stop, node, kind):
         """Returns stop in the correct entity group"""
@@ -87,41 +167,39 @@ class BalsaStopFactory(object):
         stop.location = db.GeoPt(lat=node.lat, lon=node.lon)
         stop.update_location()
         stop.names = [node.name]
-        gov = []
+        gov = {}
         for k,v in node.attr.items():
-            if k in ['alt_name', 'nat_name', 'old_name', 'reg_name', 'loc_name', 'official_name']:
+            if k in self.name_tags:
                 stop.names.append(v)
             if k.startswith('name:'):
                 # language specific
                 stop.names.append(v)
             # adminstrative regions
-            if k.startswith('is_in:country'):
-                country = Country.get_or_insert(v, name=v, ascii_names=Normalize.normalize(v))
-                stop.country = country
+            if k.startswith('is_in:country') and v:
+                stop.country = BalsaAdminCache.key(Country, v, name=v, ascii_names=Normalize.normalize(v))
+                gov['country'] = v
             if k.startswith('is_in:region') or k.startswith('is_in:state'):
                 # find the region with the best match (but must have some similarity to tag)
-                region_match = (0.6, "<no match>", "-")
-                for short_name,long_name in settings.REGIONS:
-                    ndiff = difflib.SequenceMatcher(None,long_name,v)
-                    if ndiff.ratio() > region_match[0]:
-                        region_match = (ndiff.ratio(), unicode(long_name), unicode(short_name))
-                if region_match[1] != "<no match>":
-                    logging.debug("Match %f for %s and %s" % region_match)
-                    region = Region.get_or_insert(region_match[2],
-                                                  name=region_match[1],
-                                                  short_name=region_match[2],
-                                                  ascii_names = Normalize.normalize("%s %s" % (long_name, short_name)))
-                    region.put()
-                    stop.region = region
+                region_match = BalsaStopFactory.region_resolver.resolve(v)
+                if region_match:
+                    short_name, long_name = region_match
+                    stop.region = BalsaAdminCache.key(Region, short_name,
+                                                      name=long_name,
+                                                      short_name=short_name,
+                                                      ascii_names = Normalize.normalize("%s %s" % (long_name, short_name)))
+                    gov['region'] = short_name
                 else:
                     logging.warning("Unknown region, state or Bundesland: %s" % v)
-            if k.startswith('is_in:city') or k.startswith('is_in:municipality'):
-                comuna = Comuna.get_or_insert(v, name=v, ascii_names=Normalize.normalize(v))
-                stop.comuna = comuna
+            if (k.startswith('is_in:city') or k.startswith('is_in:municipality')) and v:
+                stop.comuna = BalsaAdminCache.key(Comuna, v, name=v, ascii_names=Normalize.normalize(v))
+                gov['comuna'] = v
         stop.ascii_names = []
         for name in stop.names:
             if name != "<no name>":
                 stop.ascii_names.extend(Normalize.normalize(name))
+        stop.label = format_label(stop.names, **gov)
+        stop.fingerprint = self.fingerprint(node, kind)
+        stop.osm_timestamp = node.timestamp
         return stop
 
 
@@ -129,14 +207,44 @@ class BalsaStopWriter(object):
     """Holds Stops which are imported for the first time
 
     Takes care of batch wise write operations of stop data
-    to the database.
+    to the database. Batches are written asynchronously, so that parsing
+    goes on while up to WRITE_MAX_IN_FLIGHT batches are on their way. The
+    batch size follows the measured entity size, up to the limits of a
+    datastore call.
     """
     @classmethod
-    def init(cls):
+    def init(cls, timestamp=None, metrics=None, retry=False):
+        """Initialize writer, timestamp is the state saved by a previous task
+
+        Writes are accounted in metrics, an ImportMetrics record, if given.
+        retry tells that a failed attempt may have stored some of the stops
+        up to the next store() already, those are not counted again.
+        """
+        cls._metrics = metrics
         # store the list stop entities to be written to the datastore
         # in a batch operation
         cls._stop_data = []
-        cls._timestamp = datetime.datetime(2001,1,1)
+        # batches being written: (rpc, stops, bytes, keys stored before)
+        cls._in_flight = []
+        cls._retry = retry
+        cls._batch_size = settings.BATCH_SIZE
+        # average size of an entity in bytes, measured on the first one of a batch
+        cls._entity_size = None
+        cls._timestamp = timestamp or datetime.datetime(2001,1,1)
+        # timestamp known to be in StopMeta already
+        cls._stored_timestamp = cls._timestamp
+        BalsaAdminCache.init()
+
+    @classmethod
+    def timestamp(cls):
+        """Returns the newest timestamp of all stops added"""
+        return cls._timestamp
+
+    @classmethod
+    def advance(cls, timestamp):
+        """Advance the timestamp of the data without adding a stop"""
+        if timestamp and timestamp > cls._timestamp:
+            cls._timestamp = timestamp
 
     @classmethod
     def add(cls, stop, timestamp):
@@ -144,37 +252,99 @@ class BalsaStopWriter(object):
             cls._timestamp = timestamp
         cls._stop_data.append(stop)
         # write a batch if a certain quantity has accumulated
-        if len(cls._stop_data) % settings.BATCH_SIZE == 0:
-            cls.store()
+        if len(cls._stop_data) >= cls._batch_size:
+            cls.send()
+
+    @classmethod
+    def send(cls):
+        """Start writing the accumulated stops, waits only if too many
+        batches are in flight already"""
+        if not cls._stop_data:
+            return
+        stops, cls._stop_data = cls._stop_data, []
+        entity_size = len(db.model_to_protobuf(stops[0]).Encode())
+        if cls._entity_size:
+            cls._entity_size = (3 * cls._entity_size + entity_size) / 4
+        else:
+            cls._entity_size = entity_size
+        cls._batch_size = max(min(settings.WRITE_MAX_BATCH_SIZE,
+                                  settings.WRITE_MAX_BATCH_BYTES / cls._entity_size), 1)
+        # administrative entities referenced by the stops have to exist first
+        BalsaAdminCache.flush()
+        existing = set()
+        if cls._retry:
+            existing = set([stop.key() for stop in db.get([stop.key() for stop in stops]) if stop])
+        cls._in_flight.append((db.put_async(stops), stops, entity_size * len(stops), existing))
+        while len(cls._in_flight) > settings.WRITE_MAX_IN_FLIGHT:
+            cls._complete(cls._in_flight.pop(0))
+
+    @classmethod
+    def _complete(cls, batch):
+        """Wait for a batch to be written
+
+        Only the time spent waiting is measured: the put may have finished
+        long before, while the following batches were parsed.
+        """
+        rpc, stops, size, existing = batch
+        start = time.time()
+        rpc.get_result()
+        wait = time.time() - start
+        logging.debug("Wrote %d stops (%d kB), waited %.3f s, batch size %d" % (len(stops), size/1024, wait, cls._batch_size))
+        if cls._metrics:
+            cls._metrics.add_write(len(stops), wait)
+        # cached labels of production stops are outdated now, their
+        # fingerprints are known for the next update
+        production = [stop for stop in stops if stop.kind() == 'Stop']
+        StopLabel.invalidate([stop.key() for stop in production])
+        StopFingerprint.set_multi(dict([(stop.key().id(), stop.fingerprint) for stop in production]))
+        # counted as soon as the batch is written, a retry only counts the
+        # stops a failed attempt has not stored
+        StopCounter.add(cls.counter_deltas([stop for stop in stops if not stop.key() in existing]))
 
     @classmethod
     def store(cls):
-        """Store datasets accumulated in internal list"""
-        db.put(cls._stop_data)
-        db.run_in_transaction(cls.update_counter)
-        cls._stop_data = []
+        """Store datasets accumulated in internal list and wait for all writes"""
+        cls.send()
+        while cls._in_flight:
+            cls._complete(cls._in_flight.pop(0))
+        # the stops of a failed attempt are all overwritten now
+        cls._retry = False
+        if cls._timestamp > cls._stored_timestamp:
+            db.run_in_transaction(cls.update_last_update)
+            cls._stored_timestamp = cls._timestamp
+
+    @staticmethod
+    def counter_deltas(stops):
+        """Returns the number of stops per (stop_type, confirm)"""
+        confirms = {'Stop': "NO", 'StopUpdate': "UPDATE", 'StopNew': "NEW", 'StopDelete': "DELETE"}
+        deltas = {}
+        for stop in stops:
+            # all stop classes are derived from Stop, compare the kind
+            assert stop.kind() in confirms, "Unknown stop instance: %s" % (stop)
+            key = (stop.stop_type, confirms[stop.kind()])
+            deltas[key] = deltas.get(key, 0) + 1
+        return deltas
 
     @classmethod
-    def update_counter(cls):
-        """Update meta counter fields in transaction"""
-        counter = StopMeta.get(Key.from_path('StopMeta', 1))
-        for stop in cls._stop_data:
-            if isinstance(stop, Stop):
-                counter.counter_delta(1, stop.stop_type, "NO")
-            elif isinstance(stop, StopUpdate):
-                counter.counter_delta(1, stop.stop_type, "UPDATE")
-            elif isinstance(stop, StopNew):
-                counter.counter_delta(1, stop.stop_type, "NEW")
-            else:
-                assert False, "Unknown stop instance: %s" % (stop)
-            if cls._timestamp > counter.last_update:
-                counter.last_update = cls._timestamp
-            counter.put()
+    def update_last_update(cls):
+        """Advance last update timestamp in transaction"""
+        meta = StopMeta.get(Key.from_path('StopMeta', 1))
+        if cls._timestamp > meta.last_update:
+            meta.last_update = cls._timestamp
+            meta.put()
 
 class BalsaStopStoreTask(webapp.RequestHandler):
     """Background tasks parses osm data and stores stops, stations and places
     in the datastore.
     """
+
+    # nodes of an update waiting for the comparison with existing stops
+    _update_nodes = []
+    # osm ids of deleted nodes of a change file waiting for the same
+    _delete_ids = []
+    # last action of a change file per osm id, (node, kind) or None for a deletion
+    _changes = {}
+
     @staticmethod
     def import_node_cb(node, kind):
         # we don't consider stops for the moment
@@ -192,25 +362,127 @@ class BalsaStopStoreTask(webapp.RequestHandler):
 
         Different to import_node_cb (above) look for existing nodes with the
         same data and discard identical ones. Queue changed nodes and new nodes
-        for confirmation.
+        for confirmation. The nodes are buffered to look up the existing stops
+        batch wise, see compare_nodes.
+        """
+        BalsaStopStoreTask._update_nodes.append((node, kind))
+        if len(BalsaStopStoreTask._update_nodes) >= settings.BATCH_SIZE:
+            BalsaStopStoreTask.compare_nodes()
+
+    @staticmethod
+    def compare_nodes():
+        """Compare buffered nodes with the existing stops of the same osm_id
+
+        Nodes are compared by fingerprint. Stops are only read from the
+        datastore if their fingerprint is not in the cache.
         """
-        # look for existing node with the same osm_id
-        old_stop = Stop.get_by_key_id(node.osm_id)
-        if old_stop:
-            # create stop entity from node data
-            stop = BalsaStopStoreTask.create_update_stop(node, kind)
-            logging.debug("compare %s <==> %s" % (old_stop,stop))
-            if old_stop == stop:
-                # no change
-                return
+        nodes = BalsaStopStoreTask._update_nodes
+        BalsaStopStoreTask._update_nodes = []
+        if not nodes:
+            return
+        fingerprints = StopFingerprint.get_multi([node.osm_id for node,kind in nodes])
+        unknown = [node.osm_id for node,kind in nodes if not node.osm_id in fingerprints]
+        old_stops = {}
+        if unknown:
+            for osm_id, old_stop in zip(unknown, db.get([Key.from_path('Stop', osm_id) for osm_id in unknown])):
+                if old_stop:
+                    old_stops[osm_id] = old_stop
+            StopFingerprint.set_multi(dict([(osm_id, stop.fingerprint) for osm_id,stop in old_stops.items()
+                                            if stop.fingerprint is not None]))
+        # nodes of production stops merged away as duplicates stay away
+        new_ids = [osm_id for osm_id in unknown if not osm_id in old_stops]
+        merged = set()
+        if new_ids:
+            merged = set([stop.key().id() for stop in
+                          db.get([Key.from_path('MergedStop', osm_id) for osm_id in new_ids]) if stop])
+        for node, kind in nodes:
+            if node.osm_id in fingerprints:
+                if fingerprints[node.osm_id] == BalsaStopFactory.fingerprint(node, kind):
+                    # no change
+                    continue
+                stop = BalsaStopFactory.create_update_stop(node, kind)
+            elif node.osm_id in old_stops:
+                # create stop entity from node data
+                stop = BalsaStopFactory.create_update_stop(node, kind)
+                old_stop = old_stops[node.osm_id]
+                if old_stop.fingerprint is not None:
+                    unchanged = old_stop.fingerprint == stop.fingerprint
+                else:
+                    # stored before stops had a fingerprint
+                    unchanged = old_stop == stop
+                if unchanged:
+                    continue
+            elif node.osm_id in merged:
+                continue
             else:
-                # accumulate some greater number for efficient batch write to datastore
-                BalsaStopWriter.add(stop, node.timestamp)
-        else:
-            # create stop entity from node data
-            stop = BalsaStopStoreTask.create_new_stop(node, kind)
+                # create stop entity from node data
+                stop = BalsaStopFactory.create_new_stop(node, kind)
+            # accumulate some greater number for efficient batch write to datastore
             BalsaStopWriter.add(stop, node.timestamp)
-        return
+
+    @staticmethod
+    def change_node_cb(node, kind):
+        """Callback function for created and modified nodes of a change file"""
+        BalsaStopStoreTask._changes[node.osm_id] = (node, kind)
+
+    @staticmethod
+    def change_delete_cb(osm_id):
+        """Callback function for deleted nodes of a change file"""
+        BalsaStopStoreTask._changes[osm_id] = None
+
+    @staticmethod
+    def delete_node_cb(osm_id):
+        """Callback function for nodes deleted in a change file
+
+        Queues the deletion of the production stop for confirmation, if
+        there is one.
+        """
+        BalsaStopStoreTask._delete_ids.append(osm_id)
+        if len(BalsaStopStoreTask._delete_ids) >= settings.BATCH_SIZE:
+            BalsaStopStoreTask.compare_deletions()
+
+    @staticmethod
+    def compare_deletions():
+        """Look up the production stops of buffered deleted nodes"""
+        osm_ids = BalsaStopStoreTask._delete_ids
+        BalsaStopStoreTask._delete_ids = []
+        if not osm_ids:
+            return
+        for old_stop in db.get([Key.from_path('Stop', osm_id) for osm_id in osm_ids]):
+            if old_stop:
+                BalsaStopWriter.add(BalsaStopFactory.create_delete_stop(old_stop), BalsaStopWriter.timestamp())
+
+    @staticmethod
+    def apply_change(data):
+        """Parse osmChange data and queue its changes for confirmation
+
+        Change files are small, they are parsed in one go. A node may
+        change several times within a file, only its last action is
+        compared with the existing stops. Returns the parser.
+        """
+        BalsaStopStoreTask._changes = {}
+        handler = osmparse.OSMChangeHandler(data, (osmparse.StopAttr, BalsaStopStoreTask.change_node_cb),
+                                            BalsaStopStoreTask.change_delete_cb)
+        changes, BalsaStopStoreTask._changes = BalsaStopStoreTask._changes, {}
+        for osm_id, change in changes.items():
+            if change:
+                BalsaStopStoreTask.update_node_cb(*change)
+            else:
+                BalsaStopStoreTask.delete_node_cb(osm_id)
+        BalsaStopStoreTask.compare_nodes()
+        BalsaStopStoreTask.compare_deletions()
+        # the data is as recent as the newest change
+        BalsaStopWriter.advance(handler.timestamp)
+        BalsaStopWriter.store()
+        return handler
+
+    @staticmethod
+    def mark_storing(checkpoint):
+        """Note in the checkpoint that the stops of the next slice are
+        being stored, so that a retry does not count them twice"""
+        if not checkpoint.storing:
+            checkpoint.storing = True
+            checkpoint.put()
 
     def post(self):
         # import or upload?
@@ -223,42 +495,160 @@ class BalsaStopStoreTask(webapp.RequestHandler):
             memcache.set('%s_status' % action, "%s failed. Could not access data." % action.title(), time=30)
             return
 
-        logging.info("Retrieved %d bytes for processing." % (blob_info.size))
-
-        memcache.set('%s_status' % action, "Parsing %s data." % action, time=100)
+        # continue where the last task (or a failed attempt of this one) stopped
+        checkpoint = ImportCheckpoint.get_or_insert(str(blob_info.key()), action=action)
+        logging.info("Retrieved %d bytes for processing, continue at offset %d." % (blob_info.size, checkpoint.offset))
 
         blob_reader = blobstore.BlobReader(blob_info)
-        char2 = blob_reader.read(2)
-        blob_reader.seek(0)
-        if char2 == "PK":
-            logging.info("Detected zip file.")
-            zip_reader = zipfile.ZipFile(blob_reader, 'rU')
-            # we expect exactly one zipfile for reading
-            file_reader = zip_reader.read(zip_reader.namelist()[0])
-        else:
-            file_reader = blob_reader
-
-        # initialize the writer class for stop objects
-        BalsaStopWriter.init()
-
-        # parse blob and call node_cb on discovery of a Place, Stop or Station
+        change = None
+        slicer = None
         try:
-            if action == 'import':
-                osmparse.OSMContentHandler(file_reader, (osmparse.StopAttr, BalsaStopStoreTask.import_node_cb))
+            if osmpbf.is_pbf(blob_reader):
+                logging.info("Detected PBF file.")
+                slicer = osmpbf.PBFSlicer(blob_reader, checkpoint.offset)
+                parser = osmpbf.OSMPBFHandler
             else:
-                osmparse.OSMContentHandler(file_reader, (osmparse.StopAttr, BalsaStopStoreTask.update_node_cb))
+                osm_reader = osmparse.open_osm(blob_reader)
+                head = osm_reader.read(1024)
+                if osmparse.is_change(head):
+                    logging.info("Detected osmChange file.")
+                    change = head + osm_reader.read()
+                else:
+                    if osm_reader is blob_reader:
+                        blob_reader.seek(0)
+                    else:
+                        # zip, gzip and bz2 data is inflated once, so that
+                        # the chained tasks can seek to their offset
+                        if not checkpoint.inflated:
+                            checkpoint.inflated = BalsaStopStoreTask.inflate(head, osm_reader)
+                            checkpoint.put()
+                        osm_reader = blobstore.BlobReader(checkpoint.inflated)
+                    slicer = osmparse.OSMSlicer(osm_reader, checkpoint.offset)
+                    parser = osmparse.BACKENDS[settings.OSM_PARSER]
+        except (SyntaxError, zipfile.BadZipfile):
+            logging.error("Could not decompress uploaded file.")
+            memcache.set('%s_status' % action, "%s failed. Could not decompress data." % action.title(), time=30)
+            BalsaStopStoreTask.drop(checkpoint, blob_info)
+            return
 
-            # store fields and counters together in transaction
-            BalsaStopWriter.store
-            memcache.set('%s_status' % action, "%s finished successfully." % action.title(), time=30)
+        if change is not None and action != 'update':
+            logging.error("Change file uploaded for %s." % (action))
+            memcache.set('%s_status' % action, "%s failed. Change files can only be used for updates." % action.title(), time=30)
+            BalsaStopStoreTask.drop(checkpoint, blob_info)
+            return
+
+        # the record is started by the upload, but may have been evicted
+        metrics = ImportMetrics.load(action) or ImportMetrics.start(action, blob_info.size)
+
+        # initialize the writer class for stop objects
+        BalsaStopWriter.init(checkpoint.timestamp, metrics, checkpoint.storing)
 
+        BalsaStopStoreTask._update_nodes = []
+        BalsaStopStoreTask._delete_ids = []
+        if action == 'import':
+            store_cb = BalsaStopStoreTask.import_node_cb
+        else:
+            store_cb = BalsaStopStoreTask.update_node_cb
+        def node_cb(node, kind):
+            metrics.add_match(kind)
+            store_cb(node, kind)
+
+        # parse blob slice by slice and call node_cb on discovery of a Place, Stop or Station
+        deadline = time.time() + settings.TASK_TIME_BUDGET
+        try:
+            if change is not None:
+                BalsaStopStoreTask.mark_storing(checkpoint)
+                start = time.time()
+                handler = BalsaStopStoreTask.apply_change(change)
+                metrics.add_slice(blob_info.size, handler._counter, time.time() - start)
+            while slicer and time.time() < deadline:
+                start = time.time()
+                data = slicer.next_slice(settings.SLICE_SIZE)
+                if data is None:
+                    break
+                BalsaStopStoreTask.mark_storing(checkpoint)
+                handler = parser(data, (osmparse.StopAttr, node_cb))
+                # the checkpoint must not be ahead of buffered nodes
+                BalsaStopStoreTask.compare_nodes()
+                # wait for all stops of the slice to be stored and counted
+                BalsaStopWriter.store()
+                checkpoint.offset = slicer.offset
+                checkpoint.storing = False
+                checkpoint.slices += 1
+                checkpoint.timestamp = BalsaStopWriter.timestamp()
+                checkpoint.put()
+                metrics.add_slice(blob_reader.tell(), handler._counter, time.time() - start)
+                metrics.save()
+                memcache.set('%s_status' % action, "Parsing %s data (%d MB done)." % (action, slicer.offset/(1024*1024)), time=100)
         except SyntaxError:
             logging.error("Could not parse uploaded file.")
             memcache.set('%s_status' % action, "%s failed. Could not parse data." % action.title(), time=30)
+            BalsaStopStoreTask.drop(checkpoint, blob_info)
+            return
+
+        if slicer and not slicer.eof:
+            # out of time, chain a task which continues at the checkpoint
+            BalsaStopStoreTask.queue_task(action, blob_info.key(), checkpoint.offset)
+            return
+
+        # production data has changed, lookups need a fresh index
+        StopIndex.schedule_rebuild()
+        metrics.finish()
+        if action == 'update':
+            # score the pending updates and look for the neighbours of
+            # new stops ahead of review, see balsa_update
+            taskqueue.add(url='/update/triage', queue_name='import')
+            taskqueue.add(url='/update/neighbours', queue_name='import')
+        memcache.set('%s_status' % action, "%s finished successfully." % action.title(), time=30)
+        logging.info("%s finished after %d slices." % (action.title(), checkpoint.slices))
 
         # free space in blobstore
+        BalsaStopStoreTask.drop(checkpoint, blob_info)
+
+    @staticmethod
+    def inflate(head, osm_reader):
+        """Write the uncompressed osm data to a new blob, returns its key
+
+        head has been read from osm_reader already. Decompressing runs
+        once per upload instead of once per chained task.
+        """
+        logging.info("Inflating compressed upload.")
+        name = files.blobstore.create(mime_type='application/xml')
+        fp = files.open(name, 'a')
+        try:
+            data = head
+            while data:
+                fp.write(data)
+                # below the request size limit of the files api
+                data = osm_reader.read(512*1024)
+        finally:
+            fp.close()
+        files.finalize(name)
+        return str(files.blobstore.get_blob_key(name))
+
+    @staticmethod
+    def drop(checkpoint, blob_info):
+        """Delete the checkpoint, the upload and its inflated copy"""
+        if checkpoint.inflated:
+            blobstore.delete(checkpoint.inflated)
+        checkpoint.delete()
         blob_info.delete()
 
+    @staticmethod
+    def queue_task(action, blob_key, offset=0):
+        """Queue parsing of the uploaded blob starting at offset
+
+        The task name makes sure that a slice is not queued twice.
+        """
+        name = "%s-%s-%d" % (action, re.sub(r"[^a-zA-Z0-9_-]", "_", str(blob_key)), offset)
+        try:
+            taskqueue.add(url='/%s/store' % action, queue_name='import', name=name[-500:],
+                          params={'action': action,
+                                  'osmdata': blob_key,
+                                  'offset': offset})
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.warning("Task %s has been queued before." % (name))
+
 class BalsaStopUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
     """Is called when an osm data file has been uploaded to the blobstore"""
 
@@ -278,16 +668,15 @@ class BalsaStopUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
             memcache.set('%s_status' % action, "%s failed. Nothing found in blobstore." % action.title(), time=30)
             logging.warning("Could not find uploaded data in blobstore.")
             self.redirect('/update')
+            return
+
+        ImportMetrics.start(action, blob_info.size)
 
-        # delete memory for confirmation walkthrough (see balsa_update)
-        memcache.delete('update')
-        memcache.delete('new')
+        # outdate the confirmation walkthroughs (see balsa_update)
+        ReviewCache.invalidate_all()
 
         # start background process
-        taskqueue.add(url='/%s/store' % action, queue_name='import',
-                      params={'compressed': self.request.get('compressed', ""),
-                              'action': action,
-                              'osmdata': blob_info.key()})
+        BalsaStopStoreTask.queue_task(action, blob_info.key())
 
         # redirect to update page which will show the current state of the data storage
         self.redirect('/update')
@@ -6,10 +6,15 @@
 import settings
 import logging
 import os
+import time
+import urllib
 import zipfile
-import difflib
+import zlib
+import cPickle as pickle
 import geo.geomath
 import geo.geomodel
+import nearest
+import dedup
 from django.utils import simplejson as json
 from google.appengine.ext import db
 from google.appengine.api import users
@@ -21,9 +26,13 @@ from google.appengine.api import taskqueue
 from google.appengine.api import memcache
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
-from balsa_dbm import Stop, StopMeta, Country, Region, Comuna
+from balsa_dbm import Stop, StopUpdate, StopNew, StopDelete, StopMeta, Country, Region, Comuna, DuplicateCluster, NeighbourCandidates, NeighbourCandidatesPage
 from balsa_access import AdminRequired
 from balsa_stops import BalsaStopStoreTask, BalsaStopUploadHandler
+from balsa_index import StopIndex, StopLabel, ReviewCache
+from balsa_counter import StopCounter
+from balsa_metrics import ImportMetrics
+from balsa_confirm import BalsaConfirm, ConfirmRule, PENDING
 
 class BalsaUpdate(webapp.RequestHandler):
     """Display the update page with statistics abput the current data"""
@@ -34,25 +43,19 @@ class BalsaUpdate(webapp.RequestHandler):
         # is import or update going on?
         template_values['update_status'] = memcache.get('update_status')
         template_values['import_status'] = memcache.get('import_status')
+        template_values['metrics'] = [metrics.as_dict() for metrics in
+                                      [ImportMetrics.load('import'), ImportMetrics.load('update')] if metrics]
 
         # Check for existing data.
-        try:
-            counter = StopMeta.get(Key.from_path('StopMeta', 1))
-            template_values['production_num_stops'] = counter.counter_stop_no_confirm
-            template_values['production_num_stations'] = counter.counter_station_no_confirm
-            template_values['production_num_places'] = counter.counter_place_no_confirm
-            # confirmation outstanding
-            template_values['update_num_stops'] = counter.counter_stop_update_confirm
-            template_values['update_num_stations'] = counter.counter_station_update_confirm
-            template_values['update_num_places'] = counter.counter_place_update_confirm
-            template_values['new_num_stops'] = counter.counter_stop_new_confirm
-            template_values['new_num_stations'] = counter.counter_station_new_confirm
-            template_values['new_num_places'] = counter.counter_place_new_confirm
-            # Administrative hierarchy
-            template_values['gov_num'] = Comuna.all().count()+Region.all().count()+Country.all().count()
-        except AttributeError:
+        if not StopMeta.get(Key.from_path('StopMeta', 1)):
             # no data in database. Redirect to import page
             self.redirect('/import')
+            return
+        # production data and confirmation outstanding
+        for confirm in settings.CONFIRM_TYPES:
+            StopCounter.template_values(template_values, confirm)
+        # Administrative hierarchy
+        template_values['gov_num'] = Comuna.all().count()+Region.all().count()+Country.all().count()
 
         template_values['upload_url'] = blobstore.create_upload_url('/update/upload')
         path = os.path.join(os.path.dirname(__file__), "pages/update.html")
@@ -60,81 +63,315 @@ class BalsaUpdate(webapp.RequestHandler):
         return
 
 
+class BalsaMetrics(webapp.RequestHandler):
+    """Progress figures of the last import and update as json"""
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        res = {}
+        for action in ['import', 'update']:
+            metrics = ImportMetrics.load(action)
+            if metrics:
+                res[action] = metrics.as_dict()
+        self.response.headers['Content-Type'] = "application/json"
+        self.response.out.write(json.dumps(res))
+
+
+def review_candidate(user, flow, model_class, prepare, skip=False, order=None):
+    """Returns the candidate of a confirm walkthrough to show, None if done
+
+    Candidates are read with a cursor, REVIEW_PREFETCH at a time, and
+    prepared for the template by prepare(entities) in one go. The prepared
+    candidates are held in the review cache of the admin, so that every
+    click is answered from memcache. skip drops the current candidate,
+    order is the sort order of the candidates.
+    """
+    review = ReviewCache.get(user, flow)
+    if skip and review['items']:
+        review['items'].pop(0)
+    # batches of which no candidate could be prepared are passed over
+    while not review['items']:
+        query = model_class.all()
+        if order:
+            query.order(order)
+        if review['cursor']:
+            query.with_cursor(review['cursor'])
+        entities = query.fetch(settings.REVIEW_PREFETCH)
+        if not entities:
+            # walked through all, the next walkthrough starts over
+            ReviewCache.delete(user, flow)
+            return None
+        review['cursor'] = query.cursor()
+        review['items'] = prepare(entities)
+    ReviewCache.set(user, flow, review)
+    return review['items'][0]
+
+
+class BalsaTriageTask(webapp.RequestHandler):
+    """Background task which scores all pending updates after an update
+
+    Trivial changes are accepted right away, the others get their change
+    score, which orders the confirm walkthrough.
+    """
+
+    def post(self):
+        accepted = int(self.request.get("accepted", "0"))
+        cursor = self.request.get("cursor") or None
+        deadline = time.time() + settings.TASK_TIME_BUDGET
+        while time.time() < deadline:
+            query = StopUpdate.all()
+            if cursor:
+                query.with_cursor(cursor)
+            updates = query.fetch(settings.REVIEW_BATCH_SIZE)
+            if not updates:
+                cursor = None
+                break
+            cursor = query.cursor()
+            accepted += BalsaConfirm.triage(updates)
+
+        if cursor:
+            # out of time, continue behind the last batch
+            taskqueue.add(url='/update/triage', queue_name='import',
+                          params={'cursor': cursor, 'accepted': accepted})
+            memcache.set('update_status', "Triage of updates (%d accepted so far)." % (accepted), time=100)
+            return
+        logging.info("Triage accepted %d trivial updates." % (accepted))
+        memcache.set('update_status', "Update finished, %d trivial changes accepted." % (accepted), time=600)
+
+
+class BalsaIndexTask(webapp.RequestHandler):
+    """Background task which builds the stop lookup index, queued by
+    StopIndex.schedule_rebuild whenever the production data changes
+    """
+
+    def post(self):
+        StopIndex.build()
+
+
+def duplicate_finder(candidates):
+    """Returns dedup.DuplicateFinder for (lat, lon, osm id, names) of
+    production stops"""
+    return dedup.DuplicateFinder(candidates, settings.DEDUP_RESOLUTION, settings.DEDUP_MAX_DISTANCE,
+                                 settings.DEDUP_MIN_SCORE, settings.DEDUP_NAME_WEIGHT)
+
+
+class BalsaNeighbourTask(webapp.RequestHandler):
+    """Background task which finds the production stops next to all new
+    stops and their probable duplicates after an update
+
+    Every region is handled by its own chain of tasks: the production
+    stops of the region are loaded once and searched for many new stops
+    at once, see nearest and dedup. New stops with duplicates get a
+    DuplicateCluster. The tasks of a chain are named by their step, so a
+    retried task cannot fork the chain.
+    """
+
+    # production stops of the region of the last task on this instance,
+    # see region_stops
+    _loaded = None
+
+    def post(self):
+        region = self.request.get("region", None)
+        if region is None:
+            # the name stays the same when the task is retried
+            chain = self.request.headers.get('X-AppEngine-TaskName') or "%d" % (time.time() * 1000)
+            BalsaNeighbourTask.queue_regions(chain)
+            return
+        chain = self.request.get("chain")
+        step = int(self.request.get("step", "0"))
+        cursor = self.request.get("cursor") or None
+        clusters_found = int(self.request.get("clusters", "0"))
+        deadline = time.time() + settings.TASK_TIME_BUDGET
+        loaded = BalsaNeighbourTask.region_stops(chain, region, deadline)
+        done = False
+        while loaded and time.time() < deadline:
+            candidates, finder = loaded
+            query = StopNew.all().filter('region =', BalsaNeighbourTask._region_key(region))
+            if cursor:
+                query.with_cursor(cursor)
+            news = query.fetch(settings.REVIEW_BATCH_SIZE)
+            if not news:
+                done = True
+                break
+            cursor = query.cursor()
+
+            clusters = []
+            # new stops without duplicates drop the cluster of an earlier update
+            outdated = []
+            points = [(new.location.lat, new.location.lon) for new in news]
+            found = nearest.nearest_neighbours(points, candidates,
+                                               settings.NEIGHBOUR_COUNT, settings.NEIGHBOUR_MAX_DISTANCE)
+            for new, neighbours in zip(news, found):
+                new.neighbour_ids = [long(osm_id) for distance,osm_id in neighbours]
+                new.neighbour_distances = [float(distance) for distance,osm_id in neighbours]
+                new.neighbours_done = True
+                duplicates = finder.find(new.location.lat, new.location.lon, new.names)
+                cluster = DuplicateCluster(key=Key.from_path('DuplicateCluster', new.key().id()))
+                cluster.duplicate_ids = [long(osm_id) for score,distance,osm_id,same in duplicates]
+                cluster.scores = [float(score) for score,distance,osm_id,same in duplicates]
+                cluster.distances = [float(distance) for score,distance,osm_id,same in duplicates]
+                cluster.exact = not [same for score,distance,osm_id,same in duplicates if not same]
+                if duplicates:
+                    cluster.score = max(cluster.scores)
+                    clusters.append(cluster)
+                else:
+                    outdated.append(cluster.key())
+            db.put(news + clusters)
+            db.delete(outdated)
+            clusters_found += len(clusters)
+
+        if not done:
+            # out of time, continue behind the last batch
+            BalsaNeighbourTask.queue_task(chain, region, step + 1,
+                                          {'cursor': cursor or "", 'clusters': clusters_found})
+            return
+        BalsaNeighbourTask.drop_region_stops(chain, region)
+        logging.info("Found %d new stops with duplicates in region %s." % (clusters_found, region and Key(region).name() or "none"))
+
+    @staticmethod
+    def queue_task(chain, region, step, params={}):
+        """Queue step of the chain of region, region is the string of its
+        key or empty for the new stops without a region"""
+        params = dict(params, region=region, chain=chain, step=step)
+        try:
+            taskqueue.add(name="neighbours-%s-%s-%d" % (chain, region or "none", step),
+                          url='/update/neighbours', queue_name='import', params=params)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # queued by an earlier attempt of this task
+            pass
+
+    @staticmethod
+    def queue_regions(chain):
+        """Start a chain of tasks for every region and one for the stops
+        without a region"""
+        for region in [str(key) for key in Region.all(keys_only=True)] + [""]:
+            BalsaNeighbourTask.queue_task(chain, region, 0)
+
+    @staticmethod
+    def _region_key(region):
+        if not region:
+            # new stops without a region
+            return None
+        return Key(region)
+
+    @staticmethod
+    def _name(chain, region):
+        return "%s-%s" % (chain, region or "none")
+
+    @classmethod
+    def region_stops(cls, chain, region, deadline):
+        """Returns (candidates, finder) over the production stops in region,
+        None if the time ran out while loading them
+
+        candidates is a list of (lat, lon, osm id), finder a
+        dedup.DuplicateFinder. The stops are loaded page by page and kept
+        in NeighbourCandidates, so the following task of the chain goes
+        on where this one stopped. The stops loaded so far are also kept
+        on the instance, which saves reading them again.
+        """
+        name = cls._name(chain, region)
+        if not cls._loaded or cls._loaded['name'] != name:
+            cls._loaded = {'name': name, 'pages': 0, 'stops': [], 'result': None}
+        loaded = cls._loaded
+        if loaded['result']:
+            return loaded['result']
+        progress = NeighbourCandidates.get_or_insert(name)
+        if progress.pages > loaded['pages']:
+            # pages loaded by tasks on other instances
+            keys = [Key.from_path('NeighbourCandidatesPage', "%s-%d" % (name, i))
+                    for i in xrange(loaded['pages'], progress.pages)]
+            for page in db.get(keys):
+                loaded['stops'].extend(pickle.loads(zlib.decompress(page.data)))
+            loaded['pages'] = progress.pages
+        query = Stop.all().filter('region =', BalsaNeighbourTask._region_key(region))
+        while not progress.done:
+            if time.time() > deadline:
+                return None
+            if progress.cursor:
+                query.with_cursor(progress.cursor)
+            entities = query.fetch(settings.PURGE_BATCH_SIZE)
+            stops = [(stop.location.lat, stop.location.lon, stop.key().id(), stop.names) for stop in entities]
+            # a page written by a failed attempt is simply written again
+            NeighbourCandidatesPage(key_name="%s-%d" % (name, progress.pages),
+                                    data=db.Blob(zlib.compress(pickle.dumps(stops, pickle.HIGHEST_PROTOCOL)))).put()
+            progress.pages += 1
+            progress.cursor = query.cursor()
+            progress.done = len(entities) < settings.PURGE_BATCH_SIZE
+            progress.put()
+            loaded['stops'].extend(stops)
+            loaded['pages'] = progress.pages
+        stops = loaded['stops']
+        loaded['result'] = ([(lat, lon, osm_id) for lat, lon, osm_id, names in stops],
+                            duplicate_finder(stops))
+        return loaded['result']
+
+    @classmethod
+    def drop_region_stops(cls, chain, region):
+        """Delete the stops kept for the chain of region"""
+        name = cls._name(chain, region)
+        progress = NeighbourCandidates.get_by_key_name(name)
+        if progress:
+            db.delete([Key.from_path('NeighbourCandidatesPage', "%s-%d" % (name, i)) for i in xrange(progress.pages)] +
+                      [progress.key()])
+        cls._loaded = None
+
+
 class BalsaConfirmUpdate(webapp.RequestHandler):
     """Confirm data for update"""
 
+    @staticmethod
+    def prepare(updates):
+        """Returns the comparisons of updates with their production data
+
+        Updates of production stops deleted since the triage become new
+        stops like in the triage and are not shown here.
+        """
+        productions = db.get([Key.from_path('Stop', update.key().id()) for update in updates])
+        res = []
+        orphans = []
+        for update, production in zip(updates, productions):
+            if not production:
+                orphans.append(update)
+                continue
+            compare={}
+            compare['key'] = str(update.key())
+            compare['score'] = update.change_score
+            compare['data'] = []
+            for description, production_value, update_value in [
+                ('Stop type', production.stop_type, update.stop_type),
+                ('Location (lat)', production.location.lat, update.location.lat),
+                ('Location (lon)', production.location.lon, update.location.lon),
+                ('Name(s)', ", ".join(production.names), ", ".join(update.names)),
+                ('Location zoom', StopLabel.from_stop(production), StopLabel.from_stop(update))]:
+                data = {}
+                data['type'] = description
+                data['production'] = production_value
+                data['update'] = update_value
+                if production_value != update_value:
+                    data['style'] = "balsa-watch"
+                compare['data'].append(data)
+            res.append(compare)
+        BalsaConfirm.renew(orphans)
+        return res
+
     @AdminRequired
     def get(self, login_user=None, template_values={}):
-        pass
-
-        # hold update query in memcache
-        q_update = memcache.get('update')
-        if not q_update:
-            q_update = Stop.all().filter('confirm =', 'UPDATE')
-            memcache.set('update', q_update)
-
-        offset = int(self.request.get("offset", "0"))
-        update = q_update.fetch(limit=1, offset=offset)
-        template_values['offset'] = offset+1
-        if not update:
+        # riskiest changes first, see BalsaTriageTask
+        compare = review_candidate(login_user.email(), 'update', StopUpdate, BalsaConfirmUpdate.prepare,
+                                   self.request.get("next") == "1", '-change_score')
+        if not compare:
             # nothing to do
             self.redirect('/update')
             return
-        update = update[0]
-
-        # get corresponding production data
-        production = Stop.all().filter('osm_id =', update.osm_id).filter('confirm =', 'NO').get()
-        assert production, "Failed to fetch prodcution data for update osm_id=%d" % (update.osm_id)
-
-        compare={}
-        compare['key'] = str(update.key())
-        compare['data'] = []
-        data = {}
-        data['type'] = 'Stop type'
-        data['production'] = production.stop_type
-        data['update'] = update.stop_type
-        if production.stop_type != update.stop_type:
-            data['style'] = "balsa-watch"
-        compare['data'].append(data)
-        data = {}
-        data['type'] = 'Location (lat)'
-        data['production'] = production.location.lat
-        data['update'] = update.location.lat
-        if production.location.lat != update.location.lat:
-            data['style'] = "balsa-watch"
-        compare['data'].append(data)
-        data = {}
-        data['type'] = 'Location (lon)'
-        data['production'] = production.location.lon
-        data['update'] = update.location.lon
-        if production.location.lon != update.location.lon:
-            data['style'] = "balsa-watch"
-        compare['data'].append(data)
-        data = {}
-        data['type'] = 'Name(s)'
-        data['production'] = ", ".join(production.names)
-        data['update'] = ", ".join(update.names)
-        if production.names != update.names:
-            data['style'] = "balsa-watch"
-        compare['data'].append(data)
-        data = {}
-        data['type'] = 'Location zoom'
-        data['production'] = ", ".join(production.gov.gov_names)
-        data['update'] = ", ".join(update.gov.gov_names)
-        if production.gov.gov_names != update.gov.gov_names:
-            data['style'] = "balsa-watch"
-        compare['data'].append(data)
         template_values['compare'] = compare
 
-        counter = StopMeta.all().get()
-        template_values['update_num_stops'] = counter.counter_stop_update_confirm
-        template_values['update_num_stations'] = counter.counter_station_update_confirm
-        template_values['update_num_places'] = counter.counter_place_update_confirm
+        StopCounter.template_values(template_values, "UPDATE")
 
         path = os.path.join(os.path.dirname(__file__), "pages/confirm_update.html")
         self.response.out.write(template.render(path, template_values))
         return
 
+
 class BalsaConfirmNewAccept(webapp.RequestHandler):
     """Accepted new data (or replaced data)
 
@@ -144,28 +381,15 @@ class BalsaConfirmNewAccept(webapp.RequestHandler):
     @AdminRequired
     def get(self, login_user=None, template_values={}):
 
-        obsolete = [key for key in self.request.get_all("obsolete_key", None)]
+        obsolete = [Key(key) for key in self.request.get_all("obsolete_key", None)]
         logging.debug(obsolete)
 
         key = self.request.get("accept", None)
         assert key, "Did not receive key"
 
-        new_stop = Stop.get(key)
-        new_stop.confirm = "NO"
-
-        counter = StopMeta.all().get()
-        def store():
-            for key in obsolete:
-                stop = Stop.all().ancestor(counter).filter("__key__ =", Key(key)).get()
-                counter.counter_delta(-1, stop.stop_type)
-            counter.counter_delta(1, stop.stop_type)
-            counter.counter_delta(-1, stop.stop_type, "NEW")
-            db.put(new_stop)
-            db.delete(obsolete)
-            counter.put()
-        db.run_in_transaction(store)
+        BalsaConfirm.accept([StopNew.get(key)], obsolete)
 
-        self.redirect('/update/confirm/new')
+        self.redirect('/update/confirm/new?next=1')
 
 
 class BalsaConfirmUpdateAccept(webapp.RequestHandler):
@@ -176,20 +400,9 @@ class BalsaConfirmUpdateAccept(webapp.RequestHandler):
         key = self.request.get("key", None)
         assert key, "Did not receive key"
 
-        counter = StopMeta().all().get()
-        def store():
-            stop = Stop.get(key)
-            stop.confirm = 'NO'
-            # remove updated data set
-            old_stop = Stop.all().ancestor(counter).filter("osm_id =", stop.osm_id).filter('confirm =', 'NO').get()
-            assert old_stop, "Did not find original data for update"
-            counter.counter_delta(-1, stop.stop_type, "UPDATE")
-            counter.put()
-            stop.put()
-            old_stop.delete()
-        db.run_in_transaction(store)
+        BalsaConfirm.accept([StopUpdate.get(key)])
 
-        self.redirect('/update/confirm/update')
+        self.redirect('/update/confirm/update?next=1')
 
 
 class BalsaConfirmUpdateReject(webapp.RequestHandler):
@@ -200,91 +413,328 @@ class BalsaConfirmUpdateReject(webapp.RequestHandler):
         key = self.request.get("key", None)
         assert key, "Did not receive key"
 
-        counter = StopMeta().all().get()
-        def store():
-            stop = Stop.get(key)
-            counter.counter_delta(-1, stop.stop_type, "UPDATE")
-            counter.put()
-            stop.delete()
-        db.run_in_transaction(store)
-
-        self.redirect('/update/confirm/update')
+        BalsaConfirm.reject([StopUpdate.get(key)])
 
+        self.redirect('/update/confirm/update?next=1')
 
 
 class BalsaConfirmNew(webapp.RequestHandler):
     """Confirm new data (or replaced data)"""
 
+    @staticmethod
+    def prepare(news):
+        """Returns the new stops together with the production stops nearby"""
+        # neighbours found ahead by BalsaNeighbourTask, all in one batch
+        # as well as the duplicates, see DuplicateCluster
+        keys = []
+        for new in news:
+            keys.extend([Key.from_path('Stop', osm_id) for osm_id in new.neighbour_ids])
+        neighbours = dict([(stop.key().id(), stop) for stop in db.get(keys) if stop])
+        clusters = DuplicateCluster.get([Key.from_path('DuplicateCluster', new.key().id()) for new in news])
+        res = []
+        for new, cluster in zip(news, clusters):
+            if new.neighbours_done:
+                proximity = [neighbours[osm_id] for osm_id in new.neighbour_ids if osm_id in neighbours]
+                duplicate_ids = set(cluster and cluster.duplicate_ids or [])
+            else:
+                # not searched yet, find datasets nearby
+                proximity = geo.geomodel.GeoModel.proximity_fetch(Stop.all(), new.location, max_results=6, max_distance=500)
+                finder = duplicate_finder([(pstop.location.lat, pstop.location.lon, pstop.key().id(), pstop.names)
+                                           for pstop in proximity])
+                duplicate_ids = set([osm_id for score,distance,osm_id,same in
+                                     finder.find(new.location.lat, new.location.lon, new.names)])
+
+            compare=[]
+            stop = {}
+            stop['description'] = 'New:'
+            stop['type'] = new.stop_type
+            stop['name'] = ", ".join(new.names)
+            stop['lat'] = new.location.lat
+            stop['lon'] = new.location.lon
+            stop['new'] = True
+            stop['key'] = str(new.key())
+            compare.append(stop)
+            for pstop in proximity:
+                stop = {}
+                # calculate distance to new point
+                dist = geo.geomath.distance(new.location,pstop.location)
+                if pstop.key().id() in duplicate_ids:
+                    stop['checked'] = "checked"
+                    stop['style'] = "balsa-watch"
+                stop['description'] = 'at %4.0f meters' % (dist)
+                stop['type'] = pstop.stop_type
+                stop['name'] = ", ".join(pstop.names)
+                stop['lat'] = pstop.location.lat
+                stop['lon'] = pstop.location.lon
+                stop['new'] = False
+                stop['key'] = str(pstop.key())
+                compare.append(stop)
+            res.append(compare)
+        return res
+
     @AdminRequired
     def get(self, login_user=None, template_values={}):
-
-        # hold update query in memcache
-        q_new = memcache.get('new')
-        if not q_new:
-            q_new = Stop.all().filter('confirm =', 'NEW')
-            memcache.set('new', q_new)
-
-        offset = int(self.request.get("offset", "0"))
-        new = q_new.fetch(limit=1, offset=offset)
-        template_values['offset'] = offset+1
-        if not new:
+        compare = review_candidate(login_user.email(), 'new', StopNew, BalsaConfirmNew.prepare,
+                                   self.request.get("next") == "1")
+        if not compare:
             # nothing to do
             self.redirect('/update')
             return
-        new = new[0]
-
-        # find datasets nearby
-        query = Stop.all().filter('confirm =', 'NO')
-        proximity = geo.geomodel.GeoModel.proximity_fetch(query, new.location, max_results=6, max_distance=500)
-
-        compare=[]
-        stop = {}
-        stop['description'] = 'New:'
-        stop['type'] = new.stop_type
-        stop['name'] = ", ".join(new.names)
-        stop['lat'] = new.location.lat
-        stop['lon'] = new.location.lon
-        stop['new'] = True
-        stop['key'] = str(new.key())
-        compare.append(stop)
-        for pstop in proximity:
-            stop = {}
-            # calculate distance to new point
-            dist = geo.geomath.distance(new.location,pstop.location)
-            # calculate 'distance' between names (ratio of similarity)
-            ndiff = difflib.SequenceMatcher(None,"".join(new.names),"".join(pstop.names))
-            logging.debug("%s vs. %s ratio %f" % ("".join(new.names),"".join(pstop.names),ndiff.ratio()))
-            if dist < 100.0 or ndiff.ratio() > 0.7:
-                stop['checked'] = "checked"
-                stop['style'] = "balsa-watch"
-            stop['description'] = 'at %4.0f meters' % (dist)
-            stop['type'] = pstop.stop_type
-            stop['name'] = ", ".join(pstop.names)
-            stop['lat'] = pstop.location.lat
-            stop['lon'] = pstop.location.lon
-            stop['new'] = False
-            stop['key'] = str(pstop.key())
-            compare.append(stop)
         template_values['compare'] = compare
 
-        counter = StopMeta.all().get()
-        template_values['new_num_stops'] = counter.counter_stop_new_confirm
-        template_values['new_num_stations'] = counter.counter_station_new_confirm
-        template_values['new_num_places'] = counter.counter_place_new_confirm
+        StopCounter.template_values(template_values, "NEW")
 
         path = os.path.join(os.path.dirname(__file__), "pages/confirm_new.html")
         self.response.out.write(template.render(path, template_values))
         return
 
 
+class BalsaConfirmDelete(webapp.RequestHandler):
+    """Confirm deletions from osm change files"""
+
+    @staticmethod
+    def prepare(deletes):
+        res = []
+        for delete in deletes:
+            stop = {}
+            stop['key'] = str(delete.key())
+            stop['type'] = delete.stop_type
+            stop['name'] = StopLabel.from_stop(delete)
+            stop['lat'] = delete.location.lat
+            stop['lon'] = delete.location.lon
+            res.append(stop)
+        return res
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        stop = review_candidate(login_user.email(), 'delete', StopDelete, BalsaConfirmDelete.prepare,
+                                self.request.get("next") == "1")
+        if not stop:
+            # nothing to do
+            self.redirect('/update')
+            return
+        template_values['stop'] = stop
+
+        StopCounter.template_values(template_values, "DELETE")
+
+        path = os.path.join(os.path.dirname(__file__), "pages/confirm_delete.html")
+        self.response.out.write(template.render(path, template_values))
+        return
+
+
+class BalsaConfirmDeleteAccept(webapp.RequestHandler):
+    """Delete the production stop together with the deletion to be confirmed"""
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        key = self.request.get("key", None)
+        assert key, "Did not receive key"
+
+        BalsaConfirm.accept([StopDelete.get(key)])
+
+        self.redirect('/update/confirm/delete?next=1')
+
+
+class BalsaConfirmDeleteReject(webapp.RequestHandler):
+    """Keep the production stop and drop the deletion"""
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        key = self.request.get("key", None)
+        assert key, "Did not receive key"
+
+        BalsaConfirm.reject([StopDelete.get(key)])
+
+        self.redirect('/update/confirm/delete?next=1')
+
+
+class BalsaConfirmBatch(webapp.RequestHandler):
+    """Accept or reject many pending stops with one request
+
+    Parameters:
+    action: accept or reject
+    flow: new, update or delete (the table of pending stops)
+    key: keys of pending stops (repeated), or else a rule selecting
+         pending stops by comparison with their production stop:
+    max_distance: moved less than this (meters)
+    same_names, same_type: 1 if names or stop type must be identical
+    max_score: change score (see balsa_confirm.change_score) up to this
+
+    Works through the pending stops until the time budget is used up. The
+    json answer holds the cursor to continue with, the html form follows
+    it by redirecting to itself.
+    """
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        action = self.request.get("action")
+        assert action in ['accept', 'reject'], "Accept or reject? No action specified."
+        model_class, confirm = PENDING[self.request.get("flow")]
+        if action == 'accept':
+            confirm_batch = BalsaConfirm.accept
+        else:
+            confirm_batch = BalsaConfirm.reject
+
+        done = int(self.request.get("done", "0"))
+        cursor = None
+        keys = self.request.get_all("key")
+        if keys:
+            done += confirm_batch(model_class.get(keys))
+        else:
+            max_distance = None
+            if self.request.get("max_distance"):
+                max_distance = float(self.request.get("max_distance"))
+            max_score = None
+            if self.request.get("max_score"):
+                max_score = float(self.request.get("max_score"))
+            rule = ConfirmRule(max_distance,
+                               self.request.get("same_names") == "1",
+                               self.request.get("same_type") == "1",
+                               max_score)
+            cursor = self.request.get("cursor") or None
+            deadline = time.time() + settings.TASK_TIME_BUDGET
+            while time.time() < deadline:
+                query = model_class.all()
+                if cursor:
+                    query.with_cursor(cursor)
+                pending = query.fetch(settings.REVIEW_BATCH_SIZE)
+                if not pending:
+                    cursor = None
+                    break
+                cursor = query.cursor()
+                done += confirm_batch(BalsaConfirm.select(pending, rule))
+
+        memcache.set('update_status', "%s: %d pending stops done." % (action.title(), done), time=30)
+        if self.request.get("format") == "json":
+            self.response.headers['Content-Type'] = "application/json"
+            self.response.out.write(json.dumps({'done': done, 'cursor': cursor}))
+        elif cursor:
+            params = dict(self.request.params.items())
+            params.update({'cursor': cursor, 'done': done})
+            self.redirect('/update/confirm/batch?%s' % (urllib.urlencode(params)))
+        else:
+            self.redirect('/update')
+
+
+class BalsaConfirmDuplicates(webapp.RequestHandler):
+    """List the duplicate clusters, most probable duplicates first"""
+
+    @staticmethod
+    def prepare(clusters):
+        """Returns the clusters with their new and production stops, in one
+        batch. Clusters of new stops confirmed in the meantime are skipped."""
+        keys = [Key.from_path('StopNew', cluster.key().id()) for cluster in clusters]
+        for cluster in clusters:
+            keys.extend([Key.from_path('Stop', osm_id) for osm_id in cluster.duplicate_ids])
+        stops = dict([(stop.key(), stop) for stop in db.get(keys) if stop])
+        res = []
+        for cluster in clusters:
+            new = stops.get(Key.from_path('StopNew', cluster.key().id()))
+            if not new:
+                continue
+            duplicates = []
+            for osm_id, score, distance in zip(cluster.duplicate_ids, cluster.scores, cluster.distances):
+                production = stops.get(Key.from_path('Stop', osm_id))
+                if production:
+                    duplicates.append({'type': production.stop_type,
+                                       'label': StopLabel.from_stop(production),
+                                       'score': "%.2f" % (score),
+                                       'distance': "%4.0f" % (distance)})
+            res.append({'id': cluster.key().id(),
+                        'score': "%.2f" % (cluster.score),
+                        'type': new.stop_type,
+                        'label': StopLabel.from_stop(new),
+                        'duplicates': duplicates})
+        return res
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        query = DuplicateCluster.all().order('-score')
+        cursor = self.request.get("cursor")
+        if cursor:
+            query.with_cursor(cursor)
+        clusters = query.fetch(settings.DEDUP_PAGE_SIZE)
+        template_values['clusters'] = BalsaConfirmDuplicates.prepare(clusters)
+        if len(clusters) == settings.DEDUP_PAGE_SIZE:
+            template_values['cursor'] = query.cursor()
+        template_values['min_score'] = settings.DEDUP_MIN_SCORE
+
+        StopCounter.template_values(template_values, "NEW")
+
+        path = os.path.join(os.path.dirname(__file__), "pages/confirm_duplicates.html")
+        self.response.out.write(template.render(path, template_values))
+
+
+class BalsaConfirmDuplicatesMerge(webapp.RequestHandler):
+    """Resolve many duplicate clusters with one request
+
+    Parameters:
+    action: merge (accept the new stops, delete their duplicates from
+            production) or keep (reject the new stops)
+    cluster: osm ids of the new stops of the clusters (repeated), or else
+    min_score: all clusters scoring at least this whose duplicates all
+               have the same name words as the new stop
+
+    Works like BalsaConfirmBatch until the time budget is used up.
+    """
+
+    @AdminRequired
+    def get(self, login_user=None, template_values={}):
+        action = self.request.get("action")
+        assert action in ['merge', 'keep'], "Merge or keep? No action specified."
+
+        done = int(self.request.get("done", "0"))
+        cursor = None
+        ids = self.request.get_all("cluster")
+        if ids:
+            clusters = DuplicateCluster.get([Key.from_path('DuplicateCluster', long(osm_id)) for osm_id in ids])
+            done += BalsaConfirm.merge([cluster for cluster in clusters if cluster], action == 'merge')
+        else:
+            min_score = float(self.request.get("min_score"))
+            cursor = self.request.get("cursor") or None
+            deadline = time.time() + settings.TASK_TIME_BUDGET
+            while time.time() < deadline:
+                query = DuplicateCluster.all().filter('score >=', min_score)
+                if cursor:
+                    query.with_cursor(cursor)
+                clusters = query.fetch(settings.REVIEW_BATCH_SIZE)
+                if not clusters:
+                    cursor = None
+                    break
+                cursor = query.cursor()
+                # nobody looks at these, names which differ at all are left to the admin
+                done += BalsaConfirm.merge([cluster for cluster in clusters if cluster.exact], action == 'merge')
+
+        memcache.set('update_status', "%s: %d duplicate clusters done." % (action.title(), done), time=30)
+        if self.request.get("format") == "json":
+            self.response.headers['Content-Type'] = "application/json"
+            self.response.out.write(json.dumps({'done': done, 'cursor': cursor}))
+        elif cursor:
+            params = dict(self.request.params.items())
+            params.update({'cursor': cursor, 'done': done})
+            self.redirect('/update/confirm/duplicates/merge?%s' % (urllib.urlencode(params)))
+        else:
+            self.redirect('/update/confirm/duplicates')
+
+
 application = webapp.WSGIApplication([('/update', BalsaUpdate),
                                       ('/update/upload', BalsaStopUploadHandler),
                                       ('/update/store', BalsaStopStoreTask),
+                                      ('/update/metrics', BalsaMetrics),
+                                      ('/update/triage', BalsaTriageTask),
+                                      ('/update/neighbours', BalsaNeighbourTask),
+                                      ('/update/index', BalsaIndexTask),
                                       ('/update/confirm/update', BalsaConfirmUpdate),
                                       ('/update/confirm/update/accept', BalsaConfirmUpdateAccept),
                                       ('/update/confirm/update/reject', BalsaConfirmUpdateReject),
                                       ('/update/confirm/new/accept', BalsaConfirmNewAccept),
-                                      ('/update/confirm/new', BalsaConfirmNew)],settings.DEBUG)
+                                      ('/update/confirm/new', BalsaConfirmNew),
+                                      ('/update/confirm/delete/accept', BalsaConfirmDeleteAccept),
+                                      ('/update/confirm/delete/reject', BalsaConfirmDeleteReject),
+                                      ('/update/confirm/delete', BalsaConfirmDelete),
+                                      ('/update/confirm/batch', BalsaConfirmBatch),
+                                      ('/update/confirm/duplicates', BalsaConfirmDuplicates),
+                                      ('/update/confirm/duplicates/merge', BalsaConfirmDuplicatesMerge)],settings.DEBUG)
 
 def main():
     logging.getLogger().setLevel(settings.LOG_LEVEL)
@@ -0,0 +1,133 @@
+"""Balsa.cl Duplicate detection between new and production stops
+
+   Joins new stops with the production stops of the same and the
+   adjacent geocells and scores the pairs by the similarity of their
+   names and their distance. Also scores how much a pending update
+   changes its production stop. Does not depend on App Engine.
+
+   Stefan Wehner (2011)
+"""
+
+import re
+import difflib
+import regionmatch
+import geo.geocell
+import geo.geomath
+import geo.geotypes
+
+word_pattern = re.compile(r"(\w+)", re.UNICODE)
+
+# words telling apart stops of the same name, like the platforms of a
+# station or the stops on both sides of a road
+DIRECTION_WORDS = set(['norte', 'sur', 'oriente', 'poniente', 'este', 'oeste',
+                       'ida', 'vuelta', 'north', 'south', 'east', 'west'])
+
+
+def name_words(names):
+    """Returns the set of plain words of names
+
+    Unlike the ascii_names of a stop this keeps numbers and other words
+    of a single character.
+    """
+    words = set()
+    for name in names:
+        for word in re.findall(word_pattern, regionmatch._unicode(name)):
+            word = regionmatch.plain(word)
+            if word:
+                words.add(word)
+    return words
+
+
+def name_trigrams(words):
+    """Returns the set of trigrams of all words"""
+    grams = set()
+    for word in words:
+        grams.update(regionmatch.trigrams(word))
+    return grams
+
+
+def distinguishing_words(words):
+    """Returns the numbers and direction words among words"""
+    return set([word for word in words if word in DIRECTION_WORDS or
+                [c for c in word if c.isdigit()]])
+
+
+def name_similarity(words1, grams1, words2, grams2):
+    """Returns the similarity (0.0 to 1.0) of two sets of words
+
+    The share of common words, or the Dice coefficient of the trigrams
+    of the words if higher, which tolerates spelling differences. Names
+    with different numbers or directions are not similar at all, if only
+    one of them has such a word the similarity is halved.
+    """
+    if not words1 or not words2:
+        return 0.0
+    common = float(len(words1 & words2)) / len(words1 | words2)
+    similarity = max(common, 2.0 * len(grams1 & grams2) / (len(grams1) + len(grams2)))
+    distinct1 = distinguishing_words(words1)
+    distinct2 = distinguishing_words(words2)
+    if distinct1 != distinct2:
+        if distinct1 and distinct2:
+            return 0.0
+        return similarity / 2
+    return similarity
+
+
+def change_score(pending, production, distance_scale):
+    """Returns the magnitude of the change from production to pending
+
+    Sum of the distance moved (1.0 for distance_scale meters or more),
+    the dissimilarity of the names (0.0 to 1.0) and a change of the stop
+    type (1.0). 0.0 means no change at all.
+    """
+    score = 0.0
+    if pending.location != production.location:
+        moved = geo.geomath.distance(pending.location, production.location)
+        score += min(moved / distance_scale, 1.0)
+    if pending.names != production.names:
+        score += 1.0 - difflib.SequenceMatcher(None, "; ".join(pending.names), "; ".join(production.names)).ratio()
+    if pending.stop_type != production.stop_type:
+        score += 1.0
+    return score
+
+
+class DuplicateFinder(object):
+    """Finds the probable duplicates of stops among candidate stops
+
+    The candidates are put into buckets by their geocell of the given
+    resolution. A stop is compared with the candidates in its own cell and
+    the 8 adjacent ones, so cells should be larger than max_distance.
+    """
+
+    def __init__(self, candidates, resolution, max_distance, min_score, name_weight=0.5):
+        """candidates is a list of (lat, lon, id, names)"""
+        self.resolution = resolution
+        self.max_distance = float(max_distance)
+        self.min_score = min_score
+        self.name_weight = name_weight
+        self._grid = {}
+        for lat, lon, cid, names in candidates:
+            words = name_words(names)
+            self._grid.setdefault(self.cell(lat, lon), []).append((lat, lon, cid, words, name_trigrams(words)))
+
+    def cell(self, lat, lon):
+        return geo.geocell.compute(geo.geotypes.Point(lat, lon), self.resolution)
+
+    def find(self, lat, lon, names):
+        """Returns list of (score, distance, id, same words) of the
+        duplicates, best first"""
+        words = name_words(names)
+        grams = name_trigrams(words)
+        cell = self.cell(lat, lon)
+        found = []
+        for search_cell in [cell] + geo.geocell.all_adjacents(cell):
+            for clat, clon, cid, cwords, cgrams in self._grid.get(search_cell, ()):
+                distance = geo.geomath.haversine(lat, lon, clat, clon)
+                if distance > self.max_distance:
+                    continue
+                score = self.name_weight * name_similarity(words, grams, cwords, cgrams) + \
+                        (1.0 - self.name_weight) * (1.0 - distance / self.max_distance)
+                if score >= self.min_score:
+                    found.append((score, distance, cid, words == cwords))
+        found.sort(reverse=True)
+        return found
@@ -167,16 +167,14 @@ def collinear(cell1, cell2, column_test):
     A bool indicating whether or not the given cells are collinear in the given
     dimension.
   """
-  for i in range(min(len(cell1), len(cell2))):
-    x1, y1 = _subdiv_xy(cell1[i])
-    x2, y2 = _subdiv_xy(cell2[i])
-
-    # Check row collinearity (assure y's are always the same).
-    if not column_test and y1 != y2:
-      return False
-
+  if column_test:
     # Check column collinearity (assure x's are always the same).
-    if column_test and x1 != x2:
+    table = _CHAR_X
+  else:
+    # Check row collinearity (assure y's are always the same).
+    table = _CHAR_Y
+  for char1, char2 in zip(cell1, cell2):
+    if table[char1] != table[char2]:
       return False
 
   return True
@@ -283,7 +281,7 @@ def adjacent(cell, dir):
   i = len(cell_adj_arr) - 1
 
   while i >= 0 and (dx != 0 or dy != 0):
-    x, y = _subdiv_xy(cell_adj_arr[i])
+    x, y = _CHAR_XY[cell_adj_arr[i]]
 
     # Horizontal adjacency.
     if dx == -1:  # Asking for left.
@@ -313,7 +311,7 @@ def adjacent(cell, dir):
         y -= 1  # Adjacent, same parent.
         dy = 0  # Done with y.
 
-    cell_adj_arr[i] = _subdiv_char((x,y))
+    cell_adj_arr[i] = _XY_CHAR[y << 2 | x]
     i -= 1
 
   # If we're not done with y then it's trying to wrap vertically,
@@ -345,26 +343,23 @@ def point_distance(cell, point):
   between_w_e = bbox.west <= point.lon and point.lon <= bbox.east
   between_n_s = bbox.south <= point.lat and point.lat <= bbox.north
 
+  # Candidate edge and corner points, measured in one batch.
   if between_w_e:
     if between_n_s:
       # Inside the geocell.
-      return min(geomath.distance(point, (bbox.south, point.lon)),
-                 geomath.distance(point, (bbox.north, point.lon)),
-                 geomath.distance(point, (point.lat, bbox.east)),
-                 geomath.distance(point, (point.lat, bbox.west)))
+      lats = [bbox.south, bbox.north, point.lat, point.lat]
+      lons = [point.lon, point.lon, bbox.east, bbox.west]
     else:
-      return min(geomath.distance(point, (bbox.south, point.lon)),
-                 geomath.distance(point, (bbox.north, point.lon)))
+      lats = [bbox.south, bbox.north]
+      lons = [point.lon, point.lon]
   else:
     if between_n_s:
-      return min(geomath.distance(point, (point.lat, bbox.east)),
-                 geomath.distance(point, (point.lat, bbox.west)))
+      lats = [point.lat, point.lat]
+      lons = [bbox.east, bbox.west]
     else:
-      # TODO(romannurik): optimize
-      return min(geomath.distance(point, (bbox.south, bbox.east)),
-                 geomath.distance(point, (bbox.north, bbox.east)),
-                 geomath.distance(point, (bbox.south, bbox.west)),
-                 geomath.distance(point, (bbox.north, bbox.west)))
+      lats = [bbox.south, bbox.north, bbox.south, bbox.north]
+      lons = [bbox.east, bbox.east, bbox.west, bbox.west]
+  return min(geomath.distances(point, lats, lons))
 
 
 def compute(point, resolution=MAX_GEOCELL_RESOLUTION):
@@ -394,7 +389,7 @@ def compute(point, resolution=MAX_GEOCELL_RESOLUTION):
     y = min(int(_GEOCELL_GRID_SIZE * (point.lat - south) / (north - south)),
             _GEOCELL_GRID_SIZE - 1)
 
-    cell += _subdiv_char((x,y))
+    cell += _XY_CHAR[y << 2 | x]
 
     south += subcell_lat_span * y
     north = south + subcell_lat_span
@@ -417,22 +412,14 @@ def compute_box(cell):
   if cell is None:
     return None
 
-  bbox = geotypes.Box(90.0, 180.0, -90.0, -180.0)
-
-  while len(cell) > 0:
-    subcell_lon_span = (bbox.east - bbox.west) / _GEOCELL_GRID_SIZE
-    subcell_lat_span = (bbox.north - bbox.south) / _GEOCELL_GRID_SIZE
-
-    x, y = _subdiv_xy(cell[0])
-
-    bbox = geotypes.Box(bbox.south + subcell_lat_span * (y + 1),
-                        bbox.west  + subcell_lon_span * (x + 1),
-                        bbox.south + subcell_lat_span * y,
-                        bbox.west  + subcell_lon_span * x)
+  # The cell is at column x and row y of the grid of its resolution.
+  x, y = decode_xy(cell)
+  size = float(1 << (2 * len(cell)))
 
-    cell = cell[1:]
-
-  return bbox
+  return geotypes.Box(-90.0 + 180.0 * (y + 1) / size,
+                      -180.0 + 360.0 * (x + 1) / size,
+                      -90.0 + 180.0 * y / size,
+                      -180.0 + 360.0 * x / size)
 
 
 def is_valid(cell):
@@ -449,19 +436,53 @@ def children(cell):
   return [cell + chr for chr in _GEOCELL_ALPHABET]
 
 
+def decode_xy(cell):
+  """Returns the (x, y) column and row of the geocell in the grid of its
+  resolution, which has 4^resolution columns and rows."""
+  x = 0
+  y = 0
+  for char in cell:
+    x = (x << 2) | _CHAR_X[char]
+    y = (y << 2) | _CHAR_Y[char]
+  return x, y
+
+
+def encode_xy(x, y, resolution):
+  """Returns the geocell at column x and row y of the grid of resolution."""
+  chars = []
+  for i in range(resolution):
+    chars.append(_XY_CHAR[(y & 3) << 2 | (x & 3)])
+    x >>= 2
+    y >>= 2
+  chars.reverse()
+  return ''.join(chars)
+
+
 def _subdiv_xy(char):
   """Returns the (x, y) of the geocell character in the 4x4 alphabet grid."""
-  # NOTE: This only works for grid size 4.
-  char = _GEOCELL_ALPHABET.index(char)
-  return ((char & 4) >> 1 | (char & 1) >> 0,
-          (char & 8) >> 2 | (char & 2) >> 1)
+  return _CHAR_XY[char]
 
 
 def _subdiv_char(pos):
   """Returns the geocell character in the 4x4 alphabet grid at pos. (x, y)."""
+  return _XY_CHAR[pos[1] << 2 | pos[0]]
+
+
+def _build_tables():
+  """Computes the lookup tables between characters and (x, y) positions."""
   # NOTE: This only works for grid size 4.
-  return _GEOCELL_ALPHABET[
-      (pos[1] & 2) << 2 |
-      (pos[0] & 2) << 1 |
-      (pos[1] & 1) << 1 |
-      (pos[0] & 1) << 0]
+  char_xy = {}
+  xy_char = [None] * len(_GEOCELL_ALPHABET)
+  for i, char in enumerate(_GEOCELL_ALPHABET):
+    x = (i & 4) >> 1 | (i & 1) >> 0
+    y = (i & 8) >> 2 | (i & 2) >> 1
+    char_xy[char] = (x, y)
+    xy_char[y << 2 | x] = char
+  return (char_xy, xy_char,
+          dict([(char, xy[0]) for char, xy in char_xy.items()]),
+          dict([(char, xy[1]) for char, xy in char_xy.items()]))
+
+
+# Geocell character -> (x, y) in the 4x4 grid, the character at y * 4 + x,
+# and the x and y of each character alone.
+_CHAR_XY, _XY_CHAR, _CHAR_X, _CHAR_Y = _build_tables()
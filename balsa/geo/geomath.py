@@ -20,13 +20,21 @@ __author__ = 'api.roman.public@gmail.com (Roman Nurik)'
 
 import math
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 import geotypes
 
 RADIUS = 6378135
 
+# Batches smaller than this are faster in plain python than with numpy.
+NUMPY_MIN_BATCH = 32
+
 
 def distance(p1, p2):
-  """Calculates the great circle distance between two points (law of cosines).
+  """Calculates the great circle distance between two points (haversine).
 
   Args:
     p1: A geotypes.Point or db.GeoPt indicating the first point.
@@ -35,7 +43,60 @@ def distance(p1, p2):
   Returns:
     The 2D great-circle distance between the two given points, in meters.
   """
-  p1lat, p1lon = math.radians(p1.lat), math.radians(p1.lon)
-  p2lat, p2lon = math.radians(p2.lat), math.radians(p2.lon)
-  return RADIUS * math.acos(math.sin(p1lat) * math.sin(p2lat) +
-      math.cos(p1lat) * math.cos(p2lat) * math.cos(p2lon - p1lon))
+  return haversine(p1.lat, p1.lon, p2.lat, p2.lon)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+  """Calculates the great circle distance between two points given in degrees.
+
+  Unlike the law of cosines the haversine formula stays accurate for points
+  only a few meters apart.
+
+  Returns:
+    The great-circle distance between the two points, in meters.
+  """
+  lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+  a = (math.sin((lat2 - lat1) / 2) ** 2 +
+       math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+  return 2 * RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def equirectangular(lat1, lon1, lat2, lon2):
+  """Approximates the distance between two points given in degrees.
+
+  Projects both points onto a plane at their mean latitude. Needs a single
+  cosine and is close to the great circle distance for points up to some
+  kilometers apart, good enough to rank candidates by distance.
+
+  Returns:
+    The approximate distance between the two points, in meters.
+  """
+  x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+  y = math.radians(lat2 - lat1)
+  return RADIUS * math.sqrt(x * x + y * y)
+
+
+def distances(center, lats, lons):
+  """Calculates the great circle distances of many points to one center.
+
+  Uses a single vectorized numpy calculation if numpy is available and the
+  batch is large enough, the haversine formula point by point otherwise.
+
+  Args:
+    center: A geotypes.Point or db.GeoPt indicating the center.
+    lats: A sequence of latitudes of the points, in degrees.
+    lons: A sequence of longitudes of the points, in degrees.
+
+  Returns:
+    A list of the distances of the points to the center, in meters.
+  """
+  if numpy is None or len(lats) < NUMPY_MIN_BATCH:
+    return [haversine(center.lat, center.lon, lat, lon)
+            for lat, lon in zip(lats, lons)]
+  clat = math.radians(center.lat)
+  clon = math.radians(center.lon)
+  lats = numpy.radians(numpy.asarray(lats, dtype=float))
+  lons = numpy.radians(numpy.asarray(lons, dtype=float))
+  a = (numpy.sin((lats - clat) / 2) ** 2 +
+       math.cos(clat) * numpy.cos(lats) * numpy.sin((lons - clon) / 2) ** 2)
+  return (2 * RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))).tolist()
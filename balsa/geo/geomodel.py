@@ -217,8 +217,10 @@ class GeoModel(db.Model):
 
       # Begin storing distance from the search result entity to the
       # search center along with the search result itself, in a tuple.
-      new_results = [(entity, geomath.distance(center, entity.location))
-                     for entity in new_results]
+      new_results = zip(new_results, geomath.distances(
+          center,
+          [entity.location.lat for entity in new_results],
+          [entity.location.lon for entity in new_results]))
       new_results = sorted(new_results, lambda dr1, dr2: cmp(dr1[1], dr2[1]))
       new_results = new_results[:max_results]
 
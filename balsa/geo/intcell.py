@@ -0,0 +1,188 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2011 Stefan Wehner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Geocells as integers, operated on with bit arithmetic.
+
+The same cells as in geocell.py, represented by (resolution, value) tuples
+instead of hexadecimal strings. Every character of a geocell string holds two
+bits of the column (x) and two bits of the row (y) of the 4x4 grid:
+
+  character bits:  y1 x1 y0 x0
+
+so the value of the whole hexadecimal string is the Morton code (bitwise
+interleaving) of the column and the row of the cell in the 2^(2*resolution)
+square grid of its resolution, with x in the even and y in the odd bits:
+
+  value == int(cell, 16)
+
+Computing a cell is a single division per axis, the bounding box follows
+from the column and the row, adjacent cells are found by adding to the x or
+y bits alone, parents and children by shifting 4 bits. Values of the
+practical resolutions fit into 64 bits.
+"""
+
+import geotypes
+
+# The maximum resolution whose values fit into 64 bits.
+MAX_RESOLUTION = 16
+
+# Even bits (x) and odd bits (y) of the interleaved value.
+_X_BITS = 0x5555555555555555
+_Y_BITS = 0xaaaaaaaaaaaaaaaa
+
+
+def _spread(v):
+  """Spreads the lower 32 bits of v to the even bits of a 64 bit value."""
+  v &= 0xffffffff
+  v = (v | (v << 16)) & 0x0000ffff0000ffff
+  v = (v | (v << 8)) & 0x00ff00ff00ff00ff
+  v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0f
+  v = (v | (v << 2)) & 0x3333333333333333
+  v = (v | (v << 1)) & 0x5555555555555555
+  return v
+
+
+def _compact(v):
+  """Collects the even bits of a 64 bit value into the lower 32 bits."""
+  v &= 0x5555555555555555
+  v = (v | (v >> 1)) & 0x3333333333333333
+  v = (v | (v >> 2)) & 0x0f0f0f0f0f0f0f0f
+  v = (v | (v >> 4)) & 0x00ff00ff00ff00ff
+  v = (v | (v >> 8)) & 0x0000ffff0000ffff
+  v = (v | (v >> 16)) & 0x00000000ffffffff
+  return v
+
+
+def from_xy(x, y, resolution):
+  """Returns the cell at column x and row y of the grid of resolution."""
+  return (resolution, _spread(x) | (_spread(y) << 1))
+
+
+def to_xy(cell):
+  """Returns the (x, y) column and row of the cell in the grid of its
+  resolution."""
+  value = cell[1]
+  return (_compact(value), _compact(value >> 1))
+
+
+def from_string(cell):
+  """Converts a geocell string to a (resolution, value) tuple."""
+  if not cell:
+    return (0, 0)
+  return (len(cell), int(cell, 16))
+
+
+def to_string(cell):
+  """Converts a (resolution, value) tuple to a geocell string."""
+  resolution, value = cell
+  if not resolution:
+    return ''
+  return '%0*x' % (resolution, value)
+
+
+def compute(point, resolution=13):
+  """Computes the cell containing the given point to the given resolution.
+
+  Args:
+    point: The geotypes.Point to compute the cell for.
+    resolution: An int up to MAX_RESOLUTION.
+
+  Returns:
+    The (resolution, value) tuple of the cell containing the point.
+  """
+  size = 1 << (2 * resolution)
+  x = min(int(size * (point.lon + 180.0) / 360.0), size - 1)
+  y = min(int(size * (point.lat + 90.0) / 180.0), size - 1)
+  return from_xy(x, y, resolution)
+
+
+def compute_box(cell):
+  """Computes the bounding box of the given cell.
+
+  Returns:
+    A geotypes.Box corresponding to the rectangular boundaries of the cell.
+  """
+  if cell is None:
+    return None
+  size = float(1 << (2 * cell[0]))
+  x, y = to_xy(cell)
+  return geotypes.Box(-90.0 + 180.0 * (y + 1) / size,
+                      -180.0 + 360.0 * (x + 1) / size,
+                      -90.0 + 180.0 * y / size,
+                      -180.0 + 360.0 * x / size)
+
+
+def adjacent(cell, dir):
+  """Calculates the cell adjacent to the given cell in the given direction.
+
+  Args:
+    cell: The (resolution, value) tuple whose neighbor is being calculated.
+    dir: An (x, y) tuple indicating direction like in geocell.adjacent.
+
+  Returns:
+    The adjacent cell, or None if there is no such cell. Like in
+    geocell.adjacent cells wrap around horizontally, but not vertically.
+  """
+  if cell is None:
+    return None
+  resolution, value = cell
+  mask = (1 << (4 * resolution)) - 1
+  x_bits = _X_BITS & mask
+  y_bits = _Y_BITS & mask
+  x = value & x_bits
+  y = value & y_bits
+  dx, dy = dir
+
+  # Filling the bits in between with ones carries an addition across them,
+  # a subtraction borrows across zeros.
+  if dx == 1:
+    x = ((x | y_bits) + 1) & x_bits
+  elif dx == -1:
+    x = (x - 1) & x_bits
+  if dy == 1:
+    if y == y_bits:
+      return None
+    y = ((y | x_bits) + 1) & y_bits
+  elif dy == -1:
+    if not y:
+      return None
+    y = (y - 1) & y_bits
+  return (resolution, x | y)
+
+
+def all_adjacents(cell):
+  """Calculates all 8 adjacent cells, None for those that do not exist."""
+  return [adjacent(cell, d) for d in [(-1, 1), (0, 1), (1, 1), (1, 0),
+                                      (1, -1), (0, -1), (-1, -1), (-1, 0)]]
+
+
+def parent(cell):
+  """Returns the cell one resolution lower containing the given cell."""
+  resolution, value = cell
+  if not resolution:
+    return None
+  return (resolution - 1, value >> 4)
+
+
+def children(cell):
+  """Returns the 16 cells of the next resolution inside the given cell."""
+  resolution, value = cell
+  return [(resolution + 1, (value << 4) | i) for i in range(16)]
+
+
+def contains_point(cell, point):
+  """Returns whether or not the given cell contains the given point."""
+  return compute(point, cell[0]) == cell
@@ -0,0 +1,108 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2011 Stefan Wehner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro benchmark of the geocell operations, strings against integers.
+
+Usage:
+  PYTHONPATH=../.. python geocell_benchmark.py [number of points]
+
+Prints the operations per second of geocell.py (strings) and intcell.py
+(integers) for the same random points. Operations intcell.py does not have
+are measured for geocell.py only.
+"""
+
+import random
+import sys
+import time
+
+from geo import geocell
+from geo import geotypes
+from geo import intcell
+
+RESOLUTION = 13
+
+
+def ops_per_second(fn, args):
+  """Calls fn with every argument of args, returns the calls per second."""
+  start = time.time()
+  for arg in args:
+    fn(arg)
+  return len(args) / max(time.time() - start, 1e-9)
+
+
+def cost_function(num_cells, resolution):
+  """The default cost function of geomodel.py, which needs App Engine."""
+  return 1e10000 if num_cells > pow(geocell._GEOCELL_GRID_SIZE, 2) else 0
+
+
+def cases(points):
+  """Returns (name, string function, string args, int function, int args)."""
+  cells = [geocell.compute(p, RESOLUTION) for p in points]
+  int_cells = [intcell.from_string(c) for c in cells]
+  # cells with the cell 2 steps northeast, the grid between has 9 cells
+  cell_pairs = [(geocell.adjacent(geocell.adjacent(c, geocell.NORTHEAST),
+                                  geocell.NORTHEAST), c) for c in cells]
+  cell_pairs = [(ne, sw) for ne, sw in cell_pairs if ne]
+  # boxes of about 1 km north east of the points
+  boxes = [geotypes.Box(min(p.lat + 0.01, 90), min(p.lon + 0.01, 180),
+                        p.lat, p.lon) for p in points]
+  return [
+      ('compute',
+       lambda p: geocell.compute(p, RESOLUTION), points,
+       lambda p: intcell.compute(p, RESOLUTION), points),
+      ('compute_box', geocell.compute_box, cells,
+       intcell.compute_box, int_cells),
+      ('adjacent',
+       lambda c: geocell.adjacent(c, geocell.NORTHEAST), cells,
+       lambda c: intcell.adjacent(c, geocell.NORTHEAST), int_cells),
+      ('all_adjacents', geocell.all_adjacents, cells,
+       intcell.all_adjacents, int_cells),
+      ('parent', lambda c: c[:-1], cells,
+       intcell.parent, int_cells),
+      ('children', geocell.children, cells,
+       intcell.children, int_cells),
+      ('decode_xy', geocell.decode_xy, cells,
+       intcell.to_xy, int_cells),
+      ('interpolate', lambda pair: geocell.interpolate(*pair), cell_pairs,
+       None, None),
+      ('best_bbox', lambda box: geocell.best_bbox_search_cells(
+          box, cost_function), boxes,
+       None, None),
+  ]
+
+
+def main(args):
+  num_points = 20000
+  if len(args) > 1:
+    num_points = int(args[1])
+  rnd = random.Random(42)
+  points = [geotypes.Point(rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+            for i in xrange(num_points)]
+
+  print '%-16s %14s %14s %8s' % ('operation', 'string ops/s', 'int ops/s',
+                                 'speedup')
+  for name, str_fn, str_args, int_fn, int_args in cases(points):
+    str_ops = ops_per_second(str_fn, str_args)
+    if int_fn is None:
+      print '%-16s %14.0f %14s %8s' % (name, str_ops, '-', '-')
+      continue
+    int_ops = ops_per_second(int_fn, int_args)
+    print '%-16s %14.0f %14.0f %7.1fx' % (name, str_ops, int_ops,
+                                          int_ops / str_ops)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -77,6 +77,19 @@ class GeocellTests(unittest.TestCase):
     self.assertFalse(
         geocell.collinear(cell, geocell.adjacent(cell, (1, 0)), True))
 
+  def test_xy(self):
+    # '7' is column 3, row 1 of the 4x4 grid, '78a' adds (0, 2) and (0, 3)
+    self.assertEqual((3, 1), geocell.decode_xy('7'))
+    self.assertEqual((3 << 4, (1 << 4) | (2 << 2) | 3),
+                     geocell.decode_xy('78a'))
+    self.assertEqual((0, 0), geocell.decode_xy(''))
+
+    cell = geocell.compute(geotypes.Point(37, -122), 13)
+    x, y = geocell.decode_xy(cell)
+    self.assertEqual(cell, geocell.encode_xy(x, y, 13))
+    for char in '0123456789abcdef':
+      self.assertEqual(char, geocell._subdiv_char(geocell._subdiv_xy(char)))
+
   def test_interpolation(self):
     cell = geocell.compute(geotypes.Point(37, -122), 14)
     sw_adjacent = geocell.adjacent(cell, (-1, -1))
@@ -34,6 +34,45 @@ class GeomathTests(unittest.TestCase):
     # make sure the calculated distance is within +/- 1% of known distance
     self.assertTrue(abs((calc_dist - known_dist) / known_dist) <= 0.01)
 
+  def test_distance_short(self):
+    # 0.0001 degrees of latitude, stable where the law of cosines is not
+    calc_dist = geomath.distance(geotypes.Point(-33.45, -70.66),
+                                 geotypes.Point(-33.4501, -70.66))
+    self.assertAlmostEqual(calc_dist, geomath.RADIUS * 0.0001 * 3.14159265 / 180,
+                           places=3)
+    self.assertEqual(0, geomath.distance(geotypes.Point(-33.45, -70.66),
+                                         geotypes.Point(-33.45, -70.66)))
+
+  def test_equirectangular(self):
+    # within 0.1% of the great circle distance for nearby points
+    for lat2, lon2 in [(-33.46, -70.66), (-33.45, -70.67), (-33.44, -70.65)]:
+      exact = geomath.haversine(-33.45, -70.66, lat2, lon2)
+      approx = geomath.equirectangular(-33.45, -70.66, lat2, lon2)
+      self.assertTrue(abs(approx - exact) / exact <= 0.001)
+
+  def test_distances(self):
+    center = geotypes.Point(37, -122)
+    lats = [37 + 0.01 * i for i in range(100)]
+    lons = [-122 - 0.02 * i for i in range(100)]
+    expected = [geomath.haversine(37, -122, lat, lon)
+                for lat, lon in zip(lats, lons)]
+    self._assertDistances(expected, geomath.distances(center, lats, lons))
+
+    # the same without numpy
+    numpy = geomath.numpy
+    geomath.numpy = None
+    try:
+      self._assertDistances(expected, geomath.distances(center, lats, lons))
+    finally:
+      geomath.numpy = numpy
+
+    self.assertEqual([], geomath.distances(center, [], []))
+
+  def _assertDistances(self, expected, calculated):
+    self.assertEqual(len(expected), len(calculated))
+    for expected_dist, calc_dist in zip(expected, calculated):
+      self.assertAlmostEqual(expected_dist, calc_dist, places=3)
+
 
 if __name__ == '__main__':
   unittest.main()
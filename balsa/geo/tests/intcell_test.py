@@ -0,0 +1,106 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2011 Stefan Wehner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for intcell.py."""
+
+import random
+import unittest
+
+from geo import geocell
+from geo import geotypes
+from geo import intcell
+
+DIRECTIONS = [(-1, 1), (0, 1), (1, 1), (1, 0),
+              (1, -1), (0, -1), (-1, -1), (-1, 0)]
+
+
+class IntcellTests(unittest.TestCase):
+  def test_strings(self):
+    self.assertEqual((3, 0x78a), intcell.from_string('78a'))
+    self.assertEqual('78a', intcell.to_string((3, 0x78a)))
+    self.assertEqual('0078a', intcell.to_string((5, 0x78a)))
+    self.assertEqual('', intcell.to_string(intcell.from_string('')))
+
+  def test_xy(self):
+    # '7' is column 3, row 1 of the 4x4 grid
+    self.assertEqual((3, 1), intcell.to_xy(intcell.from_string('7')))
+    self.assertEqual('7', intcell.to_string(intcell.from_xy(3, 1, 1)))
+    self.assertEqual((15, 15), intcell.to_xy(intcell.from_string('ff')))
+
+  def test_compute(self):
+    cell = intcell.compute(geotypes.Point(37, -122), 13)
+    self.assertEqual(geocell.compute(geotypes.Point(37, -122), 13),
+                     intcell.to_string(cell))
+    self.assertTrue(intcell.contains_point(cell, geotypes.Point(37, -122)))
+
+    # corners of the world
+    self.assertEqual('f', intcell.to_string(
+        intcell.compute(geotypes.Point(90, 180), 1)))
+    self.assertEqual('0', intcell.to_string(
+        intcell.compute(geotypes.Point(-90, -180), 1)))
+
+  def test_compute_box(self):
+    cell = intcell.compute(geotypes.Point(37, -122), 13)
+    box = intcell.compute_box(cell)
+    string_box = geocell.compute_box(intcell.to_string(cell))
+
+    self.assertAlmostEqual(string_box.north, box.north)
+    self.assertAlmostEqual(string_box.east, box.east)
+    self.assertAlmostEqual(string_box.south, box.south)
+    self.assertAlmostEqual(string_box.west, box.west)
+
+  def test_adjacent(self):
+    cell = intcell.compute(geotypes.Point(37, -122), 13)
+    for dir in DIRECTIONS:
+      self.assertEqual(
+          geocell.adjacent(intcell.to_string(cell), dir),
+          intcell.to_string(intcell.adjacent(cell, dir)))
+
+    # wraps around horizontally, but not vertically
+    self.assertEqual('5', intcell.to_string(
+        intcell.adjacent(intcell.from_string('0'), (-1, 0))))
+    self.assertEqual(None, intcell.adjacent(intcell.from_string('a'), (0, 1)))
+    self.assertEqual(None, intcell.adjacent(intcell.from_string('0'),
+                                            (0, -1)))
+    self.assertEqual(8, len(intcell.all_adjacents(cell)))
+
+  def test_parent_children(self):
+    cell = intcell.from_string('78a')
+    self.assertEqual('78', intcell.to_string(intcell.parent(cell)))
+    self.assertEqual(None, intcell.parent(intcell.from_string('')))
+    self.assertEqual(geocell.children('78a'),
+                     [intcell.to_string(c) for c in intcell.children(cell)])
+
+  def test_like_geocell(self):
+    rnd = random.Random(42)
+    for i in range(1000):
+      point = geotypes.Point(rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+      resolution = rnd.randint(1, 13)
+      cell = intcell.compute(point, resolution)
+      string_cell = geocell.compute(point, resolution)
+      self.assertEqual(string_cell, intcell.to_string(cell))
+      self.assertEqual(cell, intcell.from_string(string_cell))
+      for dir in DIRECTIONS:
+        adjacent = intcell.adjacent(cell, dir)
+        string_adjacent = geocell.adjacent(string_cell, dir)
+        if string_adjacent is None:
+          self.assertEqual(None, adjacent)
+        else:
+          self.assertEqual(string_adjacent, intcell.to_string(adjacent))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -6,5 +6,6 @@ coverage -x geomath_test.py
 coverage -x geotypes_test.py
 coverage -x util_test.py
 coverage -x geocell_test.py
+coverage -x intcell_test.py
 
-coverage -r -m geomath.py geotypes.py util.py geocell.py
+coverage -r -m geomath.py geotypes.py util.py geocell.py intcell.py
@@ -105,13 +105,15 @@ def distance_sorted_edges(cells, point):
                          max([box.east for box in boxes]),
                          min([box.south for box in boxes]),
                          min([box.west for box in boxes]))
+  # Edges along a meridian or a parallel of the point, where the
+  # equirectangular approximation is cheap and good enough for ranking.
   return zip(*sorted([
-      ((0,-1), geomath.distance(geotypes.Point(max_box.south, point.lon),
-                                point)),
-      ((0,1),  geomath.distance(geotypes.Point(max_box.north, point.lon),
-                                point)),
-      ((-1,0), geomath.distance(geotypes.Point(point.lat, max_box.west),
-                                point)),
-      ((1,0),  geomath.distance(geotypes.Point(point.lat, max_box.east),
-                                point))],
+      ((0,-1), geomath.equirectangular(max_box.south, point.lon,
+                                       point.lat, point.lon)),
+      ((0,1),  geomath.equirectangular(max_box.north, point.lon,
+                                       point.lat, point.lon)),
+      ((-1,0), geomath.equirectangular(point.lat, max_box.west,
+                                       point.lat, point.lon)),
+      ((1,0),  geomath.equirectangular(point.lat, max_box.east,
+                                       point.lat, point.lon))],
       lambda x, y: cmp(x[1], y[1])))
@@ -0,0 +1,97 @@
+"""Balsa.cl Nearest neighbour search for many points at once
+
+   Finds the production stops next to pending stops ahead of review.
+   Uses numpy to compute the distances of many points at once if it is
+   available, and a grid of buckets in pure python otherwise. Does not
+   depend on App Engine.
+
+   Stefan Wehner (2011)
+"""
+
+import math
+from geo.geomath import RADIUS, haversine
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# points compared at once with all candidates when using numpy
+NUMPY_CHUNK_SIZE = 256
+# distances computed at once at most, chunks of points next to many
+# candidates are made smaller
+NUMPY_MAX_PAIRS = 256*1024
+
+
+def nearest_neighbours(points, candidates, k, max_distance):
+    """Returns the nearest candidates of every point
+
+    points is a list of (lat, lon), candidates a list of (lat, lon, id).
+    For every point the result holds a list of up to k (distance, id)
+    tuples of the candidates within max_distance meters, nearest first.
+    """
+    if not points:
+        return []
+    if not candidates:
+        return [[] for point in points]
+    if numpy:
+        return _nearest_numpy(points, candidates, k, max_distance)
+    return _nearest_grid(points, candidates, k, max_distance)
+
+
+def _nearest_numpy(points, candidates, k, max_distance):
+    # candidates sorted by latitude, so that a chunk of points sorted by
+    # latitude only needs to be compared with a band of candidates
+    candidates = sorted(candidates)
+    lats = numpy.radians(numpy.array([c[0] for c in candidates]))
+    lons = numpy.radians(numpy.array([c[1] for c in candidates]))
+    cos_lats = numpy.cos(lats)
+    ids = [c[2] for c in candidates]
+    band = float(max_distance) / RADIUS
+    order = sorted(range(len(points)), key=lambda i: points[i][0])
+    res = [None] * len(points)
+    start = 0
+    while start < len(order):
+        size = NUMPY_CHUNK_SIZE
+        while True:
+            chunk_index = order[start:start+size]
+            first = numpy.searchsorted(lats, math.radians(points[chunk_index[0]][0]) - band, 'left')
+            last = numpy.searchsorted(lats, math.radians(points[chunk_index[-1]][0]) + band, 'right')
+            if size == 1 or len(chunk_index) * (last - first) <= NUMPY_MAX_PAIRS:
+                break
+            size /= 2
+        start += len(chunk_index)
+        chunk = numpy.radians(numpy.array([points[i] for i in chunk_index]))
+        plats = chunk[:, 0:1]
+        plons = chunk[:, 1:2]
+        # haversine of every point in the chunk with every candidate of the band
+        a = numpy.sin((lats[first:last] - plats)/2)**2 + \
+            numpy.cos(plats) * cos_lats[first:last] * numpy.sin((lons[first:last] - plons)/2)**2
+        distances = 2 * RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+        for i, row in zip(chunk_index, distances):
+            nearest = numpy.argsort(row)[:k]
+            res[i] = [(float(row[j]), ids[first+j]) for j in nearest if row[j] <= max_distance]
+    return res
+
+
+def _nearest_grid(points, candidates, k, max_distance):
+    # buckets of max_distance in latitude, wider in longitude towards the poles
+    cell = max_distance / (RADIUS * math.pi / 180)
+    grid = {}
+    for lat, lon, cid in candidates:
+        grid.setdefault((int(math.floor(lat / cell)), int(math.floor(lon / cell))), []).append((lat, lon, cid))
+    res = []
+    for lat, lon in points:
+        row = int(math.floor(lat / cell))
+        # longitude cells needed to cover max_distance at this latitude
+        span = int(math.ceil(1 / max(math.cos(math.radians(min(abs(lat) + cell, 90))), 1e-6)))
+        col = int(math.floor(lon / cell))
+        found = []
+        for r in (row-1, row, row+1):
+            for c in range(col-span, col+span+1):
+                for clat, clon, cid in grid.get((r, c), ()):
+                    d = haversine(lat, lon, clat, clon)
+                    if d <= max_distance:
+                        found.append((d, cid))
+        found.sort()
+        res.append(found[:k])
+    return res
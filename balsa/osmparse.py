@@ -3,10 +3,20 @@
    Stefan Wehner (2011)
 """
 import os
+import re
 import sys
+import optparse
 import xml.sax
+import xml.parsers.expat
 import logging
 import datetime
+import struct
+import zipfile
+import zlib
+try:
+    import bz2
+except ImportError:
+    bz2 = None
 
 try:
     from settings import LOG_LEVEL
@@ -31,20 +41,218 @@ StopAttr = {'place': [('city','PLACE'),
                         ('station','STATION')]
             }
 
+
+def compile_attr(node_attr):
+    """Turns an attribute structure like StopAttr into a lookup table
+
+    Returns the list of tag keys in the order of node_attr and a dictionary
+    (key, value) -> kind.
+    """
+    keys = []
+    tags = {}
+    for key,val_list in node_attr.items():
+        keys.append(key)
+        for value,kind in val_list:
+            tags[(key, value)] = kind
+    return keys, tags
+
+# Size of the compressed chunks read by DecompressReader
+READ_CHUNK_SIZE = 64*1024
+
+
+class StoredDecompressor(object):
+    """Decompressor for uncompressed (stored) zip members"""
+    def decompress(self, data):
+        return data
+
+
+class DecompressReader(object):
+    """File-like object which decompresses data on the fly
+
+    Compressed data is read from the underlying file in bounded chunks
+    so that memory usage does not depend on the size of the file.
+    """
+
+    def __init__(self, fp, decompressor, size=None):
+        """Read at most size compressed bytes from fp (all if None) and
+        pass them through decompressor.decompress()"""
+        self._fp = fp
+        self._decompressor = decompressor
+        self._remaining = size
+        self._buffer = ""
+        self._eof = False
+
+    def _fill(self):
+        chunk_size = READ_CHUNK_SIZE
+        if self._remaining is not None:
+            chunk_size = min(chunk_size, self._remaining)
+        data = ""
+        if chunk_size > 0:
+            data = self._fp.read(chunk_size)
+        if not data:
+            self._eof = True
+            if hasattr(self._decompressor, 'flush'):
+                self._buffer += self._decompressor.flush()
+            return
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        self._buffer += self._decompressor.decompress(data)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._buffer = ""
+        self._eof = True
+
+
+def open_zip_member(fp):
+    """Returns a streaming reader for the first member of a zip file"""
+    # only the central directory is read here
+    info = zipfile.ZipFile(fp, 'r').infolist()[0]
+    fp.seek(info.header_offset)
+    header = fp.read(30)
+    if header[0:4] != "PK\003\004":
+        raise SyntaxError("Bad zip file header")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    fp.seek(info.header_offset + 30 + name_length + extra_length)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        # raw deflate stream without zlib header
+        return DecompressReader(fp, zlib.decompressobj(-zlib.MAX_WBITS), info.compress_size)
+    elif info.compress_type == zipfile.ZIP_STORED:
+        return DecompressReader(fp, StoredDecompressor(), info.compress_size)
+    raise SyntaxError("Unsupported zip compression type %d" % (info.compress_type))
+
+
+def open_osm(fp):
+    """Returns a file-like object with the uncompressed osm data in fp
+
+    Detects zip, gzip and bz2 compressed data by their magic numbers.
+    Uncompressed data is returned as it is. fp must support seek().
+    """
+    magic = fp.read(4)
+    fp.seek(0)
+    if magic == "PK\003\004":
+        logging.info("Detected zip file.")
+        return open_zip_member(fp)
+    elif magic[0:2] == "\037\213":
+        logging.info("Detected gzip file.")
+        return DecompressReader(fp, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif magic[0:3] == "BZh":
+        logging.info("Detected bz2 file.")
+        if not bz2:
+            raise SyntaxError("No bz2 support available")
+        return DecompressReader(fp, bz2.BZ2Decompressor())
+    return fp
+
+
+class OSMSlicer(object):
+    """Cuts osm xml data into slices which can be parsed one by one
+
+    Slices end right before a top level element (node, way or relation).
+    Every slice is wrapped into its own <osm> element, so that it is a well
+    formed xml document on its own. The position in the uncompressed data is
+    kept as byte offset and can be used to continue with the next slice
+    later, even in another process.
+    """
+
+    boundary_pattern = re.compile(r"<(node|way|relation)[\s/>]")
+
+    def __init__(self, fp, offset=0):
+        """Start slicing fp at byte offset (of the uncompressed data)"""
+        self._fp = fp
+        self._buffer = ""
+        self.offset = offset
+        self.eof = False
+        if offset:
+            if hasattr(fp, 'seek'):
+                fp.seek(offset)
+            else:
+                # compressed streams can only be skipped by decompressing,
+                # which costs as much as the offset. The import tasks slice
+                # an inflated copy of compressed uploads instead.
+                while offset > 0:
+                    skipped = len(fp.read(min(offset, READ_CHUNK_SIZE)))
+                    if not skipped:
+                        break
+                    offset -= skipped
+
+    def next_slice(self, size):
+        """Returns the next slice of roughly size bytes as xml document
+
+        Returns None if there is no more data.
+        """
+        if self.eof:
+            return None
+        start = self.offset
+        data = self._buffer
+        end = None
+        while end is None:
+            if len(data) > size:
+                match = self.boundary_pattern.search(data, size)
+                if match:
+                    end = match.start()
+                    break
+            chunk = self._fp.read(READ_CHUNK_SIZE)
+            if not chunk:
+                self.eof = True
+                end = len(data)
+            data += chunk
+        if self.eof and not data:
+            return None
+        # the rest belongs to the next slice
+        self._buffer = data[end:]
+        self.offset = start + end
+        data = data[:end]
+        if start:
+            data = "<osm>" + data
+        if not self.eof:
+            data = data + "</osm>"
+        return data
+
+
+def parse_timestamp(ts):
+    """Returns datetime of an osm timestamp string like 2011-03-04T10:11:12Z"""
+    return datetime.datetime(int(ts[0:4]),int(ts[5:7]),int(ts[8:10]),int(ts[11:13]),int(ts[14:16]),int(ts[17:19]),0,None)
+
+
+def is_change(data):
+    """Returns True if data, the start of an xml document, is an osmChange document"""
+    return re.search(r"<osmChange[\s>]", data) is not None
+
+
 class Node(object):
-    def __init__(self,osm_id,name,lat,lon,timestamp):
+    def __init__(self,osm_id,name,lat,lon,timestamp,attr=None):
         self.osm_id = osm_id
         self.name = name
         self.lat = lat
         self.lon = lon
-        self.attr = {}
-        self.timestamp = datetime.datetime(int(timestamp[0:4]),int(timestamp[5:7]),int(timestamp[8:10]),int(timestamp[11:13]),int(timestamp[14:16]),int(timestamp[17:19]),0,None)
+        self.attr = attr or {}
+        # string timestamps are converted when they are used first
+        self._timestamp = timestamp
+
+    def _get_timestamp(self):
+        ts = self._timestamp
+        if isinstance(ts, basestring):
+            ts = parse_timestamp(ts)
+            self._timestamp = ts
+        return ts
+    timestamp = property(_get_timestamp)
 
     def __str__(self):
         return "NODE %s (%3.3f, %3.3f)" % (self.name.encode("UTF-8") ,self.lat,self.lon)
 
 
 class OSMContentHandler(xml.sax.ContentHandler):
+    # elements which are not important for us
+    ignored_elements = set(["nd", "way", "osm", "relation", "member", "bound", "bounds"])
+
     def __init__(self, filedata, node_attr_cb):
         """
         Use this class to load and parse OSM files.
@@ -54,8 +262,12 @@ class OSMContentHandler(xml.sax.ContentHandler):
         with those in the given attribute structure, then the node is returned.
         """
         self._counter = 0
-        self._current_node = None
+        # xml attributes and tags of the node being parsed. A Node object
+        # is only created if one of the tags matches.
+        self._current_attrs = None
+        self._current_tags = None
         self._find_node_attr, self._find_node_cb = node_attr_cb
+        self._find_keys, self._find_tags = compile_attr(self._find_node_attr)
         # call parent initializer and start parsing
         # Can't use super() because Content handler is old style class
         xml.sax.handler.ContentHandler.__init__(self)
@@ -69,36 +281,17 @@ class OSMContentHandler(xml.sax.ContentHandler):
 
 
     def startElement(self, name, attrs):
-        if name == 'node':
-            # Always store data in new entity while parsing.
-            # In the end, decide whether it is written to storage
-            self._current_node = Node(long(attrs['id']), "<no name>",
-                            float(attrs['lat']),
-                            float(attrs['lon']),
-                            attrs['timestamp'])
-
-        elif name == 'way':
-            pass
-
-        elif name == 'tag':
-            if self._current_node:
-                if attrs['k'] == 'name':
-                    self._current_node.name = attrs['v']
-                self._current_node.attr[attrs['k']] = attrs['v']
+        # ordered by frequency in osm files
+        if name == 'tag':
+            if self._current_attrs is not None:
+                self._current_tags[attrs['k']] = attrs['v']
 
-        elif name == "nd":
-            pass
+        elif name == 'node':
+            self._counter += 1
+            self._current_attrs = attrs
+            self._current_tags = {}
 
-        # not important for us
-        elif name == "osm":
-            pass
-        elif name == "relation":
-            pass
-        elif name == "member":
-            pass
-        elif name == "bound":
-            pass
-        elif name == "bounds":
+        elif name in self.ignored_elements:
             pass
         else:
             logging.error ("Don't know element %s" % (name))
@@ -106,24 +299,215 @@ class OSMContentHandler(xml.sax.ContentHandler):
 
     def endElement(self, name):
         if name == "node":
-            # Check if the current node has attributes with the key/value
-            # combination we are looking for
-            for key,val_list in self._find_node_attr.items():
-                if key in self._current_node.attr:
-                    for tag,kind in val_list:
-                        if tag == self._current_node.attr[key]:
-                            # found a matching node, callback
-                            self._find_node_cb(self._current_node,kind)
-            self._current_node = None
-
-        elif name == "way":
-            pass
-        elif name == "relation":
-            pass
-        elif name == "osm":
-            pass
-        else:
-            pass
+            self._current_attrs, attrs = None, self._current_attrs
+            match_node(attrs, self._current_tags, self._find_keys, self._find_tags, self._find_node_cb)
+
+
+class OSMExpatHandler(object):
+    """Alternative to OSMContentHandler built directly on pyexpat
+
+    Calls back with the same nodes as OSMContentHandler but avoids the
+    SAX layer, and ignores the content of ways and relations: while
+    inside of them no start element callbacks are made at all.
+    """
+
+    def __init__(self, filedata, node_attr_cb):
+        """Parse filedata (string or file-like object), see OSMContentHandler"""
+        self._counter = 0
+        self._current_attrs = None
+        self._current_tags = None
+        self._find_node_attr, self._find_node_cb = node_attr_cb
+        self._find_keys, self._find_tags = compile_attr(self._find_node_attr)
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self.startElement
+        self._parser.EndElementHandler = self.endElement
+        try:
+            if isinstance(filedata,str):
+                self._parser.Parse(filedata, True)
+            else:
+                self._parser.ParseFile(filedata)
+        except xml.parsers.expat.ExpatError:
+            raise SyntaxError
+
+    def startElement(self, name, attrs):
+        if name == 'tag':
+            if self._current_attrs is not None:
+                self._current_tags[attrs['k']] = attrs['v']
+        elif name == 'node':
+            self._counter += 1
+            self._current_attrs = attrs
+            self._current_tags = {}
+        elif name == 'way' or name == 'relation':
+            # skip the whole subtree
+            self._parser.StartElementHandler = None
+            self._parser.EndElementHandler = self.endSkipped
+
+    def endElement(self, name):
+        if name == "node":
+            self._current_attrs, attrs = None, self._current_attrs
+            match_node(attrs, self._current_tags, self._find_keys, self._find_tags, self._find_node_cb)
+
+    def endSkipped(self, name):
+        if name == 'way' or name == 'relation':
+            self._parser.StartElementHandler = self.startElement
+            self._parser.EndElementHandler = self.endElement
+
+
+class OSMChangeHandler(OSMExpatHandler):
+    """Parses an osmChange document with create, modify and delete sections
+
+    Matching nodes of the create and modify sections are called back like
+    in OSMExpatHandler. delete_cb is called with the osm id of every
+    deleted node and of every modified node which does not match anymore,
+    as it may have been a stop before. After parsing, timestamp holds the
+    newest timestamp of all changes (or None).
+    """
+
+    def __init__(self, filedata, node_attr_cb, delete_cb):
+        self._delete_cb = delete_cb
+        self._action = None
+        self._timestamp = ""
+        OSMExpatHandler.__init__(self, filedata, node_attr_cb)
+        self.timestamp = None
+        if self._timestamp:
+            self.timestamp = parse_timestamp(self._timestamp)
+
+    def startElement(self, name, attrs):
+        if name == 'create' or name == 'modify' or name == 'delete':
+            self._action = name
+            return
+        if name == 'node' or name == 'way' or name == 'relation':
+            # the timestamp format sorts like the time
+            self._timestamp = max(self._timestamp, attrs.get('timestamp', ""))
+        OSMExpatHandler.startElement(self, name, attrs)
+
+    def endElement(self, name):
+        if name == "node":
+            self._current_attrs, attrs = None, self._current_attrs
+            if self._action == 'delete':
+                self._delete_cb(long(attrs['id']))
+                return
+            matched = match_node(attrs, self._current_tags, self._find_keys, self._find_tags, self._find_node_cb)
+            if not matched and self._action == 'modify':
+                self._delete_cb(long(attrs['id']))
+
+
+# Parser implementations by name
+BACKENDS = {'sax': OSMContentHandler,
+            'expat': OSMExpatHandler}
+
+
+def match_kinds(tags, find_keys, find_tags):
+    """Returns the list of kinds the tags dictionary matches"""
+    # Check if the current node has attributes with the key/value
+    # combination we are looking for
+    kinds = []
+    for key in find_keys:
+        if key in tags:
+            kind = find_tags.get((key, tags[key]))
+            if kind:
+                kinds.append(kind)
+    return kinds
+
+
+def match_node(attrs, tags, find_keys, find_tags, node_cb):
+    """Calls node_cb for every kind the tags of a node match
+
+    attrs are the xml attributes of the node element, find_keys and
+    find_tags come from compile_attr(). Returns True if the node matched.
+    """
+    # most nodes have no tags at all
+    if not tags:
+        return False
+    kinds = match_kinds(tags, find_keys, find_tags)
+    if not kinds:
+        return False
+    node = Node(long(attrs['id']), tags.get('name', "<no name>"),
+                float(attrs['lat']),
+                float(attrs['lon']),
+                attrs.get('timestamp'),
+                tags)
+    for kind in kinds:
+        # found a matching node, callback
+        node_cb(node, kind)
+    return True
+
+
+def split_ranges(filename, range_size):
+    """Splits an uncompressed osm file into byte ranges of about range_size
+
+    Every range but the first starts with a top level element (node, way
+    or relation). Returns a list of (start, end) tuples.
+    """
+    size = os.path.getsize(filename)
+    fp = open(filename, 'rb')
+    starts = [0]
+    pos = range_size
+    while pos < size:
+        fp.seek(pos)
+        data = ""
+        match = None
+        while not match:
+            chunk = fp.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            # keep a few bytes in case a tag is cut by the chunk border
+            data = data[-16:] + chunk
+            match = OSMSlicer.boundary_pattern.search(data)
+            if not match:
+                pos += len(chunk)
+        if not match:
+            break
+        start = pos + match.start() - (len(data) - len(chunk))
+        starts.append(start)
+        pos = start + range_size
+    fp.close()
+    ends = starts[1:] + [size]
+    return zip(starts, ends)
+
+
+def read_range(filename, start, end):
+    """Returns the byte range of filename as well formed xml document"""
+    fp = open(filename, 'rb')
+    fp.seek(start)
+    data = fp.read(end - start)
+    fp.close()
+    if start:
+        data = "<osm>" + data
+    if end < os.path.getsize(filename):
+        data = data + "</osm>"
+    return data
+
+
+def _parse_range(args):
+    """Worker of parallel_parse(), returns list of (Node, kind)"""
+    filename, start, end, node_attr, backend = args
+    found = []
+    def collect_cb(node, kind):
+        found.append((node, kind))
+    BACKENDS[backend](read_range(filename, start, end), (node_attr, collect_cb))
+    return found
+
+
+def parallel_parse(filename, node_attr, processes=None, range_size=32*1024*1024, backend='expat'):
+    """Parses an uncompressed osm file in a pool of processes
+
+    The file is split into byte ranges at element boundaries which are
+    parsed in parallel. Yields (Node, kind) for all matching nodes in
+    the order of the file.
+    """
+    import multiprocessing
+    ranges = split_ranges(filename, range_size)
+    logging.info("Parsing %d ranges of %s" % (len(ranges), filename))
+    pool = multiprocessing.Pool(processes)
+    try:
+        tasks = [(filename, start, end, node_attr, backend) for start, end in ranges]
+        for found in pool.imap(_parse_range, tasks):
+            for node, kind in found:
+                yield node, kind
+    finally:
+        pool.terminate()
 
 
 def test_cb(node, kind):
@@ -132,20 +516,35 @@ def test_cb(node, kind):
 
 def main(args):
     logging.getLogger().setLevel(LOG_LEVEL)
+    parser = optparse.OptionParser(usage="%prog [options] osmfile")
+    parser.add_option("-b", "--backend", default="expat", choices=BACKENDS.keys(),
+                      help="parser backend (%s)" % (", ".join(BACKENDS.keys())))
+    parser.add_option("-j", "--processes", type="int", default=1,
+                      help="parse uncompressed xml files with this number of processes")
+    options, args = parser.parse_args(args[1:])
+    if not args:
+        parser.error("Call with filename parameter")
     try:
-        fp = open(args[1],'r')
+        fp = open(args[0],'rb')
     except IOError:
-        logging.critical ("Can't open file: "+args[1])
-        sys.exit(1)
-    except IndexError:
-        logging.critical ("Usage: Call with filename parameter")
+        logging.critical ("Can't open file: "+args[0])
         sys.exit(1)
 
-    OSMContentHandler(fp, (StopAttr, test_cb))
+    import osmpbf
+    if osmpbf.is_pbf(fp):
+        osmpbf.OSMPBFHandler(fp, (StopAttr, test_cb))
+    elif options.processes > 1:
+        reader = open_osm(fp)
+        if reader is not fp:
+            logging.critical ("Parallel parsing needs an uncompressed file")
+            sys.exit(1)
+        for node, kind in parallel_parse(args[0], StopAttr, options.processes, backend=options.backend):
+            test_cb(node, kind)
+    else:
+        BACKENDS[options.backend](open_osm(fp), (StopAttr, test_cb))
     fp.close()
 
 
 
 if __name__ == "__main__":
     main(sys.argv)
-
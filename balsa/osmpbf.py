@@ -0,0 +1,323 @@
+"""Balsa parser for openstreetmap data in the PBF format
+
+   The PBF format (see http://wiki.openstreetmap.org/wiki/PBF_Format)
+   is a sequence of zlib compressed protocol buffer blocks. The few
+   messages needed for nodes are decoded here in pure python, so no
+   protobuf library is required.
+
+   Stefan Wehner (2011)
+"""
+import struct
+import zlib
+import datetime
+import osmparse
+
+# features of the OSMHeader block this reader can handle
+SUPPORTED_FEATURES = set(["OsmSchema-V0.6", "DenseNodes", "HistoricalInformation"])
+
+
+def is_pbf(fp):
+    """Returns True if fp starts with the header block of a PBF file"""
+    magic = fp.read(15)
+    fp.seek(0)
+    # length of BlobHeader, then field 1 (type) with length 9
+    return magic[4:15] == "\x0a\x09OSMHeader"
+
+
+def _varint(data, pos):
+    """Decodes the varint at pos, returns value and position behind it"""
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(data):
+    """Iterates over (field number, value) of a protocol buffer message
+
+    Values of length delimited fields are returned as strings, fixed
+    size fields are skipped.
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _varint(data, pos)
+            value = data[pos:pos+length]
+            pos += length
+        elif wire_type == 1:
+            pos += 8
+            continue
+        elif wire_type == 5:
+            pos += 4
+            continue
+        else:
+            raise SyntaxError("Unknown wire type %d" % (wire_type))
+        yield key >> 3, value
+
+
+def _packed(data):
+    """Decodes packed varints"""
+    values = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        value, pos = _varint(data, pos)
+        values.append(value)
+    return values
+
+
+def _repeated(values, value):
+    """Adds the values of a repeated varint field to the list values
+
+    Repeated fields are packed into one length delimited field as a rule,
+    but may as well come as one varint field per value.
+    """
+    if isinstance(value, str):
+        values.extend(_packed(value))
+    else:
+        values.append(value)
+
+
+def _signed(value):
+    """Two's complement for int32/int64 varints"""
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def _delta(values):
+    """Decodes packed, delta coded sint64 values"""
+    res = []
+    last = 0
+    for value in values:
+        last += _zigzag(value)
+        res.append(last)
+    return res
+
+
+class PBFSlicer(object):
+    """Cuts PBF data into slices of whole blocks
+
+    Works like osmparse.OSMSlicer, but the offset is the position in the
+    PBF file itself, which needs no decompression to seek to.
+    """
+
+    def __init__(self, fp, offset=0):
+        self._fp = fp
+        self.offset = offset
+        self.eof = False
+        fp.seek(offset)
+
+    def next_slice(self, size):
+        """Returns the next blocks, at least size bytes or None at the end"""
+        if self.eof:
+            return None
+        blocks = []
+        length = 0
+        while length < size:
+            header_size = self._fp.read(4)
+            if len(header_size) < 4:
+                self.eof = True
+                break
+            header = self._fp.read(struct.unpack(">I", header_size)[0])
+            datasize = 0
+            for field, value in _fields(header):
+                if field == 3:
+                    datasize = value
+            blob = self._fp.read(datasize)
+            blocks.extend([header_size, header, blob])
+            length += 4 + len(header) + len(blob)
+        self.offset += length
+        if not blocks:
+            return None
+        return "".join(blocks)
+
+
+class OSMPBFHandler(object):
+    """Parses PBF data and calls back for nodes like osmparse.OSMContentHandler
+
+    Blocks are only decoded as far as they may contain matching nodes:
+    blocks whose string table holds none of the searched tag keys and
+    groups with only ways and relations are skipped.
+    """
+
+    def __init__(self, filedata, node_attr_cb):
+        """filedata is a string or file-like object with PBF data"""
+        self._counter = 0
+        self._find_node_attr, self._find_node_cb = node_attr_cb
+        self._find_keys, self._find_tags = osmparse.compile_attr(self._find_node_attr)
+        if isinstance(filedata, str):
+            read = _StringReader(filedata).read
+        else:
+            read = filedata.read
+        try:
+            while True:
+                header_size = read(4)
+                if len(header_size) < 4:
+                    break
+                blob_type = None
+                datasize = 0
+                for field, value in _fields(read(struct.unpack(">I", header_size)[0])):
+                    if field == 1:
+                        blob_type = value
+                    elif field == 3:
+                        datasize = value
+                data = self._blob_data(read(datasize))
+                if blob_type == "OSMHeader":
+                    self._header_block(data)
+                elif blob_type == "OSMData":
+                    self._primitive_block(data)
+        except (IndexError, zlib.error, struct.error):
+            raise SyntaxError("Broken PBF data")
+
+    def _blob_data(self, blob):
+        for field, value in _fields(blob):
+            if field == 1:
+                # raw
+                return value
+            elif field == 3:
+                return zlib.decompress(value)
+            elif field == 4:
+                raise SyntaxError("LZMA compressed PBF blocks are not supported")
+        return ""
+
+    def _header_block(self, data):
+        for field, value in _fields(data):
+            if field == 4 and not value in SUPPORTED_FEATURES:
+                raise SyntaxError("PBF feature %s is not supported" % (value))
+
+    def _primitive_block(self, data):
+        strings = []
+        groups = []
+        granularity = 100
+        lat_offset = 0
+        lon_offset = 0
+        date_granularity = 1000
+        for field, value in _fields(data):
+            if field == 1:
+                strings = [s for f, s in _fields(value) if f == 1]
+            elif field == 2:
+                groups.append(value)
+            elif field == 17:
+                granularity = value
+            elif field == 18:
+                date_granularity = value
+            elif field == 19:
+                lat_offset = _signed(value)
+            elif field == 20:
+                lon_offset = _signed(value)
+        # no node in this block can match without one of the keys
+        if not [key for key in self._find_keys if key in strings]:
+            return
+        strings = [s.decode("UTF-8") for s in strings]
+        block = (strings, granularity, lat_offset, lon_offset, date_granularity)
+        for group in groups:
+            for field, value in _fields(group):
+                if field == 1:
+                    self._node(value, block)
+                elif field == 2:
+                    self._dense_nodes(value, block)
+
+    def _match(self, osm_id, lat, lon, timestamp, tags, block):
+        self._counter += 1
+        if not tags:
+            return
+        kinds = osmparse.match_kinds(tags, self._find_keys, self._find_tags)
+        if not kinds:
+            return
+        strings, granularity, lat_offset, lon_offset, date_granularity = block
+        node = osmparse.Node(osm_id, tags.get('name', "<no name>"),
+                             1e-9 * (lat_offset + granularity * lat),
+                             1e-9 * (lon_offset + granularity * lon),
+                             datetime.datetime.utcfromtimestamp(timestamp * date_granularity / 1000),
+                             tags)
+        for kind in kinds:
+            self._find_node_cb(node, kind)
+
+    def _node(self, data, block):
+        strings = block[0]
+        osm_id = lat = lon = timestamp = 0
+        keys = []
+        vals = []
+        for field, value in _fields(data):
+            if field == 1:
+                osm_id = _zigzag(value)
+            elif field == 2:
+                _repeated(keys, value)
+            elif field == 3:
+                _repeated(vals, value)
+            elif field == 4:
+                for info_field, info_value in _fields(value):
+                    if info_field == 2:
+                        timestamp = _signed(info_value)
+            elif field == 8:
+                lat = _zigzag(value)
+            elif field == 9:
+                lon = _zigzag(value)
+        tags = dict([(strings[k], strings[v]) for k, v in zip(keys, vals)])
+        self._match(osm_id, lat, lon, timestamp, tags, block)
+
+    def _dense_nodes(self, data, block):
+        strings = block[0]
+        ids = []
+        lats = []
+        lons = []
+        timestamps = []
+        keys_vals = []
+        for field, value in _fields(data):
+            if field == 1:
+                _repeated(ids, value)
+            elif field == 5:
+                for info_field, info_value in _fields(value):
+                    if info_field == 2:
+                        _repeated(timestamps, info_value)
+            elif field == 8:
+                _repeated(lats, value)
+            elif field == 9:
+                _repeated(lons, value)
+            elif field == 10:
+                _repeated(keys_vals, value)
+        ids = _delta(ids)
+        lats = _delta(lats)
+        lons = _delta(lons)
+        timestamps = _delta(timestamps)
+        if not [kv for kv in keys_vals if kv]:
+            # none of the nodes has tags
+            self._counter += len(ids)
+            return
+        if not timestamps:
+            timestamps = [0] * len(ids)
+        # keys_vals holds key, value string indexes per node, 0 ends a node
+        pos = 0
+        for i in xrange(len(ids)):
+            tags = {}
+            while keys_vals[pos]:
+                tags[strings[keys_vals[pos]]] = strings[keys_vals[pos+1]]
+                pos += 2
+            pos += 1
+            self._match(ids[i], lats[i], lons[i], timestamps[i], tags, block)
+
+
+class _StringReader(object):
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def read(self, size):
+        data = self._data[self._pos:self._pos+size]
+        self._pos += size
+        return data
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+"""Balsa.cl Matching of region names from is_in tags
+
+   Region tags in openstreetmap data come in many spellings. The
+   RegionResolver maps them to the regions we know. It does not depend
+   on App Engine, so it is used by the import and update as well as by
+   the offline enrichment in scripts/munis.py.
+
+   Stefan Wehner (2011)
+"""
+
+import difflib
+import unicodedata
+
+# (short name, long name) of the known regions
+REGIONS = [
+    ("V", u"Valparaíso"),
+    ("XIII", u"Metropolitana"),
+    ("VIII", u"Bio-Bío"),
+    ("III", u"Atacama"),
+    ("I", u"Tarapacá"),
+    ("X", u"Los Lagos"),
+    ("IV", u"Coquimbo"),
+    ("IX", u"La Araucanía"),
+    ("XII", u"Magallanes"),
+    ("II", u"Antofagasta"),
+    ("XV", u"Arica/Parinacota"),
+    ("XI", u"Aysén"),
+    ("VII", u"Maule"),
+    ("VI", u"O'Higgins"),
+    ("XIV", u"Los Ríos"),
+    ("BaWü", u"Baden-Württemberg"),
+    ("NY", u"New York"),
+    ("OH", u"Ohio")
+]
+
+
+def _unicode(name):
+    if isinstance(name, str):
+        return name.decode("UTF-8")
+    return unicode(name)
+
+
+def plain(name):
+    """Returns name in lower case ascii letters and digits only"""
+    name = unicodedata.normalize('NFD', _unicode(name).lower())
+    name = name.encode('ascii', 'ignore')
+    return "".join([c for c in name if c.isalnum()])
+
+
+def trigrams(name):
+    """Returns the set of character trigrams of a plain name"""
+    name = "  %s " % (name)
+    return set([name[i:i+3] for i in range(len(name)-2)])
+
+
+class RegionResolver(object):
+    """Maps region names from tags to (short_name, long_name) of REGIONS
+
+    A name is looked up by its plain form first, then by trigram
+    similarity and only then by a fuzzy comparison with all regions.
+    Results are memoized, as the same few spellings repeat all over
+    an osm file.
+    """
+
+    def __init__(self, regions=REGIONS, min_ratio=0.6, min_trigram_score=0.7):
+        self._regions = [(_unicode(short_name), _unicode(long_name)) for short_name,long_name in regions]
+        self._min_ratio = min_ratio
+        self._min_trigram_score = min_trigram_score
+        self._memo = {}
+        # plain name -> region index, for long and short names
+        self._exact = {}
+        # trigram -> set of region indexes
+        self._trigram_index = {}
+        self._trigrams = []
+        for i, (short_name, long_name) in enumerate(self._regions):
+            self._exact.setdefault(plain(long_name), i)
+            self._exact.setdefault(plain(short_name), i)
+            grams = trigrams(plain(long_name))
+            self._trigrams.append(grams)
+            for gram in grams:
+                self._trigram_index.setdefault(gram, set()).add(i)
+
+    def resolve(self, name):
+        """Returns (short_name, long_name) or None if there is no match"""
+        if name in self._memo:
+            return self._memo[name]
+        match = self._match(name)
+        self._memo[name] = match
+        return match
+
+    def _match(self, name):
+        key = plain(name)
+        if key in self._exact:
+            return self._regions[self._exact[key]]
+
+        # score candidates sharing trigrams (Dice coefficient)
+        grams = trigrams(key)
+        candidates = set()
+        for gram in grams:
+            candidates.update(self._trigram_index.get(gram, ()))
+        best = (self._min_trigram_score, None)
+        for i in candidates:
+            score = 2.0 * len(grams & self._trigrams[i]) / (len(grams) + len(self._trigrams[i]))
+            if score >= best[0]:
+                best = (score, i)
+        if best[1] is not None:
+            return self._regions[best[1]]
+
+        # fall back to the best fuzzy match, which must have some similarity
+        best = (self._min_ratio, None)
+        for i, (short_name, long_name) in enumerate(self._regions):
+            ratio = difflib.SequenceMatcher(None, long_name, name).ratio()
+            if ratio > best[0]:
+                best = (ratio, i)
+        if best[1] is not None:
+            return self._regions[best[1]]
+        return None
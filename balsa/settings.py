@@ -21,28 +21,52 @@ if DEBUG:
 RESULT_SIZE = 8
 
 STOP_TYPES = set(["STOP", "STATION", "PLACE"])
-CONFIRM_TYPES = set(["NO", "UPDATE", "NEW"])
+CONFIRM_TYPES = set(["NO", "UPDATE", "NEW", "DELETE"])
 
-# batch size for writing datasets at import or update
+# batch size for writing datasets at import or update, the writer
+# fills the batches up to the limits below once it knows the entity size
 BATCH_SIZE = 50
+WRITE_MAX_BATCH_SIZE = 500
+WRITE_MAX_BATCH_BYTES = 512*1024
+# number of batches written asynchronously while parsing goes on
+WRITE_MAX_IN_FLIGHT = 3
 
-REGIONS = [
-    ("V", u"Valparaíso"),
-    ("XIII", u"Metropolitana"),
-    ("VIII", u"Bio-Bío"),
-    ("III", u"Atacama"),
-    ("I", u"Tarapacá"),
-    ("X", u"Los Lagos"),
-    ("IV", u"Coquimbo"),
-    ("IX", u"La Araucanía"),
-    ("XII", u"Magallanes"),
-    ("II", u"Antofagasta"),
-    ("XV", u"Arica/Parinacota"),
-    ("XI", u"Aysén"),
-    ("VII", u"Maule"),
-    ("VI", u"O'Higgins"),
-    ("XIV", u"Los Ríos"),
-    ("BaWü", u"Baden-Württemberg"),
-    ("NY", u"New York"),
-    ("OH", u"Ohio")
-]
+# keys deleted per datastore call by a purge
+PURGE_BATCH_SIZE = 500
+
+# candidates prefetched per step of a confirm walkthrough
+REVIEW_PREFETCH = 10
+# pending stops checked per step of a bulk confirmation
+REVIEW_BATCH_SIZE = 100
+# the triage after an update scores moves up to this distance (meters)
+# between 0.0 and 1.0 and accepts updates with a score up to the limit
+TRIAGE_DISTANCE_SCALE = 100.0
+TRIAGE_AUTO_ACCEPT_SCORE = 0.02
+# production stops shown next to a new stop for review, up to a distance (meters)
+NEIGHBOUR_COUNT = 6
+NEIGHBOUR_MAX_DISTANCE = 500
+# new stops are compared with the production stops in the same and the
+# adjacent geocells of this resolution (about 300 meters), up to a distance
+# (meters). A pair is a duplicate if the weighted mean of the name
+# similarity and the nearness (both 0.0 to 1.0) reaches the score.
+DEDUP_RESOLUTION = 8
+DEDUP_MAX_DISTANCE = 200
+DEDUP_NAME_WEIGHT = 0.5
+DEDUP_MIN_SCORE = 0.6
+# duplicate clusters shown per page
+DEDUP_PAGE_SIZE = 50
+
+# number of shard entities per stop type and confirmation counter
+COUNTER_SHARDS = 10
+
+# parser backend from osmparse.BACKENDS for import and update
+OSM_PARSER = "expat"
+
+# import and update parse the uncompressed data in slices of this size (bytes)
+SLICE_SIZE = 2*1024*1024
+# seconds an import task may spend on parsing slices before it chains
+# a follow-up task to continue from the checkpoint
+TASK_TIME_BUDGET = 20
+
+# known regions as (short name, long name), shared with scripts/munis.py
+from regionmatch import REGIONS
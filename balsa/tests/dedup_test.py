@@ -0,0 +1,127 @@
+"""Unit tests for dedup.py
+
+   Run from this directory with PYTHONPATH=..
+
+   Stefan Wehner (2011)
+"""
+
+import unittest
+
+import dedup
+import geo.geocell
+import geo.geomath
+import geo.geotypes
+
+
+def similarity(names1, names2):
+    words1 = dedup.name_words(names1)
+    words2 = dedup.name_words(names2)
+    return dedup.name_similarity(words1, dedup.name_trigrams(words1),
+                                 words2, dedup.name_trigrams(words2))
+
+
+class NameSimilarityTests(unittest.TestCase):
+    def test_words(self):
+        self.assertEqual(set(['paradero', '3', 'los', 'heroes']),
+                         dedup.name_words(['Paradero 3', u'Los H\xe9roes']))
+
+    def test_similarity(self):
+        self.assertEqual(1.0, similarity(['Los Heroes'], [u'Los H\xe9roes']))
+        # spelling differences
+        self.assertTrue(similarity(['Los Heroes'], ['Los Heros']) > 0.7)
+        self.assertTrue(similarity(['Los Heroes'], ['Moneda']) < 0.2)
+        self.assertEqual(0.0, similarity([], ['Moneda']))
+
+    def test_distinguishing_words(self):
+        self.assertEqual(0.0, similarity(['Paradero 3'], ['Paradero 1']))
+        self.assertEqual(0.0, similarity(['Estacion Norte'], ['Estacion Sur']))
+        # only one of them has a number
+        self.assertTrue(similarity(['Paradero'], ['Paradero 1']) <= 0.5)
+        self.assertEqual(1.0, similarity(['Paradero 1'], ['paradero 1']))
+
+
+class DuplicateFinderTests(unittest.TestCase):
+    def setUp(self):
+        self.finder = dedup.DuplicateFinder([(-33.45, -70.66, 1, ['Los Heroes']),
+                                             (-33.4502, -70.66, 2, ['Moneda']),
+                                             (-33.45, -70.6615, 3, ['Paradero 1']),
+                                             (-33.47, -70.66, 4, ['Los Heroes'])],
+                                            8, 200, 0.6)
+
+    def test_find(self):
+        found = self.finder.find(-33.4501, -70.66, ['Los Heroes'])
+        self.assertEqual([1], [cid for score, distance, cid, same in found])
+        score, distance, cid, same = found[0]
+        self.assertTrue(same)
+        self.assertTrue(10 < distance < 12)
+        self.assertTrue(score > 0.95)
+
+    def test_score_threshold(self):
+        # close but with another name
+        self.assertEqual([], self.finder.find(-33.4502, -70.6601, ['Santa Lucia']))
+        # same name, other number
+        self.assertEqual([], self.finder.find(-33.45, -70.6614, ['Paradero 3']))
+        # same name, but further away than max_distance
+        self.assertEqual([], self.finder.find(-33.4725, -70.66, ['Los Heroes']))
+
+    def test_geocell_buckets(self):
+        # a candidate in the adjacent cell is found, across the cell edge
+        cell = self.finder.cell(-33.45, -70.66)
+        box = geo.geocell.compute_box(cell)
+        finder = dedup.DuplicateFinder([(box.north + 0.0001, -70.66, 5, ['Moneda'])], 8, 200, 0.6)
+        self.assertNotEqual(cell, finder.cell(box.north + 0.0001, -70.66))
+        found = finder.find(box.north - 0.0001, -70.66, ['Moneda'])
+        self.assertEqual([5], [cid for score, distance, cid, same in found])
+        # cells are larger than the maximum distance
+        self.assertTrue(geo.geomath.distance(geo.geotypes.Point(box.south, box.west),
+                                             geo.geotypes.Point(box.north, box.west)) > 200)
+
+
+class Stop(object):
+    def __init__(self, lat, lon, names, stop_type="STOP"):
+        self.location = geo.geotypes.Point(lat, lon)
+        self.names = names
+        self.stop_type = stop_type
+
+
+# the defaults of settings.TRIAGE_DISTANCE_SCALE and TRIAGE_AUTO_ACCEPT_SCORE
+SCALE = 100.0
+AUTO_ACCEPT = 0.02
+
+
+class ChangeScoreTests(unittest.TestCase):
+    def setUp(self):
+        self.production = Stop(-33.45, -70.66, ['Los Heroes'])
+
+    def score(self, pending):
+        return dedup.change_score(pending, self.production, SCALE)
+
+    def test_no_change(self):
+        self.assertEqual(0.0, self.score(Stop(-33.45, -70.66, ['Los Heroes'])))
+
+    def test_distance_scale(self):
+        # 0.0001 degrees of latitude are about 11 meters
+        self.assertAlmostEqual(0.111, self.score(Stop(-33.4501, -70.66, ['Los Heroes'])), 3)
+        self.assertAlmostEqual(0.557, self.score(Stop(-33.4505, -70.66, ['Los Heroes'])), 3)
+        # moves beyond the scale count as 1.0
+        self.assertEqual(1.0, self.score(Stop(-33.46, -70.66, ['Los Heroes'])))
+        self.assertEqual(1.0, dedup.change_score(Stop(-33.4505, -70.66, ['Los Heroes']), self.production, 10.0))
+
+    def test_auto_accept(self):
+        # moves of a meter or so are accepted without review
+        self.assertTrue(self.score(Stop(-33.450009, -70.66, ['Los Heroes'])) <= AUTO_ACCEPT)
+        self.assertTrue(self.score(Stop(-33.45003, -70.66, ['Los Heroes'])) > AUTO_ACCEPT)
+        # any renaming is reviewed
+        self.assertTrue(self.score(Stop(-33.45, -70.66, ['Los Heroes.'])) > AUTO_ACCEPT)
+
+    def test_names_and_type(self):
+        self.assertAlmostEqual(0.1, self.score(Stop(-33.45, -70.66, [u'Los H\xe9roes'])))
+        # no character in common
+        self.assertEqual(1.0, self.score(Stop(-33.45, -70.66, ['21'])))
+        self.assertEqual(1.0, self.score(Stop(-33.45, -70.66, ['Los Heroes'], "STATION")))
+        # everything changed, the score of stops not scored yet
+        self.assertEqual(3.0, self.score(Stop(-33.47, -70.66, ['21'], "STATION")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Unit tests for nearest.py
+
+   The results are compared with a brute force search. Run from this
+   directory with PYTHONPATH=..
+
+   Stefan Wehner (2011)
+"""
+
+import random
+import unittest
+
+import nearest
+from geo.geomath import haversine
+
+
+def brute_force(points, candidates, k, max_distance):
+    res = []
+    for lat, lon in points:
+        found = [(haversine(lat, lon, clat, clon), cid) for clat, clon, cid in candidates]
+        res.append(sorted([(d, cid) for d, cid in found if d <= max_distance])[:k])
+    return res
+
+
+def scatter(rnd, lat, lon, size, count):
+    """count random (lat, lon) within size degrees around lat, lon"""
+    return [(lat + rnd.uniform(-size, size), lon + rnd.uniform(-size, size)) for i in range(count)]
+
+
+class NearestTests(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(42)
+
+    def assertSame(self, expected, found):
+        self.assertEqual(len(expected), len(found))
+        for e, f in zip(expected, found):
+            self.assertEqual([cid for d, cid in e], [cid for d, cid in f])
+            for (d1, cid1), (d2, cid2) in zip(e, f):
+                self.assertAlmostEqual(d1, d2, 6)
+
+    def check(self, lat, lon, size, k, max_distance):
+        points = scatter(self.rnd, lat, lon, size, 200)
+        candidates = [(clat, clon, i) for i, (clat, clon) in enumerate(scatter(self.rnd, lat, lon, size, 500))]
+        expected = brute_force(points, candidates, k, max_distance)
+        # some points have fewer than k neighbours, some none at all
+        self.assertTrue([e for e in expected if 0 < len(e) < k])
+        self.assertTrue([e for e in expected if len(e) == k])
+        self.assertSame(expected, nearest._nearest_grid(points, candidates, k, max_distance))
+        self.assertSame(expected, nearest.nearest_neighbours(points, candidates, k, max_distance))
+
+    def test_santiago(self):
+        self.check(-33.45, -70.66, 0.05, 6, 500)
+
+    def test_magallanes(self):
+        # the longitude cells get narrower towards the poles
+        self.check(-54.9, -67.6, 0.05, 6, 500)
+        self.check(-84.0, -70.0, 0.3, 3, 800)
+
+    def test_equator(self):
+        # the grid cells around lat and lon 0
+        self.check(0.0, 0.0, 0.05, 4, 500)
+
+    def test_empty(self):
+        self.assertEqual([], nearest.nearest_neighbours([], [(0.0, 0.0, 1)], 6, 500))
+        self.assertEqual([[], []], nearest.nearest_neighbours([(0.0, 0.0), (1.0, 1.0)], [], 6, 500))
+        self.assertEqual([[]], nearest._nearest_grid([(0.0, 0.0)], [(1.0, 1.0, 1)], 6, 500))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+"""Unit tests for osmparse.py
+
+   Run from this directory with PYTHONPATH=..
+
+   Stefan Wehner (2011)
+"""
+
+import StringIO
+import bz2
+import datetime
+import gzip
+import hashlib
+import unittest
+import zipfile
+
+import osmparse
+
+
+def node(osm_id, tags=None, lat=-33.45, lon=-70.66, timestamp="2011-03-04T10:11:12Z"):
+    data = '<node id="%d" lat="%s" lon="%s" timestamp="%s"' % (osm_id, lat, lon, timestamp)
+    if not tags:
+        return data + '/>\n'
+    return data + '>\n' + "".join(['  <tag k="%s" v="%s"/>\n' % tag for tag in tags]) + '</node>\n'
+
+
+def osm(*elements):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n' + "".join(elements) + '</osm>\n'
+
+
+# a way and a relation with tags of stops, which are no nodes
+WAY = '<way id="7">\n  <nd ref="1"/>\n  <tag k="highway" v="bus_stop"/>\n  <tag k="name" v="Way"/>\n</way>\n'
+RELATION = '<relation id="8">\n  <member type="node" ref="1" role=""/>\n' \
+           '  <tag k="public_transport" v="stop_area"/>\n</relation>\n'
+
+DATA = osm(node(1, [("highway", "bus_stop"), ("name", "Los H\xc3\xa9roes")]),
+           node(2),
+           node(3, [("building", "yes")]),
+           WAY,
+           node(4, [("place", "town"), ("name", "Talca")], lat=-35.426, lon=-71.655),
+           RELATION,
+           node(5, [("railway", "station"), ("public_transport", "stop"), ("name", "Alameda")]))
+
+FOUND = [(1, u'Los H\xe9roes', 'STOP'), (4, u'Talca', 'PLACE'),
+         (5, u'Alameda', 'STATION'), (5, u'Alameda', 'STOP')]
+
+
+def parse(data, backend='expat'):
+    """Returns the handler and the found nodes as (osm id, name, kind)"""
+    found = []
+    def node_cb(node, kind):
+        found.append((node.osm_id, node.name, kind))
+    handler = osmparse.BACKENDS[backend](data, (osmparse.StopAttr, node_cb))
+    return handler, found
+
+
+class ParserTests(unittest.TestCase):
+    def test_backends(self):
+        for backend in osmparse.BACKENDS:
+            handler, found = parse(DATA, backend)
+            self.assertEqual(5, handler._counter)
+            self.assertEqual(sorted(FOUND), sorted(found))
+
+    def test_same_callbacks(self):
+        # same nodes in the same order, with the same attributes
+        nodes = {}
+        for backend in osmparse.BACKENDS:
+            nodes[backend] = []
+            def node_cb(node, kind):
+                nodes[backend].append((node.osm_id, node.name, node.lat, node.lon, node.timestamp, node.attr, kind))
+            osmparse.BACKENDS[backend](DATA, (osmparse.StopAttr, node_cb))
+        self.assertEqual(nodes['sax'], nodes['expat'])
+        self.assertEqual(datetime.datetime(2011, 3, 4, 10, 11, 12), nodes['expat'][0][4])
+
+    def test_skipped_children(self):
+        # tags of ways and relations do not leak into the nodes around them
+        data = osm(WAY, node(1), RELATION, node(2, [("name", "Moneda")]), WAY)
+        for backend in osmparse.BACKENDS:
+            handler, found = parse(data, backend)
+            self.assertEqual(2, handler._counter)
+            self.assertEqual([], found)
+
+    def test_file_data(self):
+        handler, found = parse(StringIO.StringIO(DATA))
+        self.assertEqual(FOUND, sorted(found))
+
+    def test_broken_data(self):
+        for backend in osmparse.BACKENDS:
+            self.assertRaises(SyntaxError, parse, DATA[:-20], backend)
+
+
+class SlicerTests(unittest.TestCase):
+    def slice_all(self, fp, size, offset=0):
+        slicer = osmparse.OSMSlicer(fp, offset)
+        found = []
+        data = slicer.next_slice(size)
+        while data is not None:
+            found.extend(parse(data)[1])
+            data = slicer.next_slice(size)
+        return found
+
+    def test_slices(self):
+        for size in [1, 50, 200, len(DATA)]:
+            self.assertEqual(FOUND, sorted(self.slice_all(StringIO.StringIO(DATA), size)))
+
+    def test_resume(self):
+        # every slice is continued by a new slicer from its offset, like
+        # the chained tasks of an import do
+        for size in [1, 50, 200]:
+            found = []
+            offset = 0
+            while True:
+                slicer = osmparse.OSMSlicer(StringIO.StringIO(DATA), offset)
+                data = slicer.next_slice(size)
+                if data is None:
+                    break
+                found.extend(parse(data)[1])
+                offset = slicer.offset
+                if slicer.eof:
+                    break
+            self.assertEqual(sorted(FOUND), sorted(found))
+
+    def test_resume_compressed(self):
+        # compressed streams without seek are skipped up to the offset
+        slicer = osmparse.OSMSlicer(StringIO.StringIO(DATA), 0)
+        first = parse(slicer.next_slice(200))[1]
+        rest = self.slice_all(osmparse.open_osm(StringIO.StringIO(compress_gzip(DATA))), 200, slicer.offset)
+        self.assertEqual(sorted(FOUND), sorted(first + rest))
+
+
+def compress_gzip(data):
+    out = StringIO.StringIO()
+    fp = gzip.GzipFile(fileobj=out, mode='wb')
+    fp.write(data)
+    fp.close()
+    return out.getvalue()
+
+
+def compress_zip(data, compress_type):
+    out = StringIO.StringIO()
+    fp = zipfile.ZipFile(out, 'w', compress_type)
+    fp.writestr("chile.osm", data)
+    fp.close()
+    return out.getvalue()
+
+
+class OpenTests(unittest.TestCase):
+    def read(self, data, size=-1):
+        return osmparse.open_osm(StringIO.StringIO(data)).read(size)
+
+    def test_plain(self):
+        self.assertEqual(DATA, self.read(DATA))
+
+    def test_compressed(self):
+        for data in [compress_gzip(DATA), bz2.compress(DATA),
+                     compress_zip(DATA, zipfile.ZIP_DEFLATED), compress_zip(DATA, zipfile.ZIP_STORED)]:
+            self.assertEqual(DATA, self.read(data))
+            self.assertEqual(DATA[:100], self.read(data, 100))
+
+    def test_large(self):
+        # more than one chunk of compressed data
+        data = osm(*[node(i, [("highway", "bus_stop"), ("name", hashlib.md5(str(i)).hexdigest())])
+                     for i in range(5000)])
+        self.assertTrue(len(bz2.compress(data)) > osmparse.READ_CHUNK_SIZE)
+        self.assertEqual(data, self.read(bz2.compress(data)))
+        self.assertEqual(data, self.read(compress_gzip(data)))
+
+    def test_broken_zip(self):
+        self.assertRaises(zipfile.BadZipfile, self.read, compress_zip(DATA, zipfile.ZIP_DEFLATED)[:-30])
+
+
+CHANGE = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<create>
+%s</create>
+<modify>
+%s</modify>
+<delete>
+%s</delete>
+<modify>
+%s</modify>
+</osmChange>
+""" % (node(1, [("highway", "bus_stop"), ("name", "Nueva")], timestamp="2011-03-01T00:00:00Z") +
+       node(2, [("highway", "bus_stop"), ("name", "Borrada")]),
+       node(1, [("highway", "bus_stop"), ("name", "Cambiada")], timestamp="2011-03-02T00:00:00Z") +
+       node(3, [("building", "yes")]) + WAY,
+       node(2, timestamp="2011-03-05T00:00:00Z") + node(4),
+       node(4, [("place", "town"), ("name", "Talca")]))
+
+
+class ChangeTests(unittest.TestCase):
+    def test_is_change(self):
+        self.assertTrue(osmparse.is_change(CHANGE[:100]))
+        self.assertFalse(osmparse.is_change(DATA[:100]))
+
+    def test_actions(self):
+        calls = []
+        def node_cb(node, kind):
+            calls.append(('node', node.osm_id, node.name))
+        def delete_cb(osm_id):
+            calls.append(('delete', osm_id))
+        handler = osmparse.OSMChangeHandler(CHANGE, (osmparse.StopAttr, node_cb), delete_cb)
+        # modified nodes which do not match may have been stops before
+        self.assertEqual([('node', 1, 'Nueva'), ('node', 2, 'Borrada'),
+                          ('node', 1, 'Cambiada'), ('delete', 3),
+                          ('delete', 2), ('delete', 4),
+                          ('node', 4, 'Talca')], calls)
+        self.assertEqual(datetime.datetime(2011, 3, 5), handler.timestamp)
+
+    def test_last_action(self):
+        # collected by osm id like BalsaStopStoreTask.apply_change does
+        changes = {}
+        def node_cb(node, kind):
+            changes[node.osm_id] = (node.name, kind)
+        def delete_cb(osm_id):
+            changes[osm_id] = None
+        osmparse.OSMChangeHandler(CHANGE, (osmparse.StopAttr, node_cb), delete_cb)
+        self.assertEqual({1: (u'Cambiada', 'STOP'), 2: None, 3: None, 4: (u'Talca', 'PLACE')}, changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Unit tests for osmpbf.py
+
+   The PBF data is encoded here, block by block, so every field of the
+   fixture can be seen. Run from this directory with PYTHONPATH=..
+
+   Stefan Wehner (2011)
+"""
+
+import StringIO
+import datetime
+import struct
+import unittest
+import zlib
+
+import osmparse
+import osmpbf
+
+
+def varint(value):
+    data = ""
+    while value > 0x7f:
+        data += chr(value & 0x7f | 0x80)
+        value >>= 7
+    return data + chr(value)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, value):
+    """Varint field"""
+    return varint(number << 3) + varint(value)
+
+
+def message(number, data):
+    """Length delimited field"""
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+def packed(number, values):
+    return message(number, "".join([varint(value) for value in values]))
+
+
+def delta(values):
+    """Delta and zigzag coded like the sint64 fields of DenseNodes"""
+    res = []
+    last = 0
+    for value in values:
+        res.append(zigzag(value - last))
+        last = value
+    return res
+
+
+def blob(blob_type, block):
+    data = field(2, len(block)) + message(3, zlib.compress(block))
+    header = message(1, blob_type) + field(3, len(data))
+    return struct.pack(">I", len(header)) + header + data
+
+
+def pbf(*groups, **kwds):
+    """Returns a PBF file of one block with the groups and the strings
+    of the string table"""
+    strings = kwds.get('strings', [])
+    header = message(4, "OsmSchema-V0.6") + message(4, "DenseNodes")
+    block = message(1, "".join([message(1, s) for s in [""] + strings]))
+    for group in groups:
+        block += message(2, group)
+    return blob("OSMHeader", header) + blob("OSMData", block)
+
+
+# string table of the fixtures, index 0 is the empty string
+STRINGS = ["highway", "bus_stop", "name", "Los H\xc3\xa9roes", "place", "town", "Talca"]
+
+
+def index(s):
+    return STRINGS.index(s) + 1
+
+
+class OSMPBFHandlerTests(unittest.TestCase):
+    def parse(self, data):
+        self.nodes = []
+        def node_cb(node, kind):
+            self.nodes.append((node, kind))
+        return osmpbf.OSMPBFHandler(data, (osmparse.StopAttr, node_cb))
+
+    def test_is_pbf(self):
+        self.assertTrue(osmpbf.is_pbf(StringIO.StringIO(pbf(strings=STRINGS))))
+        self.assertFalse(osmpbf.is_pbf(StringIO.StringIO("<?xml version='1.0'?><osm>")))
+
+    def test_dense_nodes(self):
+        ids = [100, 102, 105]
+        # 1e-7 degrees at the default granularity of 100 nanodegrees
+        lats = [-334500000, -334510000, -354260000]
+        lons = [-706600000, -706610000, -716550000]
+        timestamps = [1300000000, 1300000060, 1299999000]
+        keys_vals = [index("highway"), index("bus_stop"), index("name"), index("Los H\xc3\xa9roes"), 0,
+                     0,
+                     index("place"), index("town"), index("name"), index("Talca"), 0]
+        dense = packed(1, delta(ids)) + message(5, packed(2, delta(timestamps))) + \
+                packed(8, delta(lats)) + packed(9, delta(lons)) + packed(10, keys_vals)
+        handler = self.parse(pbf(message(2, dense), strings=STRINGS))
+
+        self.assertEqual(3, handler._counter)
+        self.assertEqual([(100, 'STOP'), (105, 'PLACE')],
+                         [(node.osm_id, kind) for node, kind in self.nodes])
+        stop = self.nodes[0][0]
+        self.assertEqual(u'Los H\xe9roes', stop.name)
+        self.assertAlmostEqual(-33.45, stop.lat)
+        self.assertAlmostEqual(-70.66, stop.lon)
+        self.assertEqual(datetime.datetime(2011, 3, 13, 7, 6, 40), stop.timestamp)
+        town = self.nodes[1][0]
+        self.assertEqual(u'Talca', town.name)
+        self.assertAlmostEqual(-35.426, town.lat)
+        self.assertAlmostEqual(-71.655, town.lon)
+        self.assertEqual(datetime.datetime(2011, 3, 13, 6, 50), town.timestamp)
+
+    def test_string_table(self):
+        # without any of the searched keys in the string table the block
+        # is skipped as a whole
+        dense = packed(1, delta([100])) + packed(8, delta([0])) + packed(9, delta([0])) + \
+                packed(10, [1, 2, 0])
+        handler = self.parse(pbf(message(2, dense), strings=["building", "yes"]))
+        self.assertEqual(0, handler._counter)
+        self.assertEqual([], self.nodes)
+
+    def test_unpacked_fields(self):
+        # repeated fields may come as one varint field per value
+        plain = field(1, zigzag(42)) + \
+                field(2, index("highway")) + field(2, index("name")) + \
+                field(3, index("bus_stop")) + field(3, index("Los H\xc3\xa9roes")) + \
+                field(8, zigzag(-334500000)) + field(9, zigzag(-706600000))
+        dense = "".join([field(1, value) for value in delta([7, 9])]) + \
+                "".join([field(8, value) for value in delta([-354260000, -354260000])]) + \
+                "".join([field(9, value) for value in delta([-716550000, -716550000])]) + \
+                "".join([field(10, value) for value in [0, index("place"), index("town"), 0]])
+        handler = self.parse(pbf(message(1, plain), message(2, dense), strings=STRINGS))
+        self.assertEqual(3, handler._counter)
+        self.assertEqual([(42, 'STOP'), (9, 'PLACE')],
+                         [(node.osm_id, kind) for node, kind in self.nodes])
+        self.assertEqual(u'Los H\xe9roes', self.nodes[0][0].name)
+        self.assertAlmostEqual(-35.426, self.nodes[1][0].lat)
+
+    def test_broken_data(self):
+        data = pbf(message(2, packed(1, delta([100]))), strings=STRINGS)
+        self.assertRaises(SyntaxError, self.parse, data[:-5])
+
+
+if __name__ == '__main__':
+    unittest.main()
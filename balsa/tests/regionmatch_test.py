@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+"""Unit tests for regionmatch.py
+
+   Run from this directory with PYTHONPATH=..
+
+   Stefan Wehner (2011)
+"""
+
+import unittest
+
+import regionmatch
+
+
+class PlainTests(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual("biobio", regionmatch.plain(u"Bio-Bío"))
+        self.assertEqual("biobio", regionmatch.plain("Bio-B\xc3\xado"))
+        self.assertEqual("ohiggins", regionmatch.plain(u"O'Higgins"))
+
+    def test_trigrams(self):
+        self.assertEqual(set(["  m", " ma", "mau", "aul", "ule", "le "]), regionmatch.trigrams("maule"))
+
+
+class RegionResolverTests(unittest.TestCase):
+    def setUp(self):
+        self.resolver = regionmatch.RegionResolver()
+
+    def test_exact(self):
+        # long and short names, in any case and with or without accents
+        self.assertEqual((u"V", u"Valparaíso"), self.resolver.resolve("Valparaiso"))
+        self.assertEqual((u"VIII", u"Bio-Bío"), self.resolver.resolve(u"BIOBIO"))
+        self.assertEqual((u"XIII", u"Metropolitana"), self.resolver.resolve("XIII"))
+        self.assertEqual((u"XIV", u"Los Ríos"), self.resolver.resolve("Los R\xc3\xados"))
+
+    def test_trigrams(self):
+        # without the fuzzy fallback, misspellings are found by trigrams
+        resolver = regionmatch.RegionResolver(min_ratio=1.0)
+        self.assertEqual((u"V", u"Valparaíso"), resolver.resolve("Valparaizo"))
+        self.assertEqual((u"IX", u"La Araucanía"), resolver.resolve("Araucania"))
+        self.assertEqual((u"XIII", u"Metropolitana"), resolver.resolve(u"Región Metropolitana"))
+        # below the trigram score
+        self.assertEqual(None, resolver.resolve("Metropolitana de Santiago"))
+
+    def test_fuzzy(self):
+        self.assertEqual((u"XIII", u"Metropolitana"), self.resolver.resolve("Metropolitana de Santiago"))
+        self.assertEqual((u"XII", u"Magallanes"), self.resolver.resolve("Magallanes y Antartica"))
+        # only the fuzzy comparison is left
+        resolver = regionmatch.RegionResolver(min_trigram_score=1.1)
+        self.assertEqual((u"VII", u"Maule"), resolver.resolve("Maul"))
+        self.assertEqual((u"XIII", u"Metropolitana"), resolver.resolve("Metropolitana de Santiago"))
+
+    def test_no_match(self):
+        self.assertEqual(None, self.resolver.resolve("xyz"))
+        self.assertEqual(None, self.resolver.resolve(""))
+
+    def test_memo(self):
+        self.assertEqual(None, self.resolver.resolve("xyz"))
+        self.assertTrue("xyz" in self.resolver._memo)
+        self.resolver._memo["Valparaiso"] = (u"NY", u"New York")
+        self.assertEqual((u"NY", u"New York"), self.resolver.resolve("Valparaiso"))
+
+    def test_regions(self):
+        resolver = regionmatch.RegionResolver([("RM", "Regi\xc3\xb3n Metropolitana")])
+        self.assertEqual((u"RM", u"Región Metropolitana"), resolver.resolve("region metropolitana"))
+        self.assertEqual(None, resolver.resolve("Valparaiso"))
+
+
+if __name__ == '__main__':
+    unittest.main()
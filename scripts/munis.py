@@ -5,14 +5,27 @@ import xml.sax
 import json
 import unicodedata
 import inspect
+import StringIO
 import lib.euclid
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'balsa'))
+import osmparse
+import regionmatch
+
 # contains Nodes organized by osm_id
 Nodes={}
 # contains Ways organized by osm_id
 Ways={}
 # contains Relations organized by osm_id
 Relations={}
+# boundaries used by the worker processes of the parallel node enrichment
+Bounds=None
+
+# maps boundary names to the region names the import knows
+Regions = regionmatch.RegionResolver()
+
+# size of the byte ranges the node file is split into for parallel enrichment
+RANGE_SIZE = 16*1024*1024
 
 class Box(object):
     """A geographic bounding box"""
@@ -272,11 +285,15 @@ class Relation(object):
 class OSMXMLNodeParser(xml.sax.ContentHandler):
     """Parses the file, enriches it with location information and writes it to stdout immediately"""
 
-    def __init__(self,bdy_container,out):
+    def __init__(self,bdy_container,out,fragment=False):
+        """With fragment set, only the elements inside of <osm> are written"""
         self.node = None
+        self.fragment = fragment
         self.writer = xml.sax.saxutils.XMLGenerator(out, "UTF-8")
-        self.writer.startDocument()
         self._bdy_container = bdy_container
+        if fragment:
+            return
+        self.writer.startDocument()
         attr_vals = {
             u'version': "0.6",
             u'generator': u"Balsa.cl AdminBoundary enrichment"
@@ -305,6 +322,9 @@ class OSMXMLNodeParser(xml.sax.ContentHandler):
                         self.writer.endElement(name)
                     region = self._bdy_container.get_region(self.node.lat, self.node.lon)
                     if region:
+                        region_match = Regions.resolve(region)
+                        if region_match:
+                            region = region_match[1]
                         self.writer.startElement(name, {'k': 'is_in:region', 'v': region})
                         self.writer.endElement(name)
         elif name == 'osm':
@@ -317,11 +337,26 @@ class OSMXMLNodeParser(xml.sax.ContentHandler):
     def endElement(self, name):
         if name == "node":
             self.node = None
-        else:
-            pass
+        elif name == "osm" and self.fragment:
+            return
         self.writer.endElement(name)
 
 
+def enrich_range(args):
+    """Worker for parallel enrichment of a byte range of the node file
+
+    Returns the enriched xml elements and the tagging statistics.
+    """
+    filename, start, end = args
+    out = StringIO.StringIO()
+    for level in Bounds.statistics:
+        for key in Bounds.statistics[level]:
+            Bounds.statistics[level][key] = 0
+    handler = OSMXMLNodeParser(Bounds, out, fragment=True)
+    xml.sax.parseString(osmparse.read_range(filename, start, end), handler)
+    return out.getvalue(), Bounds.statistics
+
+
 class OSMXMLFileParser(xml.sax.ContentHandler):
     """Parse OSM XML file and extract the nodes, ways and relation which make boundaries"""
     def __init__(self):
@@ -388,7 +423,7 @@ class OSMXMLFileParser(xml.sax.ContentHandler):
 
 def print_usage():
     print """Usage:
-python munis.py <osm boundary xml file>  <osm node xml file> <out file>
+python munis.py <osm boundary xml file>  <osm node xml file> <out file> [processes]
 
 <boundary input file>  contains relations and ways tagged as boundary=administrative
 <osm node xml file>    all nodes in this second input file which have a name will be
@@ -397,6 +432,7 @@ python munis.py <osm boundary xml file>  <osm node xml file> <out file>
                        location. E.g.: is_in:country (admin level 2), is_in:region (admin_level 4)
                        is_in:municipality (admin_level 8)
 <out file>             The enriched file will be written to the given filename.
+[processes]            Number of processes which enrich the nodes in parallel.
 
 All diagnostic information is written to stdout.
 """
@@ -481,9 +517,29 @@ def main(args):
         logging.critical("Can't open file: "+outfile)
         sys.exit(1)
 
+    processes = 1
+    if len(args) > 4:
+        processes = int(args[4])
+
     # parse osm file
     handler = OSMXMLNodeParser(bounds, out)
-    xml.sax.parse(fp, handler)
+    if processes > 1:
+        import multiprocessing
+        # the worker processes inherit the boundaries
+        global Bounds
+        Bounds = bounds
+        pool = multiprocessing.Pool(processes)
+        ranges = osmparse.split_ranges(nodefile, RANGE_SIZE)
+        print "Enrich %d ranges in %d processes..." % (len(ranges), processes)
+        for data, statistics in pool.imap(enrich_range, [(nodefile, start, end) for start, end in ranges]):
+            out.write(data)
+            for level in statistics:
+                for key in statistics[level]:
+                    bounds.statistics[level][key] += statistics[level][key]
+        pool.close()
+        handler.writer.endElement(u'osm')
+    else:
+        xml.sax.parse(fp, handler)
     handler.cleanup()
     fp.close()
     out.close()
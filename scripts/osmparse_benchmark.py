@@ -0,0 +1,100 @@
+"""Throughput benchmark for the osmparse backends
+
+Writes a synthetic osm file and parses it with every backend in a
+separate process, so that the peak memory of each one can be measured.
+
+Usage:
+python osmparse_benchmark.py [number of nodes] [osm file]
+
+If the osm file exists it is used as it is, otherwise it is created.
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'balsa'))
+import osmparse
+
+# share of nodes with tags, and of those the share matching StopAttr
+TAGGED_SHARE = 0.05
+MATCH_SHARE = 0.2
+
+
+def write_synthetic_file(filename, num_nodes):
+    """Write an osm file with num_nodes nodes plus ways referencing them"""
+    rnd = random.Random(42)
+    out = open(filename, 'w')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="balsa benchmark">\n')
+    for i in xrange(1, num_nodes+1):
+        out.write(' <node id="%d" lat="%.7f" lon="%.7f" version="1" changeset="1" user="balsa" uid="1" visible="true" timestamp="2011-03-04T10:11:12Z"' %
+                  (i, rnd.uniform(-56, -17), rnd.uniform(-76, -66)))
+        if rnd.random() < TAGGED_SHARE:
+            out.write('>\n  <tag k="name" v="Nodo %d"/>\n' % (i))
+            if rnd.random() < MATCH_SHARE:
+                out.write('  <tag k="highway" v="bus_stop"/>\n  <tag k="is_in:city" v="Chillan"/>\n')
+            else:
+                out.write('  <tag k="amenity" v="bench"/>\n')
+            out.write(' </node>\n')
+        else:
+            out.write('/>\n')
+    for i in xrange(1, num_nodes/10+1):
+        out.write(' <way id="%d" version="1" timestamp="2011-03-04T10:11:12Z">\n' % (i))
+        for j in range(8):
+            out.write('  <nd ref="%d"/>\n' % (rnd.randint(1, num_nodes)))
+        out.write('  <tag k="highway" v="residential"/>\n </way>\n')
+    for i in xrange(1, num_nodes/1000+1):
+        out.write(' <relation id="%d" version="1" timestamp="2011-03-04T10:11:12Z">\n' % (i))
+        for j in range(5):
+            out.write('  <member type="way" ref="%d" role="outer"/>\n' % (rnd.randint(1, num_nodes/10)))
+        out.write('  <tag k="type" v="multipolygon"/>\n </relation>\n')
+    out.write('</osm>\n')
+    out.close()
+
+
+def run_backend(backend, filename):
+    """Parse file with backend and print nodes, matches, seconds and peak rss"""
+    matches = [0]
+    def count_cb(node, kind):
+        matches[0] += 1
+    fp = open(filename, 'rb')
+    start = time.time()
+    handler = osmparse.BACKENDS[backend](osmparse.open_osm(fp), (osmparse.StopAttr, count_cb))
+    elapsed = time.time() - start
+    fp.close()
+    # ru_maxrss is in kilobytes on linux
+    print handler._counter, matches[0], elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main(args):
+    if len(args) > 3 and args[1] == '--run':
+        run_backend(args[2], args[3])
+        return
+
+    num_nodes = 2000000
+    if len(args) > 1:
+        num_nodes = int(args[1])
+    if len(args) > 2:
+        filename = args[2]
+    else:
+        filename = os.path.join(tempfile.gettempdir(), "balsa_benchmark_%d.osm" % (num_nodes))
+    if not os.path.exists(filename):
+        print "Writing %d nodes to %s..." % (num_nodes, filename)
+        write_synthetic_file(filename, num_nodes)
+    print "%d MB osm data in %s" % (os.path.getsize(filename)/(1024*1024), filename)
+
+    print "%-8s %10s %8s %8s %12s %10s" % ("backend", "nodes", "matches", "seconds", "nodes/sec", "peak MB")
+    for backend in sorted(osmparse.BACKENDS.keys()):
+        output = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run', backend, filename],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        nodes, matches, elapsed, rss = output.split()[-4:]
+        print "%-8s %10d %8d %8.2f %12.0f %10.1f" % (backend, int(nodes), int(matches), float(elapsed),
+                                                     int(nodes)/float(elapsed), int(rss)/1024.0)
+
+
+if __name__ == "__main__":
+    main(sys.argv)